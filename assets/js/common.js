@@ -136,6 +136,12 @@ export async function fetchCSV(url){
   return parseCSV(txt);
 }
 
+export async function fetchJSON(url){
+  const res = await fetch(url, { cache: "no-store" });
+  if (!res.ok) throw new Error(`Falha ao carregar JSON (${res.status}) → ${url}`);
+  return res.json();
+}
+
 export function setActiveNav(activeKey){
   const links = $all("[data-nav]");
   links.forEach(a => {
@@ -3,12 +3,38 @@ import { fetchCSV, createTable, makeSearch, formatNumber, formatInt, setActiveNa
 setActiveNav("ranking");
 
 const DATA_URL = new URL('../../data/member_ranking_export.csv', import.meta.url);
+// rankings por janela (compute_metrics.export_ranking_windows_to_csv): 7d, 30d, patch 14.3...
+const WINDOWS_URL = new URL('../../data/ranking_windows_export.csv', import.meta.url);
+
+async function loadWindows(){
+  try{
+    return await fetchCSV(WINDOWS_URL);
+  }catch(e){
+    return [];
+  }
+}
+
+// positionDelta: posição anterior - atual (vazio = entrou no ranking agora)
+function formatDelta(v){
+  if (v === undefined) return null;  // CSV antigo, sem a coluna
+  if (v === "" || v === null) return "novo";
+  const n = Number(v);
+  if (n > 0) return `▲${n}`;
+  if (n < 0) return `▼${-n}`;
+  return "=";
+}
+
+function windowLabel(w){
+  if (w.startsWith("patch ")) return `Patch ${w.slice(6)}`;
+  if (w.endsWith("d")) return `Últimos ${w.slice(0,-1)} dias`;
+  return w;
+}
 
 (async function init(){
   const mount = document.getElementById("ranking-table");
   const kpiMount = document.getElementById("kpis");
 
-  const rows = await fetchCSV(DATA_URL);
+  const [rows, windowRows] = await Promise.all([fetchCSV(DATA_URL), loadWindows()]);
 
   // KPIs
   const totalPlayers = rows.length;
@@ -24,6 +50,7 @@ const DATA_URL = new URL('../../data/member_ranking_export.csv', import.meta.url
   const table = createTable({
     columns: [
       { key:"position", label:"#", sortType:"number", align:"right", format:(v)=> formatInt(v) },
+      { key:"positionDelta", label:"±", sortType:"number", align:"right", format:(v)=> formatDelta(v) },
       { key:"nick", label:"Nick", compute:(r)=> `${r.nick}#${r.tag}` },
       { key:"matches", label:"P", sortType:"number", align:"right", format:(v)=> formatInt(v) },
       { key:"meanFinalScore", label:"Score", sortType:"number", align:"right", format:(v)=> formatNumber(v,{decimals:1}) },
@@ -37,6 +64,24 @@ const DATA_URL = new URL('../../data/member_ranking_export.csv', import.meta.url
   const {wrap:searchWrap, input} = makeSearch((q)=> table.filterByText(q, ["nick","tag"]), "Pesquisar jogador...");
   controls.appendChild(searchWrap);
 
+  // Janela do ranking ("Geral" = member_ranking_export.csv); sem o CSV das janelas, fica só o geral
+  const windows = [...new Set(windowRows.map(r => r.window))];
+  if (windows.length){
+    const select = document.createElement("select");
+    select.className = "btn";
+    [["", "Geral"], ...windows.map(w => [w, windowLabel(w)])].forEach(([value, label]) => {
+      const opt = document.createElement("option");
+      opt.value = value;
+      opt.textContent = label;
+      select.appendChild(opt);
+    });
+    select.addEventListener("change", ()=> {
+      table.setRows(select.value ? windowRows.filter(r => r.window === select.value) : rows);
+      table.filterByText(input.value, ["nick","tag"]);
+    });
+    controls.appendChild(select);
+  }
+
   const btn = document.createElement("button");
   btn.className = "btn";
   btn.textContent = "Limpar";
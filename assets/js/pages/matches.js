@@ -1,12 +1,15 @@
-import { fetchCSV, createTable, makeSearch, formatNumber, formatInt, teamPositionLabel, setActiveNav, renderKpis } from "../common.js";
+import { fetchCSV, fetchJSON, createTable, makeSearch, formatNumber, formatInt, teamPositionLabel, setActiveNav, renderKpis } from "../common.js";
 
 setActiveNav("matches");
 
 const URL_MATCHES = new URL('../../data/match_individual_score_grouped_export.csv', import.meta.url);
+// pacotes JSON paginados (compute_metrics.export_match_bundles_to_json)
+const URL_MATCHES_INDEX = new URL('../../data/matches/index.json', import.meta.url);
 
 function safeParsePlayersScores(raw){
   try{
     if (!raw) return [];
+    if (Array.isArray(raw)) return raw;
     return JSON.parse(raw);
   }catch(e){
     return [];
@@ -60,14 +63,19 @@ function createMatchCard(match){
     team_position: p.team_position,
     nick: p.nick,
     tag: p.tag,
+    champion_name: p.champion_name,
     final_score: p.final_score
   }));
+  // mesmo texto dos search-NNNN.json dos pacotes
+  card.dataset.search = [match.match_riot_id || "", ...players.map(p => `${p.nick}#${p.tag} ${p.champion_name || ""}`)]
+    .join(" ").toLowerCase();
 
   const table = createTable({
     columns: [
       { key:"position", label:"#", sortType:"number", align:"right", format:(v)=> formatInt(v) },
       { key:"team_position", label:"Rota", compute:(r)=> teamPositionLabel(r.team_position) },
       { key:"nick", label:"Nick", compute:(r)=> `${r.nick}#${r.tag}` },
+      { key:"champion_name", label:"Campeão" },
       { key:"final_score", label:"Score", sortType:"number", align:"right", format:(v)=> formatNumber(v,{decimals:1}) }
     ],
     rows,
@@ -89,13 +97,27 @@ function createMatchCard(match){
   return card;
 }
 
+async function loadIndex(){
+  try{
+    return await fetchJSON(URL_MATCHES_INDEX);
+  }catch(e){
+    return null;
+  }
+}
+
 (async function init(){
-  const rows = await fetchCSV(URL_MATCHES);
+  const index = await loadIndex();
+
+  // Sem os pacotes JSON: carrega o CSV inteiro (formato antigo)
+  let csvRows = null;
+  if (!index){
+    csvRows = await fetchCSV(URL_MATCHES);
+  }
 
-  // KPIs
-  const totalMatches = rows.length;
-  const totalPlayers = rows.reduce((acc,r)=> acc + Number(r.players || 0), 0);
-  const bestMax = rows.reduce((m,r)=> Math.max(m, Number(r.maxFinalScore||0)), 0);
+  // KPIs (com os pacotes, vêm prontos no index.json)
+  const totalMatches = index ? index.total_matches : csvRows.length;
+  const totalPlayers = index ? index.total_players : csvRows.reduce((acc,r)=> acc + Number(r.players || 0), 0);
+  const bestMax = index ? index.max_final_score : csvRows.reduce((m,r)=> Math.max(m, Number(r.maxFinalScore||0)), 0);
 
   renderKpis(document.getElementById("kpis"), [
     { label:"Partidas", value: formatInt(totalMatches), accent:true },
@@ -105,17 +127,84 @@ function createMatchCard(match){
 
   const mount = document.getElementById("matches");
   const controls = document.getElementById("controls");
+  const showError = (err)=> {
+    console.error(err);
+    document.getElementById("page-error").textContent = `Erro ao carregar dados: ${err.message}`;
+  };
 
-  // Search filters cards by riot id or nick in json string
-  const {wrap:searchWrap, input} = makeSearch((q)=> {
+  // Search filters cards by riot id, nick or champion
+  const filterCards = (q)=> {
     const qq = (q||"").toLowerCase();
     const cards = [...mount.children];
     cards.forEach(card => {
-      const id = card.querySelector(".match-title")?.textContent?.toLowerCase() || "";
-      const text = card.textContent.toLowerCase();
-      card.style.display = (id.includes(qq) || text.includes(qq)) ? "" : "none";
+      const text = card.dataset.search || card.textContent.toLowerCase();
+      card.style.display = text.includes(qq) ? "" : "none";
+    });
+  };
+
+  // Pacotes: a busca também olha as páginas ainda não carregadas (os
+  // search-NNNN.json, baixados só na primeira busca) e carrega até a
+  // última página com resultado
+  let nextPage = 0;
+  let loading = Promise.resolve();
+  const more = document.createElement("button");
+
+  const loadPage = async ()=> {
+    const page = index.pages[nextPage++];
+    const bundle = await fetchJSON(new URL(page.file, URL_MATCHES_INDEX));
+    bundle.matches.forEach(m => mount.appendChild(createMatchCard(m)));
+    more.style.display = nextPage < index.pages.length ? "" : "none";
+  };
+
+  const loadPagesUpTo = (last)=> {
+    // uma carga por vez; uma falha anterior não trava as próximas
+    loading = loading.catch(()=> {}).then(async ()=> {
+      more.disabled = true;
+      try{
+        while (nextPage <= last && nextPage < index.pages.length) await loadPage();
+      }finally{
+        more.disabled = false;
+      }
     });
-  }, "Pesquisar match id ou jogador...");
+    return loading;
+  };
+
+  const searchTexts = new Map();
+  const pageSearch = (i)=> {
+    const page = index.pages[i];
+    // index.json antigo, sem o arquivo: null = carrega a página
+    if (!page.search_file) return Promise.resolve(page.search || null);
+    if (!searchTexts.has(i)){
+      const req = fetchJSON(new URL(page.search_file, URL_MATCHES_INDEX)).then(b => b.search);
+      // uma falha não fica no cache: a próxima busca tenta de novo
+      req.catch(()=> searchTexts.delete(i));
+      searchTexts.set(i, req);
+    }
+    return searchTexts.get(i);
+  };
+
+  const lastPageMatching = async (qq)=> {
+    const first = nextPage;
+    const texts = await Promise.all(index.pages.slice(first).map((_, k)=> pageSearch(first + k)));
+    for (let k = texts.length - 1; k >= 0; k--){
+      if (!texts[k] || texts[k].some(text => text.includes(qq))) return first + k;
+    }
+    return -1;
+  };
+
+  const applySearch = (q)=> {
+    filterCards(q);
+    const qq = (q||"").toLowerCase().trim();
+    if (!index || !qq) return;
+    lastPageMatching(qq).then(last => {
+      // a busca mudou enquanto os arquivos chegavam
+      if (qq !== input.value.toLowerCase().trim()) return;
+      if (last >= nextPage){
+        return loadPagesUpTo(last).then(()=> filterCards(input.value));
+      }
+    }).catch(showError);
+  };
+  const {wrap:searchWrap, input} = makeSearch(applySearch, "Pesquisar match id, jogador ou campeão...");
   controls.appendChild(searchWrap);
 
   const btn = document.createElement("button");
@@ -126,8 +215,25 @@ function createMatchCard(match){
 
   // Render
   mount.innerHTML = "";
-  const sorted = rows.slice().sort((a,b)=> Number(b.match_pk||0)-Number(a.match_pk||0));
-  sorted.forEach(m => mount.appendChild(createMatchCard(m)));
+
+  if (!index){
+    const sorted = csvRows.slice().sort((a,b)=> Number(b.match_pk||0)-Number(a.match_pk||0));
+    sorted.forEach(m => mount.appendChild(createMatchCard(m)));
+    return;
+  }
+
+  // Pacotes: uma página por vez, na ordem do export (mais recentes primeiro)
+  more.className = "btn";
+  more.textContent = "Carregar mais";
+  mount.after(more);
+
+  const loadNextPage = ()=> loadPagesUpTo(nextPage).then(()=> filterCards(input.value));
+
+  more.addEventListener("click", ()=> {
+    loadNextPage().catch(showError);
+  });
+
+  await loadNextPage();
 
 })().catch(err => {
   console.error(err);
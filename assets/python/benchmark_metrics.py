@@ -0,0 +1,610 @@
+"""
+Benchmark do pipeline de métricas (compute_metrics.py), sem MySQL.
+
+Gera partidas sintéticas (10 participantes, timeline no formato da Riot com
+30–40 frames e alguns milhares de eventos) e mede, separadamente:
+  - timeline_parse:    load_timeline_json (backend JSON configurado)
+  - timeline_walk:     features_from_timeline (passada pelos frames)
+  - scoring:           compute_metrics_for_match (com as features prontas)
+  - normalize_batch:   score_metrics_batch (min-max + final_score vetorizados)
+                       em lotes de METRICS_SCORING_BATCH_SIZE partidas
+  - insert:            MetricsWriter numa conexão em memória (montagem do SQL)
+  - ranking_aggregate: MetricsAggregator.add_all sobre as linhas exportadas
+  - export_*:          cada exporter, gravando num diretório temporário
+
+Uso:
+    python python/benchmark_metrics.py                      # 1k, 10k e 100k partidas
+    python python/benchmark_metrics.py --scales 1000,10000 --json bench.jsonl
+    python python/benchmark_metrics.py --scales 1000 --trace-memory
+
+A geração das partidas não entra nos tempos. Os timelines vêm de um pool
+de --timeline-pool partidas distintas (só o metadata muda por partida),
+para os 100k não precisarem de dezenas de GB em memória.
+"""
+
+import io
+import json
+import random
+import shutil
+import argparse
+import datetime
+import tempfile
+import resource
+import tracemalloc
+import contextlib
+
+from time import perf_counter
+from pathlib import Path
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+
+import pymysql
+
+import compute_metrics as cm
+
+
+# =========================
+# GERADOR SINTÉTICO
+# =========================
+
+POSITIONS = ["TOP", "JUNGLE", "MIDDLE", "BOTTOM", "UTILITY"]
+CHAMPIONS = [
+    "Ahri", "Garen", "Lux", "Jinx", "Thresh", "LeeSin", "Darius", "Yasuo",
+    "Ezreal", "Leona", "Viego", "Orianna", "Kaisa", "Nautilus", "Sett",
+]
+
+# tipos de evento com peso aproximado ao de um timeline real
+EVENT_TYPES = [
+    ("ITEM_PURCHASED", 30),
+    ("SKILL_LEVEL_UP", 18),
+    ("LEVEL_UP", 18),
+    ("WARD_PLACED", 12),
+    ("ITEM_DESTROYED", 8),
+    ("WARD_KILL", 4),
+    ("CHAMPION_KILL", 4),
+    ("ITEM_SOLD", 2),
+    ("ELITE_MONSTER_KILL", 2),
+    ("BUILDING_KILL", 2),
+]
+
+
+def _participant_frame(rng: random.Random, pid: int, minute: int, cc_ms: int) -> Dict[str, Any]:
+    gold = 500 + minute * rng.randint(250, 450)
+    return {
+        "championStats": {
+            "abilityHaste": 0, "abilityPower": rng.randint(0, 400), "armor": rng.randint(30, 200),
+            "armorPen": 0, "armorPenPercent": 0, "attackDamage": rng.randint(50, 300),
+            "attackSpeed": 100 + rng.randint(0, 150), "bonusArmorPenPercent": 0,
+            "bonusMagicPenPercent": 0, "ccReduction": 0, "cooldownReduction": 0,
+            "health": rng.randint(600, 3000), "healthMax": 3000, "healthRegen": 10,
+            "lifesteal": 0, "magicPen": 0, "magicPenPercent": 0, "magicResist": 40,
+            "movementSpeed": 345, "omnivamp": 0, "physicalVamp": 0, "power": 400,
+            "powerMax": 400, "powerRegen": 8, "spellVamp": 0,
+        },
+        "currentGold": rng.randint(0, 1500),
+        "damageStats": {
+            "magicDamageDone": minute * rng.randint(100, 900),
+            "magicDamageDoneToChampions": minute * rng.randint(0, 300),
+            "magicDamageTaken": minute * rng.randint(50, 400),
+            "physicalDamageDone": minute * rng.randint(100, 1200),
+            "physicalDamageDoneToChampions": minute * rng.randint(0, 300),
+            "physicalDamageTaken": minute * rng.randint(50, 400),
+            "totalDamageDone": minute * rng.randint(200, 2000),
+            "totalDamageDoneToChampions": minute * rng.randint(0, 600),
+            "totalDamageTaken": minute * rng.randint(100, 800),
+            "trueDamageDone": minute * rng.randint(0, 100),
+            "trueDamageDoneToChampions": minute * rng.randint(0, 50),
+            "trueDamageTaken": minute * rng.randint(0, 50),
+        },
+        "goldPerSecond": 20,
+        "jungleMinionsKilled": minute * rng.randint(0, 4),
+        "level": min(18, 1 + minute // 2),
+        "minionsKilled": minute * rng.randint(0, 9),
+        "participantId": pid,
+        "position": {"x": rng.randint(0, 15000), "y": rng.randint(0, 15000)},
+        "timeEnemySpentControlled": cc_ms,
+        "totalGold": gold,
+        "xp": minute * rng.randint(350, 600),
+    }
+
+
+def _event(rng: random.Random, etype: str, timestamp: int) -> Dict[str, Any]:
+    pid = rng.randint(1, 10)
+    event: Dict[str, Any] = {"timestamp": timestamp, "type": etype}
+    if etype in ("ITEM_PURCHASED", "ITEM_DESTROYED", "ITEM_SOLD"):
+        event.update(participantId=pid, itemId=rng.randint(1001, 7000))
+    elif etype == "SKILL_LEVEL_UP":
+        event.update(participantId=pid, skillSlot=rng.randint(1, 4), levelUpType="NORMAL")
+    elif etype == "LEVEL_UP":
+        event.update(participantId=pid, level=rng.randint(2, 18))
+    elif etype == "WARD_PLACED":
+        event.update(creatorId=pid, wardType=rng.choice(["YELLOW_TRINKET", "CONTROL_WARD", "SIGHT_WARD"]))
+    elif etype == "WARD_KILL":
+        event.update(killerId=pid, wardType=rng.choice(["YELLOW_TRINKET", "CONTROL_WARD"]))
+    elif etype == "CHAMPION_KILL":
+        victim = rng.choice([i for i in range(1, 11) if i != pid])
+        event.update(
+            killerId=pid,
+            victimId=victim,
+            assistingParticipantIds=rng.sample(range(1, 11), rng.randint(0, 3)),
+            bounty=300,
+            shutdownBounty=0,
+            killStreakLength=rng.randint(0, 4),
+            position={"x": rng.randint(0, 15000), "y": rng.randint(0, 15000)},
+            victimDamageReceived=[
+                {"basic": False, "magicDamage": rng.randint(0, 900), "name": rng.choice(CHAMPIONS),
+                 "participantId": rng.randint(1, 10), "physicalDamage": rng.randint(0, 900),
+                 "spellName": "q", "spellSlot": 0, "trueDamage": 0, "type": "OTHER"}
+                for _ in range(rng.randint(1, 5))
+            ],
+        )
+    elif etype == "ELITE_MONSTER_KILL":
+        event.update(killerId=pid, monsterType=rng.choice(["DRAGON", "RIFTHERALD", "BARON_NASHOR"]))
+    elif etype == "BUILDING_KILL":
+        event.update(killerId=pid, buildingType="TOWER_BUILDING", teamId=rng.choice([100, 200]))
+    return event
+
+
+def make_timeline_info(rng: random.Random, events_per_frame: Tuple[int, int]) -> Tuple[str, int]:
+    """
+    Parte "info" de um timeline (JSON já serializado) e a duração em segundos.
+    30–40 frames de 1 minuto, cada um com os 10 participantFrames e
+    events_per_frame eventos.
+    """
+    n_frames = rng.randint(30, 40)
+    names = [name for name, _ in EVENT_TYPES]
+    weights = [w for _, w in EVENT_TYPES]
+    cc_ms = [0] * 11
+
+    frames = []
+    for minute in range(n_frames):
+        timestamp = minute * 60000
+        participant_frames = {}
+        for pid in range(1, 11):
+            if rng.random() < 0.5:
+                cc_ms[pid] += rng.randint(0, 3000)
+            participant_frames[str(pid)] = _participant_frame(rng, pid, minute, cc_ms[pid])
+
+        n_events = rng.randint(*events_per_frame)
+        events = [
+            _event(rng, etype, timestamp + rng.randint(0, 59999))
+            for etype in rng.choices(names, weights, k=n_events)
+        ]
+        if minute == 0:
+            events.insert(0, {"realTimestamp": 0, "timestamp": 0, "type": "PAUSE_END"})
+        events.sort(key=lambda e: e["timestamp"])
+        frames.append({"events": events, "participantFrames": participant_frames, "timestamp": timestamp})
+
+    duration_sec = (n_frames - 1) * 60 + rng.randint(0, 59)
+    frames[-1]["events"].append({"gameId": 1, "timestamp": duration_sec * 1000, "type": "GAME_END", "winningTeam": 100})
+
+    info = {"endOfGameResult": "GameComplete", "frameInterval": 60000, "frames": frames, "gameId": 1}
+    return json.dumps(info, separators=(",", ":")), duration_sec
+
+
+class SyntheticMatches:
+    """
+    Partidas sintéticas determinísticas (seed): members puuids de um grupo,
+    1–5 membros por partida, e um pool de timelines reaproveitado.
+    """
+
+    def __init__(
+        self,
+        seed: int = 42,
+        n_members: int = 25,
+        timeline_pool: int = 32,
+        events_per_frame: Tuple[int, int] = (60, 140)
+    ):
+        self.seed = seed
+        rng = random.Random(seed)
+        self.members = {
+            f"member-{i:03d}-" + "x" * 60: {"nick": f"Capita{i}", "tag": rng.choice(["BR1", "GIGP", "0001"])}
+            for i in range(n_members)
+        }
+        self.member_puuids = set(self.members)
+        self.timelines = [make_timeline_info(rng, events_per_frame) for _ in range(max(1, timeline_pool))]
+        self.base_time = datetime.datetime(2025, 1, 1)
+
+    def match(self, match_pk: int) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        rng = random.Random(self.seed * 1_000_003 + match_pk)
+        info_json, duration_sec = self.timelines[match_pk % len(self.timelines)]
+
+        puuids = [f"p-{match_pk}-{i}-" + "y" * 60 for i in range(10)]
+        for slot, puuid in zip(rng.sample(range(10), rng.randint(1, 5)),
+                               rng.sample(sorted(self.members), 5)):
+            puuids[slot] = puuid
+
+        match_riot_id = f"BR1_{3000000000 + match_pk}"
+        metadata = {"dataVersion": "2", "matchId": match_riot_id, "participants": puuids}
+        timeline_json = '{"metadata":' + json.dumps(metadata) + ',"info":' + info_json + "}"
+
+        winner = rng.choice([100, 200])
+        participants = []
+        for i, puuid in enumerate(puuids):
+            team_id = 100 if i < 5 else 200
+            participants.append({
+                "id": match_pk * 10 + i,
+                "match_id": match_pk,
+                "participant_number": i + 1,
+                "puuid": puuid,
+                "team_id": team_id,
+                "team_position": POSITIONS[i % 5],
+                "champion_name": rng.choice(CHAMPIONS),
+                "win": team_id == winner,
+                "kills": rng.randint(0, 15),
+                "deaths": rng.randint(0, 12),
+                "assists": rng.randint(0, 25),
+                "total_damage_dealt_to_champions": rng.randint(3000, 55000),
+                "total_damage_taken": rng.randint(5000, 50000),
+                "gold_earned": rng.randint(6000, 20000),
+                "total_minions_killed": rng.randint(10, 320),
+                "neutral_minions_killed": rng.randint(0, 180),
+            })
+
+        match_row = {
+            "match_pk": match_pk,
+            "match_id_riot": match_riot_id,
+            "game_duration_sec": duration_sec,
+            "game_version": "14.3.1.2",
+            "timeline_json": timeline_json,
+            "timeline_features_json": None,
+            "created_at": self.base_time + datetime.timedelta(minutes=match_pk),
+            # epoch em ms, como matches.game_creation (partida jogada 30 min antes)
+            "game_creation": int((self.base_time + datetime.timedelta(minutes=match_pk - 30)).timestamp() * 1000),
+        }
+        return match_row, participants
+
+    def iter_matches(self, n: int) -> Iterator[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+        for match_pk in range(1, n + 1):
+            yield self.match(match_pk)
+
+
+# =========================
+# BANCO EM MEMÓRIA
+# =========================
+
+class InMemoryCursor:
+    def __init__(self, db: "InMemoryDB"):
+        self.db = db
+        self._rows: List[Dict[str, Any]] = []
+        self._pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def execute(self, sql, params=None):
+        if "GROUP BY m.id" in sql:
+            # ranking: rebuild (pmm.id <= max) ou delta (mark < pmm.id <= max)
+            lo, hi = (0, params[0]) if len(params) == 1 else params
+            self._rows = self.db.ranking_groups(lo, hi)
+            if "ORDER BY mean_final_score DESC" in sql:
+                self._rows.sort(key=lambda r: r["mean_final_score"], reverse=True)
+        elif "FROM player_match_metrics pmm" in sql:
+            self._rows = self.db.export_rows
+        elif "AS max_id FROM player_match_metrics" in sql:
+            self._rows = [{"max_id": max((r[0] for r in self.db.metrics.values()), default=0)}]
+        elif "FROM member_ranking_metrics" in sql:
+            self._rows = [dict(r) for r in self.db.ranking.values()]
+        elif "SELECT state_value FROM metrics_job_state" in sql:
+            value = self.db.job_state.get(params[0])
+            self._rows = [{"state_value": value}] if value is not None else []
+        elif "INSERT INTO metrics_job_state" in sql:
+            self.db.job_state[params[0]] = params[1]
+            self._rows = []
+        elif "DELETE FROM metrics_job_state" in sql:
+            self.db.job_state.pop(params[0], None)
+            self._rows = []
+        else:
+            self._rows = []
+        self._pos = 0
+
+    def executemany(self, sql, seq):
+        # custo do lado do cliente: escapar cada valor e montar o SQL, sem rede
+        for row in seq:
+            if isinstance(row, dict):
+                sql % {k: pymysql.converters.escape_item(v, "utf8mb4") for k, v in row.items()}
+            else:
+                sql % tuple(pymysql.converters.escape_item(v, "utf8mb4") for v in row)
+            if "INSERT INTO player_match_metrics" in sql:
+                self.db.inserted += 1
+                if self.db.keep_metrics:
+                    self.db.upsert_metrics(row)
+            elif "INSERT INTO member_ranking_metrics" in sql:
+                self.db.ranking[row["member_id"]] = dict(row)
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size):
+        rows = self._rows[self._pos:self._pos + size]
+        self._pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self._rows))
+
+
+class InMemoryDB:
+    """
+    Conexão falsa com o que o benchmark precisa: INSERT em
+    player_match_metrics (só conta) e o SELECT do export de métricas
+    (devolve export_rows, já no formato das linhas do MySQL).
+
+    Com keep_metrics=True (testes), guarda as linhas de player_match_metrics
+    ({(match_id, match_participant_id): (id, MetricsRow)}, id como o
+    AUTO_INCREMENT) e responde às consultas do ranking de membros
+    (rebuild, delta do incremental, member_ranking_metrics e
+    metrics_job_state), com members = {puuid: {nick, tag}}.
+    """
+
+    def __init__(self, members: Optional[Dict[str, Dict[str, Any]]] = None, keep_metrics: bool = False):
+        self.inserted = 0
+        self.export_rows: List[Dict[str, Any]] = []
+        self.keep_metrics = keep_metrics
+        self.members = {
+            puuid: dict(info, id=member_id)
+            for member_id, (puuid, info) in enumerate(sorted((members or {}).items()), start=1)
+        }
+        self.metrics: Dict[Tuple[int, int], Tuple[int, cm.MetricsRow]] = {}
+        self.ranking: Dict[int, Dict[str, Any]] = {}
+        self.job_state: Dict[str, int] = {}
+        self._next_id = 1
+
+    def cursor(self, cursor_class=None):
+        return InMemoryCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def upsert_metrics(self, row: cm.MetricsRow):
+        # ON DUPLICATE KEY UPDATE: a linha mantém o id
+        key = (row.match_id, row.match_participant_id)
+        current = self.metrics.get(key)
+        if current is None:
+            current = (self._next_id, row)
+            self._next_id += 1
+        self.metrics[key] = (current[0], row)
+
+    def ranking_groups(self, lo: int, hi: int) -> List[Dict[str, Any]]:
+        """GROUP BY por membro das linhas com lo < id <= hi (na ordem do id)."""
+        groups: Dict[int, Dict[str, Any]] = {}
+        for row_id, row in sorted(self.metrics.values(), key=lambda item: item[0]):
+            member = self.members.get(row.puuid)
+            if member is None or not lo < row_id <= hi:
+                continue
+            g = groups.setdefault(member["id"], {
+                "member_id": member["id"],
+                "puuid": row.puuid,
+                "nick": member.get("nick"),
+                "tag": member.get("tag"),
+                "matches_count": 0,
+                "sum_final_score": 0.0,
+            })
+            g["matches_count"] += 1
+            g["sum_final_score"] += row.final_score
+        for g in groups.values():
+            g["mean_final_score"] = g["sum_final_score"] / g["matches_count"]
+        return list(groups.values())
+
+    def add_export_rows(self, match_row, participants, metrics_rows, members):
+        by_mp = {p["id"]: p for p in participants}
+        for r in metrics_rows:
+            p = by_mp[r.match_participant_id]
+            member = members.get(r.puuid, {})
+            self.export_rows.append({
+                "metrics_id": len(self.export_rows) + 1,
+                "match_pk": match_row["match_pk"],
+                "match_riot_id": match_row["match_id_riot"],
+                "puuid": r.puuid,
+                "nick": member.get("nick"),
+                "tag": member.get("tag"),
+                "team_position": p["team_position"],
+                "win": b"\x01" if p["win"] else b"\x00",
+                "champion_name": p["champion_name"],
+                **{key: getattr(r, key) for key in cm.METRIC_KEYS},
+                "final_score": r.final_score,
+                "created_at": match_row["created_at"],
+                "game_version": match_row["game_version"],
+                "game_creation": match_row["game_creation"],
+            })
+
+    def finish(self):
+        # mesma ordem do SELECT do export (created_at DESC, match_id DESC)
+        self.export_rows.sort(key=lambda r: (r["created_at"], r["match_pk"]), reverse=True)
+
+
+# =========================
+# MEDIÇÃO
+# =========================
+
+class StageTimer:
+    """Acumula tempo (perf_counter) e itens por etapa; opcionalmente o pico do tracemalloc."""
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.seconds: Dict[str, float] = {}
+        self.items: Dict[str, int] = {}
+        self.peak_bytes: Dict[str, int] = {}
+
+    def add(self, stage: str, seconds: float, items: int = 1):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.items[stage] = self.items.get(stage, 0) + items
+
+    @contextlib.contextmanager
+    def stage(self, name: str, items: int = 1):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        t0 = perf_counter()
+        yield
+        self.add(name, perf_counter() - t0, items)
+        if self.trace_memory:
+            self.peak_bytes[name] = tracemalloc.get_traced_memory()[1]
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss em KB no Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_scale(gen: SyntheticMatches, n_matches: int, out_dir: Path, trace_memory: bool = False) -> Dict[str, Any]:
+    timer = StageTimer(trace_memory)
+    db = InMemoryDB()
+
+    if trace_memory:
+        tracemalloc.start()
+
+    # ---- parse + frame walk + scoring + insert, partida a partida ----
+    writer = cm.MetricsWriter(db)
+    raw_batch: List[List[Tuple[float, ...]]] = []
+    batch_size = max(1, cm.SCORING_BATCH_SIZE)
+    for match_row, participants in gen.iter_matches(n_matches):
+        t0 = perf_counter()
+        timeline = cm.load_timeline_json(match_row["timeline_json"])
+        t1 = perf_counter()
+        features = cm.features_from_timeline(timeline)
+        t2 = perf_counter()
+        metrics_rows = cm.compute_metrics_for_match(match_row, participants, gen.member_puuids, features)
+        t3 = perf_counter()
+        writer.add(metrics_rows)
+        t4 = perf_counter()
+
+        timer.add("timeline_parse", t1 - t0)
+        timer.add("timeline_walk", t2 - t1)
+        timer.add("scoring", t3 - t2)
+        timer.add("insert", t4 - t3, len(metrics_rows))
+
+        db.add_export_rows(match_row, participants, metrics_rows, gen.members)
+        del timeline
+
+        raw_batch.append([r.metrics() for r in cm.raw_metrics_for_match(match_row, participants, gen.member_puuids, features)])
+        if len(raw_batch) >= batch_size:
+            with timer.stage("normalize_batch", len(raw_batch)):
+                cm.score_metrics_batch(raw_batch)
+            raw_batch = []
+    if raw_batch:
+        with timer.stage("normalize_batch", len(raw_batch)):
+            cm.score_metrics_batch(raw_batch)
+
+    with timer.stage("insert", 0):  # flush final do writer
+        writer.close()
+
+    db.finish()
+    n_rows = len(db.export_rows)
+    if trace_memory:
+        timer.peak_bytes["scoring"] = tracemalloc.get_traced_memory()[1]
+
+    # ---- exports e agregação dos rankings ----
+    # positionDelta contra um snapshot vazio: não lê o data/ranking_snapshot.json real
+    cm._RANKING_SNAPSHOT = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        with timer.stage("export_metrics", n_rows):
+            agg = cm.export_metrics_to_csv(db, out_dir / "player_match_metrics_export.csv")
+
+        with timer.stage("ranking_aggregate", n_rows):
+            cm.MetricsAggregator().add_all(
+                cm.ExportRow.from_db(r) for r in db.export_rows
+            )
+
+        # os exports por partida agrupam as linhas em streaming (no pipeline,
+        # na mesma passada do export de métricas)
+        export_rows = [cm.ExportRow.from_db(r) for r in db.export_rows]
+
+        exporters = [
+            ("export_kda_mean", cm.export_ranking_kda_mean_to_csv, "ranking_kda_mean_export.csv"),
+            ("export_position_score", cm.export_ranking_position_score_to_csv, "ranking_position_score_export.csv"),
+            ("export_damage_mean", cm.export_ranking_damage_mean_to_csv, "ranking_damage_mean_export.csv"),
+            ("export_champion_winrate", cm.export_ranking_champion_winrate_to_csv, "ranking_champion_winrate_export.csv"),
+            ("export_champion_kda", cm.export_ranking_champion_kda_to_csv, "ranking_champion_kda_export.csv"),
+            ("export_ranking_windows", cm.export_ranking_windows_to_csv, "ranking_windows_export.csv"),
+        ]
+        for stage, exporter, name in exporters:
+            with timer.stage(stage, n_rows):
+                exporter(agg, out_dir / name)
+
+        with timer.stage("export_match_grouped", n_rows):
+            cm.export_match_individual_score_grouped_to_csv(export_rows, out_dir / "match_individual_score_grouped_export.csv")
+        with timer.stage("export_match_bundles", n_rows):
+            cm.export_match_bundles_to_json(export_rows, out_dir / "matches")
+
+    if trace_memory:
+        tracemalloc.stop()
+
+    return {
+        "matches": n_matches,
+        "rows": n_rows,
+        "inserted": db.inserted,
+        "json_backend": cm.TIMELINE_JSON_BACKEND,
+        "numpy": cm.np is not None,
+        "stages": {
+            stage: {
+                "seconds": round(timer.seconds[stage], 6),
+                "items": timer.items[stage],
+                "per_second": round(timer.items[stage] / timer.seconds[stage], 1) if timer.seconds[stage] else None,
+                **({"peak_mb": round(timer.peak_bytes[stage] / 2**20, 1)} if stage in timer.peak_bytes else {}),
+            }
+            for stage in timer.seconds
+        },
+        "max_rss_mb": round(max_rss_mb(), 1),
+    }
+
+
+def print_result(result: Dict[str, Any]):
+    print(f"\n== {result['matches']} partidas, {result['rows']} linhas de membros "
+          f"(JSON: {result['json_backend']}, numpy: {result['numpy']}) ==")
+    print(f"{'etapa':<26}{'segundos':>10}{'itens':>10}{'itens/s':>12}{'pico MB':>10}")
+    for stage, info in result["stages"].items():
+        per_second = f"{info['per_second']:.0f}" if info["per_second"] else "-"
+        peak = f"{info['peak_mb']:.1f}" if "peak_mb" in info else "-"
+        print(f"{stage:<26}{info['seconds']:>10.3f}{info['items']:>10}{per_second:>12}{peak:>10}")
+    print(f"RSS máximo do processo: {result['max_rss_mb']:.1f} MB")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark offline do pipeline de métricas (sem MySQL).")
+    parser.add_argument("--scales", default="1000,10000,100000", help="quantidades de partidas, separadas por vírgula")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timeline-pool", type=int, default=32, help="timelines distintos gerados e reaproveitados")
+    parser.add_argument("--events-per-frame", default="60,140", help="mín,máx de eventos por frame")
+    parser.add_argument("--trace-memory", action="store_true", help="pico do tracemalloc por etapa (deixa tudo mais lento)")
+    parser.add_argument("--json", type=Path, default=None, help="acrescenta os resultados (JSON lines) neste arquivo")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    scales = [int(s) for s in args.scales.split(",") if s.strip()]
+    lo, hi = (int(x) for x in args.events_per_frame.split(","))
+
+    t0 = perf_counter()
+    gen = SyntheticMatches(seed=args.seed, timeline_pool=args.timeline_pool, events_per_frame=(lo, hi))
+    sample_json = gen.match(1)[0]["timeline_json"]
+    sample = json.loads(sample_json)
+    n_events = sum(len(f["events"]) for f in sample["info"]["frames"])
+    print(f"Gerador pronto em {perf_counter() - t0:.1f}s: {len(gen.timelines)} timelines, "
+          f"ex.: {len(sample['info']['frames'])} frames, {n_events} eventos, "
+          f"{len(sample_json) / 1024:.0f} KB")
+
+    for n_matches in scales:
+        out_dir = Path(tempfile.mkdtemp(prefix="capita-bench-"))
+        try:
+            result = run_scale(gen, n_matches, out_dir, trace_memory=args.trace_memory)
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+            cm._EXPORTS_WRITTEN.clear()
+            cm._RANKING_POSITIONS.clear()
+            cm._RANKING_SNAPSHOT = None
+
+        print_result(result)
+        if args.json is not None:
+            with open(args.json, "a", encoding="utf-8") as f:
+                f.write(json.dumps(dict(result, seed=args.seed)) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,57 @@
 import os
+import csv
 import json
 import math
-
-from typing import List, Dict, Any
+import time
+import hashlib
+import shutil
+import heapq
+import argparse
+import bisect
+import datetime
+import queue
+import signal
+import multiprocessing
+import cProfile
+import pstats
+import threading
+import tracemalloc
+
+from collections import deque
+from itertools import islice
+from contextlib import nullcontext, contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Iterator, Optional, Tuple, TypedDict, NamedTuple
 from pathlib import Path
 
 import pymysql
 
+# parsers JSON opcionais (mais rápidos); sem eles, usa o json da stdlib
+try:
+    import msgspec
+except ImportError:  # pragma: no cover - dependência opcional
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dependência opcional
+    orjson = None
+
+# pyarrow opcional: exports colunares (Parquet) ao lado dos CSVs
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - dependência opcional
+    pa = None
+    pq = None
+
+# numpy opcional: motor vetorizado de normalização/final_score
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - dependência opcional
+    np = None
+
 # pasta do projeto = pai da pasta "python"
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -19,6 +64,28 @@ CSV_RANKING_DAMAGE_MEAN_EXPORT_PATH = BASE_DIR / "data" / "ranking_damage_mean_e
 CSV_RANKING_CHAMPION_WINRATE_EXPORT_PATH = BASE_DIR / "data" / "ranking_champion_winrate_export.csv"
 CSV_RANKING_CHAMPION_KDA_EXPORT_PATH = BASE_DIR / "data" / "ranking_champion_kda_export.csv"
 CSV_MATCH_INDIVIDUAL_SCORE_GROUPED_EXPORT_PATH = BASE_DIR / "data" / "match_individual_score_grouped_export.csv"
+CSV_RANKING_WINDOWS_EXPORT_PATH = BASE_DIR / "data" / "ranking_windows_export.csv"
+
+# rankings por janela: últimos N dias (até hoje), os N patches mais recentes e
+# o mínimo de partidas na janela para entrar no ranking
+RANKING_WINDOW_DAYS = [int(d) for d in os.getenv("RANKING_WINDOW_DAYS", "7,30").split(",") if d.strip()]
+RANKING_WINDOW_PATCHES = int(os.getenv("RANKING_WINDOW_PATCHES", "3"))
+RANKING_WINDOW_MIN_MATCHES = int(os.getenv("RANKING_WINDOW_MIN_MATCHES", "1"))
+
+# rankings: só os K primeiros de cada um (0 = todos) e as posições da
+# execução anterior, de onde sai a coluna positionDelta
+RANKING_TOP_K = int(os.getenv("RANKING_TOP_K", "0"))
+RANKING_SNAPSHOT_PATH = BASE_DIR / "data" / "ranking_snapshot.json"
+
+# manifesto dos exports (sha256, bytes e linhas de cada arquivo em data/)
+EXPORT_MANIFEST_PATH = BASE_DIR / "data" / "export_manifest.json"
+
+# pacotes JSON paginados da página de partidas (index.json + page-NNNN.json)
+JSON_MATCHES_EXPORT_DIR = BASE_DIR / "data" / "matches"
+MATCHES_BUNDLE_PAGE_SIZE = int(os.getenv("MATCHES_BUNDLE_PAGE_SIZE", "50"))
+# partidas por arquivo do CSV agrupado paginado (nome-0001.csv...), além do
+# arquivo único (fallback da página de partidas); 0 = só o arquivo único
+MATCHES_GROUPED_PAGE_SIZE = int(os.getenv("MATCHES_GROUPED_PAGE_SIZE", "0"))
 
 # =========================
 # CONFIG DO BANCO
@@ -33,6 +100,35 @@ DB_CONFIG = {
     "cursorclass": pymysql.cursors.DictCursor,
 }
 
+# quantos match_pk vão em cada "WHERE match_id IN (...)" ao buscar participantes
+PARTICIPANTS_CHUNK_SIZE = int(os.getenv("PARTICIPANTS_CHUNK_SIZE", "500"))
+
+# quantas partidas (com o timeline bruto) ficam em memória por vez
+MATCHES_BATCH_SIZE = int(os.getenv("MATCHES_BATCH_SIZE", "50"))
+
+# threads que leem os próximos lotes (timelines + participantes) enquanto o
+# lote atual é calculado, cada uma com a sua conexão; 0 = tudo na conexão principal
+DB_READERS = int(os.getenv("METRICS_DB_READERS", "1"))
+# lotes lidos à frente do cálculo (0 = 2 x leitores); cada um ocupa batch_size timelines
+DB_PREFETCH_BATCHES = int(os.getenv("METRICS_DB_PREFETCH", "0"))
+
+# partidas normalizadas de uma vez pelo motor vetorizado (score_match_batch);
+# com --workers, cada tarefa do pool leva até N partidas (limitado por --max-in-flight)
+SCORING_BATCH_SIZE = int(os.getenv("METRICS_SCORING_BATCH_SIZE", "64"))
+# como o pool do --workers cria os processos: forkserver (ou spawn) e não
+# fork, porque o pool pode nascer com as threads leitoras já rodando
+SCORING_START_METHOD = os.getenv(
+    "METRICS_SCORING_START_METHOD",
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn",
+)
+
+# backend do parse do timeline: auto | msgspec | orjson | json
+TIMELINE_JSON_BACKEND = os.getenv("TIMELINE_JSON_BACKEND", "auto")
+
+# versão de extract_timeline_features; mude sempre que o formato ou o
+# cálculo das features mudar, para invalidar o cache match_timeline_features
+TIMELINE_FEATURES_VERSION = 1
+
 # =========================
 # PESOS DAS MÉTRICAS
 # =========================
@@ -50,6 +146,188 @@ WEIGHTS = {
     "cc_per_min":        0.15,
 }
 
+# ordem das métricas nos vetores/arrays (mesma ordem da soma do final_score)
+METRIC_KEYS = list(WEIGHTS.keys())
+
+# métricas em que menor é melhor (normalização invertida)
+INVERTED_METRICS = {"deaths_per_min"}
+
+# identificador dos pesos atuais, gravado em player_match_metrics.weights_version;
+# muda sozinho quando WEIGHTS muda, e o --rescore recalcula o que estiver em outra versão
+WEIGHTS_VERSION = hashlib.sha1(
+    json.dumps(WEIGHTS, sort_keys=True).encode("utf-8")
+).hexdigest()[:12]
+
+# normalização dos score_*: "match" = min-max entre os participantes da partida;
+# "role" = contra os baselines (média/desvio) da rota em metric_role_baselines
+SCORING_MODE = os.getenv("METRICS_SCORING_MODE", "match")
+# rebuild dos baselines também por patch (game_version "14.3.x" -> "14.3")
+ROLE_BASELINE_BY_PATCH = os.getenv("ROLE_BASELINE_BY_PATCH", "0") == "1"
+# amostras mínimas para um baseline ser usado (senão cai para o mais geral)
+ROLE_BASELINE_MIN_SAMPLES = int(os.getenv("ROLE_BASELINE_MIN_SAMPLES", "30"))
+
+# buffer do MetricsWriter: flush ao passar de N linhas ou de N segundos
+METRICS_WRITER_MAX_ROWS = int(os.getenv("METRICS_WRITER_MAX_ROWS", "2000"))
+METRICS_WRITER_MAX_SECONDS = float(os.getenv("METRICS_WRITER_MAX_SECONDS", "5"))
+
+# grava também um .parquet (colunar, tipado, comprimido) ao lado de cada CSV
+EXPORT_PARQUET = os.getenv("EXPORT_PARQUET", "0") == "1"
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd")
+
+# linhas lidas por vez do cursor do servidor no export de métricas
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "5000"))
+
+# linhas de player_match_metrics por UPDATE no --rescore
+RESCORE_CHUNK_SIZE = int(os.getenv("RESCORE_CHUNK_SIZE", "2000"))
+
+# 0 = só resumos; 1 (-v) = uma linha por partida
+VERBOSITY = int(os.getenv("METRICS_VERBOSITY", "0"))
+
+# destino das estatísticas da execução (JSON lines); vazio = stdout
+METRICS_STATS_PATH = os.getenv("METRICS_STATS_PATH", "")
+
+# a busca por partidas pendentes começa em (high-water mark - N) ids, para
+# pegar partidas com id menor que só ficaram visíveis depois (commit tardio).
+# Limite: uma partida que aparece mais de N ids abaixo do high-water mark não
+# é mais encontrada (rode uma vez com --hwm-lookback maior para recuperar)
+HWM_LOOKBACK = int(os.getenv("METRICS_HWM_LOOKBACK", "500"))
+
+# --watch: intervalo entre consultas por partidas novas e partidas por micro-lote
+WATCH_POLL_SECONDS = float(os.getenv("WATCH_POLL_SECONDS", "5"))
+WATCH_BATCH_SIZE = int(os.getenv("WATCH_BATCH_SIZE", "20"))
+# --watch: ranking/exports só depois de N segundos sem partidas novas,
+# mas no máximo N segundos depois da primeira partida pendente
+WATCH_DEBOUNCE_SECONDS = float(os.getenv("WATCH_DEBOUNCE_SECONDS", "10"))
+WATCH_MAX_DELAY_SECONDS = float(os.getenv("WATCH_MAX_DELAY_SECONDS", "60"))
+
+
+# =========================
+# INSTRUMENTAÇÃO (tempo por etapa)
+# =========================
+
+class RunStats:
+    """
+    Tempo acumulado por etapa (fetch, json_parse, frame_walk, scoring,
+    insert, ranking_update, export_*) e contadores (matches, rows_written...).
+
+    emit() grava um snapshot como uma linha JSON em path (append) ou, sem
+    path, no stdout. Com every > 0, match_done() emite um "progress" a cada
+    every partidas; o main emite o "run_summary" no fim.
+    """
+
+    def __init__(self, path: Optional[Path] = None, every: int = 0):
+        self.path = path
+        self.every = max(0, every)
+        self.started = time.perf_counter()
+        self.seconds: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {}
+        # as threads leitoras (iter_prefetched_batches) também somam tempo aqui
+        self._lock = threading.Lock()
+
+    def add_time(self, stage: str, seconds: float):
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def add_timings(self, timings: Dict[str, float]):
+        for stage, seconds in timings.items():
+            self.add_time(stage, seconds)
+
+    def incr(self, counter: str, n: int = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t0)
+
+    def match_done(self):
+        self.incr("matches")
+        if self.every and self.counters["matches"] % self.every == 0:
+            self.emit("progress")
+
+    def snapshot(self, event: str) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self.started
+        return {
+            "event": event,
+            "ts": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "elapsed_s": round(elapsed, 3),
+            "stages_s": {k: round(v, 3) for k, v in self.seconds.items()},
+            "counters": dict(self.counters),
+            "matches_per_s": round(self.counters.get("matches", 0) / elapsed, 2) if elapsed else None,
+            "rows_per_s": round(self.counters.get("rows_written", 0) / elapsed, 2) if elapsed else None,
+        }
+
+    def emit(self, event: str, **extra):
+        line = json.dumps(dict(self.snapshot(event), **extra), ensure_ascii=False)
+        if self.path is None:
+            print(line)
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+class MemoryTracer:
+    """
+    --trace-memory: liga o tracemalloc e, a cada checkpoint(label), emite
+    (via RunStats) a memória atual, o pico desde o checkpoint anterior e os
+    top_n locais que mais alocaram, além dos que mais cresceram desde o
+    checkpoint anterior. Só enxerga o processo principal (não os workers).
+    """
+
+    def __init__(self, stats: RunStats, top_n: int = 10, frames: int = 1):
+        self.stats = stats
+        self.top_n = top_n
+        self._previous = None
+        tracemalloc.start(frames)
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+
+    @staticmethod
+    def _site(stat) -> Dict[str, Any]:
+        frame = stat.traceback[0]
+        return {
+            "site": f"{frame.filename}:{frame.lineno}",
+            "size_kb": round(stat.size / 1024, 1),
+            "count": stat.count,
+        }
+
+    def checkpoint(self, label: str):
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = self._snapshot()
+
+        top = [self._site(st) for st in snapshot.statistics("lineno")[:self.top_n]]
+        growth = []
+        if self._previous is not None:
+            for st in snapshot.compare_to(self._previous, "lineno")[:self.top_n]:
+                site = self._site(st)
+                site["diff_kb"] = round(st.size_diff / 1024, 1)
+                growth.append(site)
+
+        self.stats.emit(
+            "memory",
+            checkpoint=label,
+            current_mb=round(current / 2**20, 1),
+            peak_mb=round(peak / 2**20, 1),
+            top=top,
+            growth=growth,
+        )
+        self._previous = snapshot
+        tracemalloc.reset_peak()
+
+    def stop(self):
+        self._previous = None
+        tracemalloc.stop()
+
 
 # =========================
 # FUNÇÕES AUXILIARES
@@ -76,6 +354,17 @@ def normalize_metric(values: List[float], invert: bool = False) -> List[float]:
     return scores
 
 
+def weighted_final_score(scores: List[float]) -> float:
+    """
+    final_score de um participante a partir dos scores 0–100 na ordem de
+    METRIC_KEYS (mesma ordem de soma de compute_metrics_for_match).
+    """
+    final = WEIGHTS[METRIC_KEYS[0]] * scores[0]
+    for k, key in enumerate(METRIC_KEYS[1:], start=1):
+        final = final + WEIGHTS[key] * scores[k]
+    return final
+
+
 def win_to_int(raw_win) -> int:
     if raw_win is None:
         return 0
@@ -92,6 +381,168 @@ def win_to_int(raw_win) -> int:
     return 0
 
 
+def _int_or_none(v) -> Optional[int]:
+    return int(v) if v not in (None, "") else None
+
+
+def _float_or_none(v) -> Optional[float]:
+    return float(v) if v not in (None, "") else None
+
+
+def game_day(game_creation: Optional[int], created_at: str = "") -> str:
+    """
+    Dia da partida ("AAAA-MM-DD", UTC) a partir de matches.game_creation
+    (epoch em ms da Riot). Sem ele (exports antigos), cai para o dia de
+    created_at; vazio se não tiver nenhum dos dois.
+    """
+    if game_creation:
+        return datetime.datetime.fromtimestamp(game_creation / 1000, tz=datetime.timezone.utc).date().isoformat()
+    return (created_at or "")[:10]
+
+
+# =========================
+# REGISTROS (linhas compactas)
+# =========================
+# Tuplas nomeadas em vez de dicts: sem um dict (chaves + hash table) por
+# linha, cada registro ocupa uma fração da memória, e o pickle para os
+# workers fica menor. Os dicts só aparecem nas bordas (cursor do banco,
+# DictReader/Parquet do --from-export, JSON dos pacotes).
+
+class RawMetricsRow(NamedTuple):
+    """Métricas brutas de um participante (todos da partida, para a normalização)."""
+    match_participant_id: int
+    puuid: str
+    team_id: int
+    champion_name: str
+    team_position: str
+    is_member: bool
+    kda: float
+    dmg_per_min: float
+    gold_per_min: float
+    cs_per_min: float
+    kp: float
+    dmg_taken_per_min: float
+    deaths_per_min: float
+    xp_per_min: float
+    vision_per_min: float
+    cc_per_min: float
+
+    def metrics(self) -> Tuple[float, ...]:
+        """As métricas na ordem de METRIC_KEYS."""
+        return self[6:]
+
+
+class MetricsRow(NamedTuple):
+    """Uma linha de player_match_metrics, na ordem das colunas de INSERT_METRICS_SQL."""
+    match_id: int
+    match_participant_id: int
+    puuid: str
+    team_id: int
+    champion_name: str
+    kda: float
+    dmg_per_min: float
+    gold_per_min: float
+    cs_per_min: float
+    kp: float
+    dmg_taken_per_min: float
+    deaths_per_min: float
+    xp_per_min: float
+    vision_per_min: float
+    cc_per_min: float
+    score_kda: float
+    score_dmg_per_min: float
+    score_gold_per_min: float
+    score_cs_per_min: float
+    score_kp: float
+    score_dmg_taken_per_min: float
+    score_deaths_per_min: float
+    score_xp_per_min: float
+    score_vision_per_min: float
+    score_cc_per_min: float
+    final_score: float
+    weights_version: str
+
+
+class ExportRow(NamedTuple):
+    """Uma linha do export de métricas (colunas do CSV, na ordem)."""
+    metrics_id: int
+    match_pk: int
+    match_riot_id: str
+    puuid: str
+    nick: str
+    tag: str
+    team_position: str
+    win: int
+    champion_name: str
+    kda: float
+    dmg_per_min: float
+    gold_per_min: float
+    cs_per_min: float
+    kp: float
+    dmg_taken_per_min: float
+    deaths_per_min: float
+    xp_per_min: float
+    vision_per_min: float
+    cc_per_min: float
+    final_score: float
+    created_at: str
+    patch: str
+    game_creation: Optional[int]
+
+    @classmethod
+    def from_db(cls, r: Dict[str, Any]) -> "ExportRow":
+        """Linha do SELECT de export_metrics_to_csv (win=0/1, created_at em ISO, patch do game_version)."""
+        return cls(
+            r["metrics_id"],
+            r["match_pk"],
+            r["match_riot_id"],
+            r["puuid"],
+            r["nick"] or "",
+            r["tag"] or "",
+            r["team_position"] or "",
+            win_to_int(r["win"]),
+            r["champion_name"],
+            *(r[key] for key in METRIC_KEYS),
+            r["final_score"],
+            r["created_at"].isoformat() if r["created_at"] else "",
+            patch_from_version(r["game_version"]),
+            r["game_creation"],
+        )
+
+    @classmethod
+    def from_export(cls, r: Dict[str, Any]) -> "ExportRow":
+        """Linha relida de um export (DictReader do CSV ou Parquet), com os tipos de volta."""
+        return cls(
+            _int_or_none(r["metrics_id"]),
+            _int_or_none(r["match_pk"]),
+            r["match_riot_id"],
+            r["puuid"],
+            r["nick"] or "",
+            r["tag"] or "",
+            r["team_position"] or "",
+            win_to_int(r["win"]),
+            r["champion_name"],
+            *(_float_or_none(r[key]) for key in METRIC_KEYS),
+            _float_or_none(r["final_score"]),
+            r["created_at"] or "",
+            r.get("patch") or "",  # exports antigos não têm a coluna
+            _int_or_none(r.get("game_creation")),
+        )
+
+
+class MatchPlayer(NamedTuple):
+    """Um jogador dentro de uma partida agrupada (players_scores do export agrupado)."""
+    team_position: str
+    nick: str
+    tag: str
+    puuid: str
+    win: int
+    champion_name: str
+    kda: float
+    dmg_per_min: float
+    final_score: float
+
+
 # =========================
 # ACESSO AO BANCO
 # =========================
@@ -100,6 +551,68 @@ def get_connection():
     return pymysql.connect(**DB_CONFIG)
 
 
+class ConnectionPool:
+    """
+    Pool pequeno de conexões (thread-safe) para o job: a thread principal
+    fica com uma conexão para escrever (MetricsWriter, features, ranking) e
+    as threads leitoras pegam as outras, então leitura de timelines e
+    gravação não disputam o mesmo socket.
+
+    As conexões são abertas sob demanda até size; acquire() bloqueia quando
+    todas estão em uso. Uma conexão que volta do pool passa por ping
+    (reconnect) antes de ser entregue de novo; o que não foi commitado
+    antes do release() é descartado.
+    """
+
+    def __init__(self, size: int, factory=None):
+        self.size = max(1, size)
+        self.factory = factory
+        self._idle: "queue.LifoQueue" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._all: List[Any] = []
+
+    def acquire(self, timeout: Optional[float] = None):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = len(self._all) < self.size
+                if can_open:
+                    conn = (self.factory or get_connection)()
+                    self._all.append(conn)
+            if can_open:
+                return conn
+            conn = self._idle.get(timeout=timeout)
+        conn.ping(reconnect=True)
+        return conn
+
+    def release(self, conn):
+        # como o reset-on-return de outros pools: encerra a transação aberta
+        # (inclusive o snapshot de leitura do REPEATABLE READ) antes de devolver
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        with self._lock:
+            conns, self._all = self._all, []
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
 def fetch_members(conn):
     """
     Busca todos os membros ativos da tabela members.
@@ -129,194 +642,675 @@ def fetch_members(conn):
     return members_by_puuid, puuid_set
 
 
-def fetch_matches_to_process(conn) -> List[Dict[str, Any]]:
+def iter_matches_to_process(
+    conn,
+    batch_size: int = MATCHES_BATCH_SIZE,
+    start_after: int = 0
+) -> Iterator[List[Dict[str, Any]]]:
     """
-    Busca partidas que ainda não foram processadas em player_match_metrics.
-    Critério: não existe nenhuma linha em player_match_metrics com aquele match_id.
+    Busca as partidas ainda não processadas (fora de match_metrics_processed,
+    marcada ao gravar as métricas, inclusive quando não tem nenhum membro)
+    em lotes de até batch_size, paginando por matches.id (keyset),
+    para que só um lote de timelines fique em memória por vez.
+
+    Como cada página começa depois do último m.id já lido, dá para inserir
+    em player_match_metrics (na mesma conexão) entre um lote e outro.
+    start_after: só partidas com matches.id acima dele (pending_scan_start:
+    o high-water mark menos HWM_LOOKBACK), então a query só olha as
+    partidas novas em vez da tabela inteira.
+
+    Partidas que já estão no cache match_timeline_features (na versão atual
+    do extrator) vêm com timeline_features_json preenchido e sem o
+    timeline bruto.
     """
     sql = """
         SELECT m.id AS match_pk,
                m.match_id AS match_id_riot,
                m.game_duration AS game_duration_sec,
-               t.raw_json AS timeline_json
+               m.game_version AS game_version,
+               CASE WHEN f.match_id IS NULL THEN t.raw_json END AS timeline_json,
+               f.features_json AS timeline_features_json
         FROM matches m
         JOIN match_timelines t ON t.match_id = m.match_id
-        LEFT JOIN player_match_metrics pmm ON pmm.match_id = m.id
-        WHERE pmm.id IS NULL;
+        LEFT JOIN match_timeline_features f
+          ON f.match_id = m.id AND f.extractor_version = %s
+         AND f.match_riot_id = m.match_id
+        LEFT JOIN match_metrics_processed p ON p.match_id = m.id
+        WHERE p.match_id IS NULL
+          AND m.id > %s
+        ORDER BY m.id ASC
+        LIMIT %s;
     """
-    with conn.cursor() as cur:
-        cur.execute(sql)
-        rows = cur.fetchall()
-    return rows
+    batch_size = max(1, batch_size)
+    last_pk = start_after
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(sql, (TIMELINE_FEATURES_VERSION, last_pk, batch_size))
+            rows = cur.fetchall()
+        if not rows:
+            return
+
+        last_pk = rows[-1]["match_pk"]
+        yield rows
+
+        if len(rows) < batch_size:
+            return
+
+
+def iter_pending_match_pks(
+    conn,
+    batch_size: int = MATCHES_BATCH_SIZE,
+    start_after: int = 0
+) -> Iterator[List[int]]:
+    """
+    Mesma paginação de iter_matches_to_process, mas só com os matches.id
+    (sem timeline): query barata, que define os lotes para as threads
+    leitoras buscarem com fetch_matches_by_pk.
+    """
+    sql = """
+        SELECT m.id AS match_pk
+        FROM matches m
+        JOIN match_timelines t ON t.match_id = m.match_id
+        LEFT JOIN match_metrics_processed p ON p.match_id = m.id
+        WHERE p.match_id IS NULL
+          AND m.id > %s
+        ORDER BY m.id ASC
+        LIMIT %s;
+    """
+    batch_size = max(1, batch_size)
+    last_pk = start_after
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(sql, (last_pk, batch_size))
+            pks = [r["match_pk"] for r in cur.fetchall()]
+        if not pks:
+            return
 
+        last_pk = pks[-1]
+        yield pks
 
-def fetch_participants_for_match(conn, match_pk: int) -> List[Dict[str, Any]]:
+        if len(pks) < batch_size:
+            return
+
+
+def fetch_matches_by_pk(conn, match_pks: List[int]) -> List[Dict[str, Any]]:
     """
-    Busca todos os participantes de uma partida (match_participants).
+    Busca as partidas de um lote (timeline ou features em cache), no
+    formato de iter_matches_to_process, ordenadas por matches.id.
     """
-    sql = """
-        SELECT *
-        FROM match_participants
-        WHERE match_id = %s
-        ORDER BY participant_number ASC
+    if not match_pks:
+        return []
+    placeholders = ", ".join(["%s"] * len(match_pks))
+    sql = f"""
+        SELECT m.id AS match_pk,
+               m.match_id AS match_id_riot,
+               m.game_duration AS game_duration_sec,
+               m.game_version AS game_version,
+               CASE WHEN f.match_id IS NULL THEN t.raw_json END AS timeline_json,
+               f.features_json AS timeline_features_json
+        FROM matches m
+        JOIN match_timelines t ON t.match_id = m.match_id
+        LEFT JOIN match_timeline_features f
+          ON f.match_id = m.id AND f.extractor_version = %s
+         AND f.match_riot_id = m.match_id
+        WHERE m.id IN ({placeholders})
+        ORDER BY m.id ASC;
     """
     with conn.cursor() as cur:
-        cur.execute(sql, (match_pk,))
-        rows = cur.fetchall()
-    return rows
+        cur.execute(sql, [TIMELINE_FEATURES_VERSION, *match_pks])
+        return list(cur.fetchall())
 
 
-def insert_metrics(conn, metrics_rows: List[Dict[str, Any]]):
+def fetch_participants_for_matches(
+    conn,
+    match_pks: List[int],
+    chunk_size: int = PARTICIPANTS_CHUNK_SIZE
+) -> Dict[int, List[Dict[str, Any]]]:
     """
-    Insere os dados calculados em player_match_metrics.
-    Usa INSERT ... ON DUPLICATE KEY UPDATE.
+    Busca os participantes de várias partidas de uma vez, em blocos de
+    chunk_size match_pk por query (WHERE match_id IN (...)).
+    Retorna {match_pk: [participantes (SELECT *) ordenados por participant_number]}.
+    Partidas sem participantes voltam com lista vazia.
     """
-    if not metrics_rows:
-        return
+    participants_by_match: Dict[int, List[Dict[str, Any]]] = {pk: [] for pk in match_pks}
+    if not match_pks:
+        return participants_by_match
 
-    sql = """
-        INSERT INTO player_match_metrics (
-            match_id,
-            match_participant_id,
-            puuid,
-            team_id,
-            champion_name,
-            kda,
-            dmg_per_min,
-            gold_per_min,
-            cs_per_min,
-            kp,
-            dmg_taken_per_min,
-            deaths_per_min,
-            xp_per_min,
-            vision_per_min,
-            cc_per_min,
-            score_kda,
-            score_dmg_per_min,
-            score_gold_per_min,
-            score_cs_per_min,
-            score_kp,
-            score_dmg_taken_per_min,
-            score_deaths_per_min,
-            score_xp_per_min,
-            score_vision_per_min,
-            score_cc_per_min,
-            final_score
+    chunk_size = max(1, chunk_size)
+    pks = list(participants_by_match.keys())
+
+    with conn.cursor() as cur:
+        for start in range(0, len(pks), chunk_size):
+            chunk = pks[start:start + chunk_size]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            sql = f"""
+                SELECT *
+                FROM match_participants
+                WHERE match_id IN ({placeholders})
+                ORDER BY match_id ASC, participant_number ASC
+            """
+            cur.execute(sql, chunk)
+            for r in cur.fetchall():
+                participants_by_match[r["match_id"]].append(r)
+
+    return participants_by_match
+
+
+def iter_loaded_batches(
+    conn,
+    batches: Iterator[List[Dict[str, Any]]],
+    stats: Optional[RunStats] = None
+) -> Iterator[Tuple[List[Dict[str, Any]], Dict[int, List[Dict[str, Any]]]]]:
+    """
+    Para cada lote de partidas, busca os participantes na mesma conexão e
+    devolve (lote, {match_pk: participantes}). Sem threads: a leitura do
+    próximo lote só começa depois do cálculo do atual.
+    Com stats, soma o tempo das queries em "fetch".
+    """
+    while True:
+        t0 = time.perf_counter()
+        batch = next(batches, None)
+        if batch is None:
+            return
+        participants_by_match = fetch_participants_for_matches(
+            conn, [m["match_pk"] for m in batch]
         )
-        VALUES (
-            %(match_id)s,
-            %(match_participant_id)s,
-            %(puuid)s,
-            %(team_id)s,
-            %(champion_name)s,
-            %(kda)s,
-            %(dmg_per_min)s,
-            %(gold_per_min)s,
-            %(cs_per_min)s,
-            %(kp)s,
-            %(dmg_taken_per_min)s,
-            %(deaths_per_min)s,
-            %(xp_per_min)s,
-            %(vision_per_min)s,
-            %(cc_per_min)s,
-            %(score_kda)s,
-            %(score_dmg_per_min)s,
-            %(score_gold_per_min)s,
-            %(score_cs_per_min)s,
-            %(score_kp)s,
-            %(score_dmg_taken_per_min)s,
-            %(score_deaths_per_min)s,
-            %(score_xp_per_min)s,
-            %(score_vision_per_min)s,
-            %(score_cc_per_min)s,
-            %(final_score)s
+        if stats is not None:
+            stats.add_time("fetch", time.perf_counter() - t0)
+        yield batch, participants_by_match
+
+
+def iter_prefetched_batches(
+    pool: ConnectionPool,
+    batch_size: int = MATCHES_BATCH_SIZE,
+    start_after: int = 0,
+    readers: int = DB_READERS,
+    prefetch: int = DB_PREFETCH_BATCHES,
+    stats: Optional[RunStats] = None
+) -> Iterator[Tuple[List[Dict[str, Any]], Dict[int, List[Dict[str, Any]]]]]:
+    """
+    Igual a iter_loaded_batches, mas lendo à frente do cálculo:
+    iter_pending_match_pks pagina só os ids (numa conexão do pool) e
+    `readers` threads buscam timelines e participantes de cada lote, cada
+    uma na sua conexão, enquanto o lote atual é calculado.
+
+    Até `prefetch` lotes ficam lidos à frente (padrão: 2 x readers), então
+    a memória continua limitada a (prefetch + 1) x batch_size timelines.
+    Os lotes saem na ordem de matches.id, como em iter_matches_to_process.
+    Com stats, "fetch" soma o tempo das threads leitoras e "fetch_wait" o
+    tempo que o cálculo ficou parado esperando um lote.
+    """
+    readers = max(1, readers)
+    prefetch = max(1, prefetch or 2 * readers)
+
+    def load(match_pks: List[int]):
+        t0 = time.perf_counter()
+        with pool.connection() as conn:
+            batch = fetch_matches_by_pk(conn, match_pks)
+            participants_by_match = fetch_participants_for_matches(conn, match_pks)
+        if stats is not None:
+            stats.add_time("fetch", time.perf_counter() - t0)
+        return batch, participants_by_match
+
+    with pool.connection() as pager_conn, ThreadPoolExecutor(
+        max_workers=readers, thread_name_prefix="metrics-reader"
+    ) as executor:
+        pages = iter_pending_match_pks(pager_conn, batch_size, start_after)
+        pending = deque()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < prefetch:
+                    match_pks = next(pages, None)
+                    if match_pks is None:
+                        exhausted = True
+                        break
+                    pending.append(executor.submit(load, match_pks))
+                if not pending:
+                    return
+
+                t0 = time.perf_counter()
+                loaded = pending.popleft().result()
+                if stats is not None:
+                    stats.add_time("fetch_wait", time.perf_counter() - t0)
+                yield loaded
+        finally:
+            # saída antecipada (erro no cálculo): não lê os lotes que faltam
+            for future in pending:
+                future.cancel()
+
+
+INSERT_PROCESSED_SQL = """
+    INSERT INTO match_metrics_processed (match_id, rows_count)
+    VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE rows_count = VALUES(rows_count)
+"""
+
+# colunas na ordem de MetricsRow (o executemany recebe as tuplas direto)
+INSERT_METRICS_SQL = """
+    INSERT INTO player_match_metrics (
+        match_id,
+        match_participant_id,
+        puuid,
+        team_id,
+        champion_name,
+        kda,
+        dmg_per_min,
+        gold_per_min,
+        cs_per_min,
+        kp,
+        dmg_taken_per_min,
+        deaths_per_min,
+        xp_per_min,
+        vision_per_min,
+        cc_per_min,
+        score_kda,
+        score_dmg_per_min,
+        score_gold_per_min,
+        score_cs_per_min,
+        score_kp,
+        score_dmg_taken_per_min,
+        score_deaths_per_min,
+        score_xp_per_min,
+        score_vision_per_min,
+        score_cc_per_min,
+        final_score,
+        weights_version
+    )
+    VALUES (
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s,
+        %s
+    )
+    ON DUPLICATE KEY UPDATE
+        kda = VALUES(kda),
+        dmg_per_min = VALUES(dmg_per_min),
+        gold_per_min = VALUES(gold_per_min),
+        cs_per_min = VALUES(cs_per_min),
+        kp = VALUES(kp),
+        dmg_taken_per_min = VALUES(dmg_taken_per_min),
+        deaths_per_min = VALUES(deaths_per_min),
+        xp_per_min = VALUES(xp_per_min),
+        vision_per_min = VALUES(vision_per_min),
+        cc_per_min = VALUES(cc_per_min),
+        score_kda = VALUES(score_kda),
+        score_dmg_per_min = VALUES(score_dmg_per_min),
+        score_gold_per_min = VALUES(score_gold_per_min),
+        score_cs_per_min = VALUES(score_cs_per_min),
+        score_kp = VALUES(score_kp),
+        score_dmg_taken_per_min = VALUES(score_dmg_taken_per_min),
+        score_deaths_per_min = VALUES(score_deaths_per_min),
+        score_xp_per_min = VALUES(score_xp_per_min),
+        score_vision_per_min = VALUES(score_vision_per_min),
+        score_cc_per_min = VALUES(score_cc_per_min),
+        final_score = VALUES(final_score),
+        weights_version = VALUES(weights_version);
+"""
+
+
+class MetricsFlushError(Exception):
+    """
+    Falha ao gravar um flush do MetricsWriter. match_ids são as partidas
+    (matches.id) do flush que sofreu rollback, ou seja, que NÃO foram gravadas.
+    """
+
+    def __init__(self, match_ids: List[int], cause: Exception):
+        self.match_ids = match_ids
+        self.cause = cause
+        super().__init__(
+            f"falha ao gravar {len(match_ids)} partidas em player_match_metrics "
+            f"(match_ids={match_ids}): {cause}"
         )
-        ON DUPLICATE KEY UPDATE
-            kda = VALUES(kda),
-            dmg_per_min = VALUES(dmg_per_min),
-            gold_per_min = VALUES(gold_per_min),
-            cs_per_min = VALUES(cs_per_min),
-            kp = VALUES(kp),
-            dmg_taken_per_min = VALUES(dmg_taken_per_min),
-            deaths_per_min = VALUES(deaths_per_min),
-            xp_per_min = VALUES(xp_per_min),
-            vision_per_min = VALUES(vision_per_min),
-            cc_per_min = VALUES(cc_per_min),
-            score_kda = VALUES(score_kda),
-            score_dmg_per_min = VALUES(score_dmg_per_min),
-            score_gold_per_min = VALUES(score_gold_per_min),
-            score_cs_per_min = VALUES(score_cs_per_min),
-            score_kp = VALUES(score_kp),
-            score_dmg_taken_per_min = VALUES(score_dmg_taken_per_min),
-            score_deaths_per_min = VALUES(score_deaths_per_min),
-            score_xp_per_min = VALUES(score_xp_per_min),
-            score_vision_per_min = VALUES(score_vision_per_min),
-            score_cc_per_min = VALUES(score_cc_per_min),
-            final_score = VALUES(final_score);
+
+
+class MetricsWriter:
+    """
+    Writer com buffer para player_match_metrics: junta as linhas de várias
+    partidas e grava tudo num flush, com um único commit, em vez de um
+    commit por partida.
+
+    O flush acontece quando o buffer passa de max_rows linhas ou quando o
+    último flush tem mais de max_seconds (checado a cada add), e no
+    flush()/close() final. O executemany do pymysql reescreve o
+    INSERT ... VALUES ... ON DUPLICATE KEY UPDATE em INSERTs multi-linha
+    (até max_allowed_packet), então cada flush são poucos statements.
+
+    Se um flush falhar, faz rollback, esvazia o buffer e levanta
+    MetricsFlushError com os match_ids que ficaram sem gravar.
+
+    Cada partida adicionada (mesmo sem linhas, quando não tem membros) é
+    marcada em match_metrics_processed na mesma transação das suas linhas,
+    então ela sai da busca por pendentes exatamente quando as métricas
+    ficam gravadas. max_match_pk é o maior match_id já gravado.
+
+    Com stats (RunStats), soma o tempo dos flushes em "insert".
+    """
+
+    def __init__(
+        self,
+        conn,
+        max_rows: int = METRICS_WRITER_MAX_ROWS,
+        max_seconds: float = METRICS_WRITER_MAX_SECONDS,
+        stats: Optional[RunStats] = None
+    ):
+        self.conn = conn
+        self.stats = stats
+        self.max_rows = max(1, max_rows)
+        self.max_seconds = max_seconds
+        self.rows_written = 0
+        self.matches_written = 0
+        self.matches_marked = 0
+        self.max_match_pk: Optional[int] = None
+        self._buffer: List[MetricsRow] = []
+        self._matches: List[Tuple[int, int]] = []
+        self._last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # em caso de erro no meio do processamento, ainda grava o que já foi calculado
+        self.close()
+
+    def add(self, metrics_rows: List[MetricsRow], match_pk: Optional[int] = None):
+        """
+        Adiciona as linhas de UMA partida ao buffer (e faz flush se passou
+        de algum limite). Para marcar uma partida sem linhas (sem membros),
+        passe metrics_rows vazio e o match_pk.
+        """
+        if match_pk is None:
+            if not metrics_rows:
+                return
+            match_pk = metrics_rows[0].match_id
+
+        self._buffer.extend(metrics_rows)
+        self._matches.append((match_pk, len(metrics_rows)))
+
+        if (len(self._buffer) + len(self._matches) >= self.max_rows
+                or time.monotonic() - self._last_flush >= self.max_seconds):
+            self.flush()
+
+    def flush(self):
+        """Grava o buffer numa transação."""
+        self._last_flush = time.monotonic()
+        if not self._matches:
+            return
+
+        rows, matches = self._buffer, self._matches
+        self._buffer, self._matches = [], []
+
+        t0 = time.perf_counter()
+        try:
+            with self.conn.cursor() as cur:
+                if rows:
+                    cur.executemany(INSERT_METRICS_SQL, rows)
+                cur.executemany(INSERT_PROCESSED_SQL, matches)
+            self.conn.commit()
+        except Exception as exc:
+            try:
+                self.conn.rollback()
+            except Exception:
+                pass
+            raise MetricsFlushError([pk for pk, _ in matches], exc) from exc
+
+        if self.stats is not None:
+            self.stats.add_time("insert", time.perf_counter() - t0)
+            self.stats.incr("rows_written", len(rows))
+
+        self.rows_written += len(rows)
+        self.matches_written += sum(1 for _, n in matches if n)
+        self.matches_marked += len(matches)
+        batch_max = max(pk for pk, _ in matches)
+        if self.max_match_pk is None or batch_max > self.max_match_pk:
+            self.max_match_pk = batch_max
+
+    def close(self):
+        self.flush()
+
+
+def ensure_column(conn, table: str, column: str, ddl: str) -> bool:
+    """
+    Roda o ALTER TABLE em ddl se table.column ainda não existe
+    (bancos criados antes da coluna entrar na entidade do Spring).
+    Retorna True se criou.
+    """
+    sql = """
+        SELECT COUNT(*) AS n
+        FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE()
+          AND TABLE_NAME = %s
+          AND COLUMN_NAME = %s
     """
     with conn.cursor() as cur:
-        cur.executemany(sql, metrics_rows)
+        cur.execute(sql, (table, column))
+        if cur.fetchone()["n"]:
+            return False
+        cur.execute(ddl)
     conn.commit()
+    print(f"Coluna {table}.{column} criada.")
+    return True
+
+
+def ensure_weights_version_column(conn):
+    """
+    Garante a coluna player_match_metrics.weights_version (e o índice)
+    em bancos criados antes dela existir na entidade PlayerMatchMetrics.
+    """
+    ensure_column(conn, "player_match_metrics", "weights_version", """
+        ALTER TABLE player_match_metrics
+            ADD COLUMN weights_version VARCHAR(32) NULL,
+            ADD INDEX idx_pmm_weights_version (weights_version)
+    """)
+
+
+def ensure_ranking_sum_column(conn):
+    """
+    Garante member_ranking_metrics.sum_final_score, a soma acumulada
+    usada pela atualização incremental do ranking.
+    """
+    ensure_column(conn, "member_ranking_metrics", "sum_final_score", """
+        ALTER TABLE member_ranking_metrics
+            ADD COLUMN sum_final_score DOUBLE NULL
+    """)
 
 
 # =========================
-# CÁLCULO DE MÉTRICAS POR PARTIDA
+# EXTRAÇÃO DO TIMELINE
 # =========================
 
-def compute_metrics_for_match(
-    match_row: Dict[str, Any],
-    participants: List[Dict[str, Any]],
-    member_puuids: set
-) -> List[Dict[str, Any]]:
+if msgspec is not None:
+    # Só os campos que o cálculo usa; o msgspec ignora o resto do JSON
+    # sem montar os objetos (posições, itens, damageStats etc.).
+    class _TimelineParticipantFrame(TypedDict, total=False):
+        timeEnemySpentControlled: int
+        xp: int
+
+    class _TimelineEvent(TypedDict, total=False):
+        type: str
+        creatorId: int
+        killerId: int
+
+    class _TimelineFrame(TypedDict, total=False):
+        participantFrames: Dict[str, _TimelineParticipantFrame]
+        events: List[_TimelineEvent]
+
+    class _TimelineMetadata(TypedDict, total=False):
+        participants: List[str]
+
+    class _TimelineInfo(TypedDict, total=False):
+        frames: List[_TimelineFrame]
+
+    class _Timeline(TypedDict, total=False):
+        metadata: _TimelineMetadata
+        info: _TimelineInfo
+
+    _TIMELINE_DECODER = msgspec.json.Decoder(_Timeline)
+else:
+    _TIMELINE_DECODER = None
+
+
+def load_timeline_json(raw_json) -> Dict[str, Any]:
     """
-    Calcula métricas para TODOS os participantes da partida (para normalização),
-    mas só retorna linhas para quem está em member_puuids.
+    Faz o parse do timeline bruto com o backend mais rápido disponível
+    (TIMELINE_JSON_BACKEND): msgspec (só os campos usados) > orjson > json.
+    Se o msgspec rejeitar o documento (tipo inesperado em algum campo),
+    cai para o parse completo.
     """
-    duration_sec = match_row["game_duration_sec"]
-    if not duration_sec or duration_sec <= 0:
-        return []
+    backend = TIMELINE_JSON_BACKEND
 
-    duration_min = duration_sec / 60.0
+    if _TIMELINE_DECODER is not None and backend in ("auto", "msgspec"):
+        try:
+            return _TIMELINE_DECODER.decode(raw_json)
+        except msgspec.ValidationError:
+            pass
 
-    # ---- Parse timeline JSON ----
-    timeline = json.loads(match_row["timeline_json"])
-    tl_meta = timeline["metadata"]
-    tl_info = timeline["info"]
+    if orjson is not None and backend in ("auto", "msgspec", "orjson"):
+        return orjson.loads(raw_json)
 
-    # Mapa: puuid -> participantId (1..10)
-    tl_puuids = tl_meta["participants"]
-    puuid_to_pid = {puuid: idx + 1 for idx, puuid in enumerate(tl_puuids)}
+    return json.loads(raw_json)
 
-    frames = tl_info["frames"]
 
-    # Pré-cálculo: cc total e xp final por participantId
-    cc_total_ms = {pid: 0 for pid in range(1, 11)}
-    xp_final = {pid: 0 for pid in range(1, 11)}
+def get_timeline_features(
+    match_row: Dict[str, Any],
+    timings: Optional[Dict[str, float]] = None
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Devolve (features, extraidas_agora) de uma partida: do cache
+    (timeline_features_json) quando a query já trouxe, senão extraindo
+    do timeline bruto.
 
-    for frame in frames:
-        pf = frame["participantFrames"]
-        for pid_str, data in pf.items():
-            pid = int(pid_str)
-            cc_ms = data.get("timeEnemySpentControlled", 0)
-            if cc_ms > cc_total_ms[pid]:
-                cc_total_ms[pid] = cc_ms
-            xp_final[pid] = data.get("xp", xp_final.get(pid, 0))
+    timings (opcional) recebe os segundos de "json_parse" e "frame_walk".
+    """
+    t0 = time.perf_counter()
+    cached = match_row.get("timeline_features_json")
+    if cached:
+        features = json.loads(cached)
+        if timings is not None:
+            timings["json_parse"] = time.perf_counter() - t0
+        return features, False
+
+    timeline = load_timeline_json(match_row["timeline_json"])
+    t1 = time.perf_counter()
+    features = features_from_timeline(timeline)
+    if timings is not None:
+        timings["json_parse"] = t1 - t0
+        timings["frame_walk"] = time.perf_counter() - t1
+    return features, True
+
+
+def extract_timeline_features(raw_json) -> Dict[str, Any]:
+    """
+    Extrai do timeline, numa única passada pelos frames, o que o cálculo usa:
+      - participants: puuids na ordem do participantId (1..10)
+      - cc_total_ms: maior timeEnemySpentControlled visto
+      - xp_final: xp do último frame
+      - wards_placed / wards_killed: eventos WARD_PLACED / WARD_KILL
+    As listas são indexadas por participantId - 1.
+    """
+    return features_from_timeline(load_timeline_json(raw_json))
+
+
+def features_from_timeline(timeline: Dict[str, Any]) -> Dict[str, Any]:
+    """Passada pelos frames de um timeline já parseado (ver extract_timeline_features)."""
+    tl_puuids = list(timeline["metadata"]["participants"])
+    frames = timeline["info"]["frames"]
 
-    # Wards da timeline (WARD_PLACED / WARD_KILL)
-    wards_placed = {pid: 0 for pid in range(1, 11)}
-    wards_killed = {pid: 0 for pid in range(1, 11)}
+    n = max(10, len(tl_puuids))
+    cc_total_ms = [0] * n
+    xp_final = [0] * n
+    wards_placed = [0] * n
+    wards_killed = [0] * n
 
     for frame in frames:
-        for event in frame.get("events", []):
+        for pid_str, data in frame["participantFrames"].items():
+            i = int(pid_str) - 1
+            if not 0 <= i < n:
+                continue
+            cc_ms = data.get("timeEnemySpentControlled", 0)
+            if cc_ms > cc_total_ms[i]:
+                cc_total_ms[i] = cc_ms
+            if "xp" in data:
+                xp_final[i] = data["xp"]
+
+        for event in frame.get("events", ()):
             etype = event.get("type")
             if etype == "WARD_PLACED":
                 creator = event.get("creatorId")
-                if creator in wards_placed:
-                    wards_placed[creator] += 1
+                if isinstance(creator, int) and 0 < creator <= n:
+                    wards_placed[creator - 1] += 1
             elif etype == "WARD_KILL":
                 killer = event.get("killerId")
-                if killer in wards_killed:
-                    wards_killed[killer] += 1
+                if isinstance(killer, int) and 0 < killer <= n:
+                    wards_killed[killer - 1] += 1
+
+    return {
+        "participants": tl_puuids,
+        "cc_total_ms": cc_total_ms,
+        "xp_final": xp_final,
+        "wards_placed": wards_placed,
+        "wards_killed": wards_killed,
+    }
+
+
+# =========================
+# CÁLCULO DE MÉTRICAS POR PARTIDA
+# =========================
+
+def raw_metrics_for_match(
+    match_row: Dict[str, Any],
+    participants: List[Dict[str, Any]],
+    member_puuids: set,
+    features: Optional[Dict[str, Any]] = None
+) -> List[RawMetricsRow]:
+    """
+    Métricas brutas de TODOS os participantes da partida (a entrada da
+    normalização), com is_member marcado para quem está em member_puuids.
+    Vazio se a partida não tem duração válida.
+
+    features: saída de extract_timeline_features; se não vier, usa o cache
+    da partida (timeline_features_json) ou extrai do timeline bruto.
+    """
+    duration_sec = match_row["game_duration_sec"]
+    if not duration_sec or duration_sec <= 0:
+        return []
+
+    duration_min = duration_sec / 60.0
+
+    # ---- Features do timeline (cc, xp, wards): cache ou uma passada ----
+    if features is None:
+        features, _ = get_timeline_features(match_row)
+
+    # Mapa: puuid -> participantId (1..10)
+    puuid_to_pid = {puuid: idx + 1 for idx, puuid in enumerate(features["participants"])}
+
+    cc_total_ms = features["cc_total_ms"]
+    xp_final = features["xp_final"]
+    wards_placed = features["wards_placed"]
+    wards_killed = features["wards_killed"]
 
     # ---- Team kills (para KP) ----
     team_kills: Dict[int, int] = {}
@@ -325,19 +1319,7 @@ def compute_metrics_for_match(
         team_kills[team_id] = team_kills.get(team_id, 0) + (p.get("kills") or 0)
 
     # ---- Calcula métricas brutas por participante ----
-    temp_rows: List[Dict[str, Any]] = []
-    metrics_raw = {
-        "kda": [],
-        "dmg_per_min": [],
-        "gold_per_min": [],
-        "cs_per_min": [],
-        "kp": [],
-        "dmg_taken_per_min": [],
-        "deaths_per_min": [],
-        "xp_per_min": [],
-        "vision_per_min": [],
-        "cc_per_min": [],
-    }
+    temp_rows: List[RawMetricsRow] = []
 
     for p in participants:
         puuid = p["puuid"]
@@ -358,12 +1340,12 @@ def compute_metrics_for_match(
         gold_earned = p.get("gold_earned") or 0
         total_minions = (p.get("total_minions_killed") or 0) + (p.get("neutral_minions_killed") or 0)
 
-        # timeline based
-        xp = xp_final[pid]
-        cc_ms = cc_total_ms[pid]
+        # timeline based (listas indexadas por participantId - 1)
+        xp = xp_final[pid - 1]
+        cc_ms = cc_total_ms[pid - 1]
         cc_s = cc_ms / 1000.0
-        w_placed = wards_placed[pid]
-        w_killed = wards_killed[pid]
+        w_placed = wards_placed[pid - 1]
+        w_killed = wards_killed[pid - 1]
         vision_actions = w_placed + w_killed
 
         # métricas por minuto
@@ -386,196 +1368,1605 @@ def compute_metrics_for_match(
         team_total_kills = team_kills.get(team_id, 0)
         kp = (kills + assists) / team_total_kills if team_total_kills > 0 else 0.0
 
-        row = {
-            "match_id": match_row["match_pk"],
-            "match_participant_id": mp_id,
-            "puuid": puuid,
-            "team_id": team_id,
-            "champion_name": champion_name,
-            "kda": kda,
-            "dmg_per_min": dmg_per_min,
-            "gold_per_min": gold_per_min,
-            "cs_per_min": cs_per_min,
-            "kp": kp,
-            "dmg_taken_per_min": dmg_taken_per_min,
-            "deaths_per_min": deaths_per_min,
-            "xp_per_min": xp_per_min,
-            "vision_per_min": vision_per_min,
-            "cc_per_min": cc_per_min,
-            "is_member": puuid in member_puuids,
-        }
+        temp_rows.append(RawMetricsRow(
+            mp_id,
+            puuid,
+            team_id,
+            champion_name,
+            map_team_position(p.get("team_position")),
+            puuid in member_puuids,
+            kda,
+            dmg_per_min,
+            gold_per_min,
+            cs_per_min,
+            kp,
+            dmg_taken_per_min,
+            deaths_per_min,
+            xp_per_min,
+            vision_per_min,
+            cc_per_min,
+        ))
+
+    return temp_rows
+
+
+def member_metrics_rows(
+    match_pk: int,
+    temp_rows: List[RawMetricsRow],
+    scores_by_row: List[List[float]],
+    finals: List[float],
+    weights_version: str
+) -> List[MetricsRow]:
+    """Linhas finais (só membros) a partir dos scores/final_score de cada participante."""
+    return [
+        MetricsRow(
+            match_pk,
+            base.match_participant_id,
+            base.puuid,
+            base.team_id,
+            base.champion_name,
+            *base.metrics(),
+            *scores,
+            final,
+            weights_version,
+        )
+        for base, scores, final in zip(temp_rows, scores_by_row, finals)
+        if base.is_member
+    ]
 
-        temp_rows.append(row)
 
-        metrics_raw["kda"].append(kda)
-        metrics_raw["dmg_per_min"].append(dmg_per_min)
-        metrics_raw["gold_per_min"].append(gold_per_min)
-        metrics_raw["cs_per_min"].append(cs_per_min)
-        metrics_raw["kp"].append(kp)
-        metrics_raw["dmg_taken_per_min"].append(dmg_taken_per_min)
-        metrics_raw["deaths_per_min"].append(deaths_per_min)
-        metrics_raw["xp_per_min"].append(xp_per_min)
-        metrics_raw["vision_per_min"].append(vision_per_min)
-        metrics_raw["cc_per_min"].append(cc_per_min)
+def role_metrics_rows(
+    match_row: Dict[str, Any],
+    temp_rows: List[RawMetricsRow],
+    baselines: "RoleBaselines"
+) -> List[MetricsRow]:
+    """Modo "role": cada membro contra o baseline da rota (não depende dos outros 9)."""
+    patch = patch_from_version(match_row.get("game_version"))
+    members = [base for base in temp_rows if base.is_member]
+    scores_by_row = [baselines.scores(base.team_position, patch, base.metrics()) for base in members]
+    return member_metrics_rows(
+        match_row["match_pk"], members, scores_by_row,
+        final_scores(scores_by_row),
+        baselines.scoring_version,
+    )
+
 
+def compute_metrics_for_match(
+    match_row: Dict[str, Any],
+    participants: List[Dict[str, Any]],
+    member_puuids: set,
+    features: Optional[Dict[str, Any]] = None,
+    baselines: Optional["RoleBaselines"] = None
+) -> List[MetricsRow]:
+    """
+    Calcula métricas para TODOS os participantes da partida (para normalização),
+    mas só retorna linhas (MetricsRow) para quem está em member_puuids.
+
+    Caminho escalar de uma partida (a referência do motor vetorizado:
+    score_match_batch dá os mesmos valores bit a bit).
+    features: saída de extract_timeline_features; se não vier, usa o cache
+    da partida (timeline_features_json) ou extrai do timeline bruto.
+    baselines: modo "role": cada membro é normalizado contra o baseline da
+    sua rota (RoleBaselines.scores) em vez do min-max da partida.
+    """
+    temp_rows = raw_metrics_for_match(match_row, participants, member_puuids, features)
     if not temp_rows:
         return []
 
-    # ---- Normalização por partida ----
-    scores_norm = {
-        "kda":               normalize_metric(metrics_raw["kda"], invert=False),
-        "dmg_per_min":       normalize_metric(metrics_raw["dmg_per_min"], invert=False),
-        "gold_per_min":      normalize_metric(metrics_raw["gold_per_min"], invert=False),
-        "cs_per_min":        normalize_metric(metrics_raw["cs_per_min"], invert=False),
-        "kp":                normalize_metric(metrics_raw["kp"], invert=False),
-        "dmg_taken_per_min": normalize_metric(metrics_raw["dmg_taken_per_min"], invert=False),
-        "deaths_per_min":    normalize_metric(metrics_raw["deaths_per_min"], invert=True),
-        "xp_per_min":        normalize_metric(metrics_raw["xp_per_min"], invert=False),
-        "vision_per_min":    normalize_metric(metrics_raw["vision_per_min"], invert=False),
-        "cc_per_min":        normalize_metric(metrics_raw["cc_per_min"], invert=False),
-    }
-
-    # ---- Monta linhas finais com scores normalizados e final_score ----
-    metrics_rows: List[Dict[str, Any]] = []
-    for i, base in enumerate(temp_rows):
-        if not base["is_member"]:
-            continue
-
-        score_kda = scores_norm["kda"][i]
-        score_dmg_per_min = scores_norm["dmg_per_min"][i]
-        score_gold_per_min = scores_norm["gold_per_min"][i]
-        score_cs_per_min = scores_norm["cs_per_min"][i]
-        score_kp = scores_norm["kp"][i]
-        score_dmg_taken_per_min = scores_norm["dmg_taken_per_min"][i]
-        score_deaths_per_min = scores_norm["deaths_per_min"][i]
-        score_xp_per_min = scores_norm["xp_per_min"][i]
-        score_vision_per_min = scores_norm["vision_per_min"][i]
-        score_cc_per_min = scores_norm["cc_per_min"][i]
-
-        final_score = (
-            WEIGHTS["kda"]               * score_kda +
-            WEIGHTS["dmg_per_min"]       * score_dmg_per_min +
-            WEIGHTS["gold_per_min"]      * score_gold_per_min +
-            WEIGHTS["cs_per_min"]        * score_cs_per_min +
-            WEIGHTS["kp"]                * score_kp +
-            WEIGHTS["dmg_taken_per_min"] * score_dmg_taken_per_min +
-            WEIGHTS["deaths_per_min"]    * score_deaths_per_min +
-            WEIGHTS["xp_per_min"]        * score_xp_per_min +
-            WEIGHTS["vision_per_min"]    * score_vision_per_min +
-            WEIGHTS["cc_per_min"]        * score_cc_per_min
-        )
-
-        base.pop("is_member", None)
-
-        base.update({
-            "score_kda":               score_kda,
-            "score_dmg_per_min":       score_dmg_per_min,
-            "score_gold_per_min":      score_gold_per_min,
-            "score_cs_per_min":        score_cs_per_min,
-            "score_kp":                score_kp,
-            "score_dmg_taken_per_min": score_dmg_taken_per_min,
-            "score_deaths_per_min":    score_deaths_per_min,
-            "score_xp_per_min":        score_xp_per_min,
-            "score_vision_per_min":    score_vision_per_min,
-            "score_cc_per_min":        score_cc_per_min,
-            "final_score":             final_score,
-        })
+    if baselines is not None:
+        return role_metrics_rows(match_row, temp_rows, baselines)
 
-        metrics_rows.append(base)
+    # ---- Normalização por partida (uma coluna por métrica, ordem de METRIC_KEYS) ----
+    columns = list(zip(*(r.metrics() for r in temp_rows)))
+    scores_norm = [
+        normalize_metric(list(columns[k]), invert=key in INVERTED_METRICS)
+        for k, key in enumerate(METRIC_KEYS)
+    ]
+    scores_by_row = [list(scores) for scores in zip(*scores_norm)]
 
-    return metrics_rows
+    return member_metrics_rows(
+        match_row["match_pk"], temp_rows, scores_by_row,
+        [weighted_final_score(scores) for scores in scores_by_row],
+        WEIGHTS_VERSION,
+    )
 
 
 # =========================
-# RANKING DE MEMBROS
+# MOTOR VETORIZADO (numpy)
 # =========================
 
-def update_member_ranking(conn):
+def _pack_raw_metrics(raw_by_match: List[List[Tuple[float, ...]]]):
     """
-    Calcula ranking por membro (apenas membros da tabela members)
-    e grava em member_ranking_metrics.
+    Empacota [partida][participante][métrica] num array (M, P, K) com
+    padding, mais a máscara (M, P) dos participantes válidos.
     """
-    sql = """
-        SELECT m.id AS member_id,
-               m.puuid AS puuid,
-               m.nick AS nick,
-               m.tag  AS tag,
-               COUNT(pmm.id) AS matches_count,
-               AVG(pmm.final_score) AS mean_final_score
-        FROM player_match_metrics pmm
-        JOIN members m ON m.puuid = pmm.puuid
-        GROUP BY m.id, m.puuid, m.nick, m.tag
-        ORDER BY mean_final_score DESC;
+    n_matches = len(raw_by_match)
+    n_players = max((len(rows) for rows in raw_by_match), default=0)
+    raw = np.zeros((n_matches, n_players, len(METRIC_KEYS)), dtype=np.float64)
+    mask = np.zeros((n_matches, n_players), dtype=bool)
+    for i, rows in enumerate(raw_by_match):
+        if rows:
+            raw[i, :len(rows)] = rows
+            mask[i, :len(rows)] = True
+    return raw, mask
+
+
+def normalize_metrics_batch(raw, mask):
     """
-    with conn.cursor() as cur:
-        cur.execute(sql)
-        rows = cur.fetchall()
+    Versão vetorizada de normalize_metric para várias partidas de uma vez.
+    raw: (M, P, K) com as métricas na ordem de METRIC_KEYS; mask: (M, P).
+    Normaliza cada métrica entre os participantes válidos da partida, com
+    o mesmo empate técnico (50.0 quando max ~= min, como math.isclose) e
+    a inversão de INVERTED_METRICS. Posições fora da máscara ficam com 0.
+    """
+    valid = mask[:, :, None]
+    min_v = np.where(valid, raw, np.inf).min(axis=1, keepdims=True)
+    max_v = np.where(valid, raw, -np.inf).max(axis=1, keepdims=True)
+    span = max_v - min_v
 
-    if not rows:
-        print("Nenhum dado para ranking de membros.")
-        return
+    # math.isclose(max_v, min_v) com rel_tol=1e-9 e abs_tol=0
+    tie = np.abs(span) <= 1e-9 * np.maximum(np.abs(max_v), np.abs(min_v))
 
-    ranking_rows = []
-    position = 1
-    for r in rows:
-        ranking_rows.append({
-            "member_id": r["member_id"],
-            "puuid": r["puuid"],
-            "nick": r["nick"],
-            "tag":  r["tag"],
-            "matches_count": int(r["matches_count"]),
-            "mean_final_score": float(r["mean_final_score"]),
-            "position": position,
-        })
-        position += 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = (raw - min_v) / span * 100.0
 
-    sql_insert = """
-        INSERT INTO member_ranking_metrics (
-            member_id,
-            puuid,
-            nick,
-            tag,
-            matches_count,
-            mean_final_score,
-            position
+    invert = np.array([k in INVERTED_METRICS for k in METRIC_KEYS])
+    scores = np.where(invert, 100.0 - scores, scores)
+    scores = np.where(tie, 50.0, scores)
+    return np.where(valid, scores, 0.0)
+
+
+def final_scores_batch(scores):
+    """
+    final_score vetorizado: soma ponderada por WEIGHTS sobre o último eixo
+    (ordem de METRIC_KEYS). Soma métrica a métrica, na mesma ordem da
+    expressão de compute_metrics_for_match, para dar o mesmo resultado
+    bit a bit.
+    """
+    final = WEIGHTS[METRIC_KEYS[0]] * scores[..., 0]
+    for k, key in enumerate(METRIC_KEYS[1:], start=1):
+        final = final + WEIGHTS[key] * scores[..., k]
+    return final
+
+
+def final_scores(scores_by_row: List[List[float]]) -> List[float]:
+    """final_score de cada linha de scores: final_scores_batch com numpy, senão weighted_final_score."""
+    if not scores_by_row:
+        return []
+    if np is None:
+        return [weighted_final_score(scores) for scores in scores_by_row]
+    return final_scores_batch(np.array(scores_by_row, dtype=np.float64)).tolist()
+
+
+def score_metrics_batch(
+    raw_by_match: List[List[Tuple[float, ...]]]
+) -> Tuple[List[List[List[float]]], List[List[float]]]:
+    """
+    Normaliza e calcula o final_score de muitas partidas de uma vez.
+    raw_by_match[partida][participante] = métricas brutas na ordem de METRIC_KEYS
+    (todos os participantes da partida, como em compute_metrics_for_match).
+
+    Retorna (scores_by_match, final_by_match) no mesmo formato. Usa numpy
+    quando disponível; sem numpy, cai no caminho Python (normalize_metric),
+    que dá exatamente os mesmos valores.
+    """
+    if not raw_by_match:
+        return [], []
+
+    if np is None:
+        scores_by_match = []
+        final_by_match = []
+        for rows in raw_by_match:
+            columns = [
+                normalize_metric([r[k] for r in rows], invert=key in INVERTED_METRICS)
+                for k, key in enumerate(METRIC_KEYS)
+            ]
+            scores = [list(col) for col in zip(*columns)]
+            scores_by_match.append(scores)
+            final_by_match.append([weighted_final_score(sc) for sc in scores])
+        return scores_by_match, final_by_match
+
+    raw, mask = _pack_raw_metrics(raw_by_match)
+    scores = normalize_metrics_batch(raw, mask)
+    final = final_scores_batch(scores)
+
+    scores_by_match = []
+    final_by_match = []
+    for i, rows in enumerate(raw_by_match):
+        n = len(rows)
+        scores_by_match.append(scores[i, :n].tolist())
+        final_by_match.append(final[i, :n].tolist())
+    return scores_by_match, final_by_match
+
+
+# =========================
+# NORMALIZAÇÃO POR ROTA (baselines)
+# =========================
+
+# versão dos baselines em metrics_job_state (sobe a cada rebuild)
+BASELINE_STATE_KEY = "role_baseline_version"
+
+# sufixo do weights_version das linhas calculadas no modo "role"
+ROLE_VERSION_TAG = "-role"
+
+
+def patch_from_version(game_version) -> str:
+    """'14.3.512.1' -> '14.3' (vazio se não der para ler)."""
+    parts = str(game_version or "").split(".")
+    return ".".join(parts[:2]) if len(parts) >= 2 else ""
+
+
+class RunningMoments:
+    """
+    Média e variância em uma passada (Welford), para cada métrica na ordem
+    de METRIC_KEYS: numericamente estável e sem guardar os valores, então
+    o rebuild dos baselines usa memória constante por grupo.
+    """
+
+    __slots__ = ("n", "mean", "m2")
+
+    def __init__(self):
+        self.n = 0
+        self.mean = [0.0] * len(METRIC_KEYS)
+        self.m2 = [0.0] * len(METRIC_KEYS)
+
+    def add(self, values):
+        self.n += 1
+        n = self.n
+        mean, m2 = self.mean, self.m2
+        for k, x in enumerate(values):
+            delta = x - mean[k]
+            mean[k] += delta / n
+            m2[k] += delta * (x - mean[k])
+
+    def std(self) -> List[float]:
+        """Desvio padrão amostral (0.0 com menos de 2 amostras)."""
+        if self.n < 2:
+            return [0.0] * len(self.m2)
+        return [math.sqrt(v / (self.n - 1)) for v in self.m2]
+
+
+def ensure_role_baselines_table(conn):
+    """
+    Cria (se não existir) metric_role_baselines: média e desvio de cada
+    métrica bruta por (team_position, patch). "" em team_position/patch
+    significa todos.
+    """
+    sql = """
+        CREATE TABLE IF NOT EXISTS metric_role_baselines (
+            team_position VARCHAR(16) NOT NULL,
+            patch VARCHAR(16) NOT NULL,
+            metric VARCHAR(32) NOT NULL,
+            samples BIGINT NOT NULL,
+            mean DOUBLE NOT NULL,
+            std DOUBLE NOT NULL,
+            PRIMARY KEY (team_position, patch, metric)
         )
-        VALUES (
-            %(member_id)s,
-            %(puuid)s,
-            %(nick)s,
-            %(tag)s,
-            %(matches_count)s,
-            %(mean_final_score)s,
-            %(position)s
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql)
+    conn.commit()
+
+
+def iter_baseline_samples(
+    conn,
+    chunk_size: int = EXPORT_FETCH_SIZE
+) -> Iterator[Tuple[str, str, List[float]]]:
+    """
+    Lê player_match_metrics em streaming (SSDictCursor, blocos de
+    chunk_size) e gera (rota, patch, métricas brutas na ordem de METRIC_KEYS).
+    """
+    sql = f"""
+        SELECT mp.team_position AS team_position,
+               m.game_version AS game_version,
+               {", ".join(f"pmm.{k}" for k in METRIC_KEYS)}
+        FROM player_match_metrics pmm
+        JOIN match_participants mp ON pmm.match_participant_id = mp.id
+        JOIN matches m ON pmm.match_id = m.id
+    """
+    chunk_size = max(1, chunk_size)
+    with conn.cursor(pymysql.cursors.SSDictCursor) as cur:
+        cur.execute(sql)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                return
+            for r in rows:
+                yield (
+                    map_team_position(r["team_position"]),
+                    patch_from_version(r["game_version"]),
+                    [float(r[k] or 0.0) for k in METRIC_KEYS],
+                )
+
+
+def build_role_baselines(samples, by_patch: bool = False) -> Dict[Tuple[str, str], RunningMoments]:
+    """
+    Acumula as amostras por (rota, "") e no geral ("", ""); com by_patch,
+    também por (rota, patch).
+    """
+    groups: Dict[Tuple[str, str], RunningMoments] = {}
+    for team_position, patch, values in samples:
+        keys = {(team_position, ""), ("", "")}
+        if by_patch and patch:
+            keys.add((team_position, patch))
+        for key in keys:
+            moments = groups.get(key)
+            if moments is None:
+                moments = groups[key] = RunningMoments()
+            moments.add(values)
+    return groups
+
+
+def rebuild_role_baselines(
+    conn,
+    by_patch: bool = ROLE_BASELINE_BY_PATCH,
+    chunk_size: int = EXPORT_FETCH_SIZE
+) -> Tuple[int, int]:
+    """
+    Recalcula metric_role_baselines a partir de player_match_metrics numa
+    passada (iter_baseline_samples + RunningMoments, sem carregar a tabela)
+    e sobe a versão dos baselines em metrics_job_state, na mesma transação.
+    Retorna (versão nova, grupos gravados).
+    """
+    groups = build_role_baselines(iter_baseline_samples(conn, chunk_size), by_patch)
+
+    rows = []
+    for (team_position, patch), moments in groups.items():
+        std = moments.std()
+        for k, key in enumerate(METRIC_KEYS):
+            rows.append((team_position, patch, key, moments.n, moments.mean[k], std[k]))
+
+    version = (load_job_state(conn, BASELINE_STATE_KEY) or 0) + 1
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM metric_role_baselines")
+        if rows:
+            cur.executemany("""
+                INSERT INTO metric_role_baselines
+                    (team_position, patch, metric, samples, mean, std)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, rows)
+    # save_job_state faz o commit (baselines + versão juntos)
+    save_job_state(conn, BASELINE_STATE_KEY, version)
+    return version, len(groups)
+
+
+class RoleBaselines:
+    """
+    Baselines de metric_role_baselines para o modo "role": cada jogador é
+    normalizado contra a distribuição da sua rota, não contra os outros 9
+    da partida. score = 100 x Phi(z), com z = (x - média) / desvio, ou seja,
+    o percentil aproximado pela normal; invertido em INVERTED_METRICS e
+    50.0 quando o desvio é zero (como o empate de normalize_metric).
+
+    O baseline usado é o primeiro com pelo menos min_samples amostras entre
+    (rota, patch), (rota, todos) e (todos, todos). Objeto simples
+    (picklable): vai para os workers no initializer.
+    """
+
+    def __init__(
+        self,
+        version: int,
+        groups: Dict[Tuple[str, str], Tuple[int, List[float], List[float]]],
+        min_samples: int = ROLE_BASELINE_MIN_SAMPLES
+    ):
+        self.version = version
+        # (rota, patch) -> (amostras, médias, desvios), na ordem de METRIC_KEYS
+        self.groups = groups
+        self.min_samples = min_samples
+        self.scoring_version = f"{WEIGHTS_VERSION}{ROLE_VERSION_TAG}{version}"
+        self._invert = [key in INVERTED_METRICS for key in METRIC_KEYS]
+
+    def lookup(self, team_position: str, patch: str):
+        for key in ((team_position, patch), (team_position, ""), ("", "")):
+            group = self.groups.get(key)
+            if group is not None and group[0] >= self.min_samples:
+                return group
+        return self.groups.get(("", ""))
+
+    def scores(self, team_position: str, patch: str, metrics) -> List[float]:
+        group = self.lookup(team_position, patch)
+        if group is None:
+            return [50.0] * len(METRIC_KEYS)
+        _, means, stds = group
+        scores = []
+        for x, mean, std, invert in zip(metrics, means, stds, self._invert):
+            if std <= 0.0:
+                scores.append(50.0)
+                continue
+            score = 50.0 * (1.0 + math.erf((x - mean) / (std * math.sqrt(2.0))))
+            scores.append(100.0 - score if invert else score)
+        return scores
+
+
+def load_role_baselines(conn, min_samples: int = ROLE_BASELINE_MIN_SAMPLES) -> Optional[RoleBaselines]:
+    """Carrega os baselines atuais (None se nunca foram construídos ou estão vazios)."""
+    version = load_job_state(conn, BASELINE_STATE_KEY)
+    if version is None:
+        return None
+    with conn.cursor() as cur:
+        cur.execute("SELECT team_position, patch, metric, samples, mean, std FROM metric_role_baselines")
+        rows = cur.fetchall()
+
+    by_group: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for r in rows:
+        by_group.setdefault((r["team_position"], r["patch"]), {})[r["metric"]] = r
+
+    groups = {}
+    for key, metrics in by_group.items():
+        if any(k not in metrics for k in METRIC_KEYS):
+            continue
+        groups[key] = (
+            min(int(metrics[k]["samples"]) for k in METRIC_KEYS),
+            [float(metrics[k]["mean"]) for k in METRIC_KEYS],
+            [float(metrics[k]["std"]) for k in METRIC_KEYS],
         )
+    if not groups:
+        return None
+    return RoleBaselines(version, groups, min_samples)
+
+
+# =========================
+# RESCORE (mudança de WEIGHTS)
+# =========================
+
+def update_scores_by_id(
+    conn,
+    ids: List[int],
+    columns: List[str],
+    values_by_row: List[List[float]],
+    weights_version: str
+):
+    """
+    Grava um bloco de scores recalculados num único UPDATE (um CASE id por
+    coluna), carimbando weights_version. values_by_row segue a ordem de
+    ids, com um valor por coluna de columns. Faz commit.
+    """
+    case_sql = " ".join(["WHEN %s THEN %s"] * len(ids))
+    placeholders = ", ".join(["%s"] * len(ids))
+    set_sql = ",\n                ".join(f"{c} = CASE id {case_sql} END" for c in columns)
+    sql_update = f"""
+        UPDATE player_match_metrics
+        SET {set_sql},
+            weights_version = %s
+        WHERE id IN ({placeholders})
+    """
+    params: List[Any] = []
+    for c in range(len(columns)):
+        for row_id, values in zip(ids, values_by_row):
+            params.extend((row_id, values[c]))
+    params.append(weights_version)
+    params.extend(ids)
+
+    with conn.cursor() as cur:
+        cur.execute(sql_update, params)
+    conn.commit()
+
+
+def rescore_metrics(conn, chunk_size: int = RESCORE_CHUNK_SIZE) -> int:
+    """
+    Recalcula o final_score das linhas de player_match_metrics que não
+    estão em WEIGHTS_VERSION, sem reler timeline nem participantes.
+
+    Os score_* (normalização 0–100 dentro da partida) não dependem dos
+    pesos e já estão gravados; só o final_score muda quando WEIGHTS muda.
+    Ele sai de final_scores_batch sobre os score_* armazenados, o mesmo
+    valor que um recálculo completo daria.
+
+    Lê em blocos por id (keyset) e grava cada bloco num único UPDATE,
+    carimbando weights_version. Retorna quantas linhas foram atualizadas.
+
+    Linhas calculadas no modo "role" ficam de fora: os score_* delas não
+    são min-max da partida (voltar para o modo "match" é com
+    reprocess_role_matches).
+    """
+    score_columns = [f"score_{k}" for k in METRIC_KEYS]
+    sql_select = f"""
+        SELECT id, {", ".join(score_columns)}
+        FROM player_match_metrics
+        WHERE (weights_version IS NULL
+               OR (weights_version <> %s AND weights_version NOT LIKE %s))
+          AND id > %s
+        ORDER BY id ASC
+        LIMIT %s
+    """
+
+    chunk_size = max(1, chunk_size)
+    last_id = 0
+    total = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(sql_select, (WEIGHTS_VERSION, f"%{ROLE_VERSION_TAG}%", last_id, chunk_size))
+            rows = cur.fetchall()
+        if not rows:
+            break
+
+        # linhas antigas podem ter score nulo; esses contam como 0
+        scores = [[float(r[c] or 0.0) for c in score_columns] for r in rows]
+        finals = final_scores(scores)
+
+        ids = [r["id"] for r in rows]
+        update_scores_by_id(conn, ids, ["final_score"], [[f] for f in finals], WEIGHTS_VERSION)
+
+        total += len(rows)
+        last_id = ids[-1]
+        if len(rows) < chunk_size:
+            break
+
+    return total
+
+
+def rescore_metrics_by_role(
+    conn,
+    baselines: RoleBaselines,
+    chunk_size: int = RESCORE_CHUNK_SIZE
+) -> int:
+    """
+    Modo "role": recalcula score_* e final_score das linhas que não estão
+    em baselines.scoring_version (pesos ou baselines mudaram, ou linhas do
+    modo "match"). Cada linha só depende das próprias métricas brutas, da
+    rota e do patch, então não precisa de timeline nem dos outros
+    participantes, e linhas já atualizadas não são tocadas.
+
+    Mesmo esquema de rescore_metrics: blocos por id (keyset), um UPDATE
+    com CASE por bloco. Retorna quantas linhas foram atualizadas.
+    """
+    sql_select = f"""
+        SELECT pmm.id AS id,
+               mp.team_position AS team_position,
+               m.game_version AS game_version,
+               {", ".join(f"pmm.{k}" for k in METRIC_KEYS)}
+        FROM player_match_metrics pmm
+        JOIN match_participants mp ON pmm.match_participant_id = mp.id
+        JOIN matches m ON pmm.match_id = m.id
+        WHERE (pmm.weights_version IS NULL OR pmm.weights_version <> %s)
+          AND pmm.id > %s
+        ORDER BY pmm.id ASC
+        LIMIT %s
+    """
+    columns = [f"score_{k}" for k in METRIC_KEYS] + ["final_score"]
+
+    chunk_size = max(1, chunk_size)
+    last_id = 0
+    total = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(sql_select, (baselines.scoring_version, last_id, chunk_size))
+            rows = cur.fetchall()
+        if not rows:
+            break
+
+        ids = [r["id"] for r in rows]
+        scores_by_row = [
+            baselines.scores(
+                map_team_position(r["team_position"]),
+                patch_from_version(r["game_version"]),
+                [float(r[k] or 0.0) for k in METRIC_KEYS],
+            )
+            for r in rows
+        ]
+        values_by_row = [
+            list(scores) + [final]
+            for scores, final in zip(scores_by_row, final_scores(scores_by_row))
+        ]
+
+        update_scores_by_id(conn, ids, columns, values_by_row, baselines.scoring_version)
+
+        total += len(rows)
+        last_id = ids[-1]
+        if len(rows) < chunk_size:
+            break
+
+    return total
+
+
+def has_role_scored_rows(conn) -> bool:
+    """Se ainda há linhas de player_match_metrics calculadas no modo "role"."""
+    # sem baselines nunca houve modo "role": evita varrer a tabela
+    if load_job_state(conn, BASELINE_STATE_KEY) is None:
+        return False
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT 1 AS found FROM player_match_metrics WHERE weights_version LIKE %s LIMIT 1",
+            (f"%{ROLE_VERSION_TAG}%",),
+        )
+        return cur.fetchone() is not None
+
+
+def reprocess_role_matches(
+    conn,
+    stats: Optional[RunStats] = None,
+    chunk_size: int = MATCHES_BATCH_SIZE
+) -> Tuple[int, int]:
+    """
+    Volta para o modo "match" as linhas calculadas no modo "role": a
+    normalização min-max precisa dos 10 participantes, que não ficam em
+    player_match_metrics, então cada partida com linhas "-role" é
+    recalculada a partir de match_timeline_features (ou do timeline, sem
+    cache) e de match_participants.
+
+    Atualiza score_* e final_score das linhas existentes (mesmos ids, sem
+    mexer nas marcas de match_metrics_processed), para os mesmos puuids
+    que já estavam gravados. Lê as partidas em blocos por match_id
+    (keyset) e recalcula cada bloco de uma vez (score_match_batch).
+    Retorna (linhas atualizadas, partidas que não deu para recalcular: sem
+    timeline, sem participantes ou com timeline inválido, que seguem "-role").
+    """
+    sql_matches = """
+        SELECT DISTINCT match_id
+        FROM player_match_metrics
+        WHERE weights_version LIKE %s
+          AND match_id > %s
+        ORDER BY match_id ASC
+        LIMIT %s
+    """
+    columns = [f"score_{k}" for k in METRIC_KEYS] + ["final_score"]
+    role_like = f"%{ROLE_VERSION_TAG}%"
+
+    chunk_size = max(1, chunk_size)
+    last_pk = 0
+    total = 0
+    skipped = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(sql_matches, (role_like, last_pk, chunk_size))
+            match_pks = [r["match_id"] for r in cur.fetchall()]
+        if not match_pks:
+            break
+
+        placeholders = ", ".join(["%s"] * len(match_pks))
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT id, match_id, puuid
+                FROM player_match_metrics
+                WHERE weights_version LIKE %s
+                  AND match_id IN ({placeholders})
+                """,
+                [role_like, *match_pks],
+            )
+            role_rows = cur.fetchall()
+        ids_by_match: Dict[int, Dict[str, int]] = {}
+        for r in role_rows:
+            ids_by_match.setdefault(r["match_id"], {})[r["puuid"]] = r["id"]
+
+        matches = fetch_matches_by_pk(conn, match_pks)
+        participants_by_match = fetch_participants_for_matches(conn, match_pks)
+        skipped += len(match_pks) - len(matches)
+
+        jobs = []
+        for m in matches:
+            participants = participants_by_match.get(m["match_pk"]) or []
+            if participants:
+                jobs.append((m, participants))
+            else:
+                skipped += 1
+        puuids = {puuid for row_ids in ids_by_match.values() for puuid in row_ids}
+
+        ids: List[int] = []
+        values_by_row: List[List[float]] = []
+        new_features: Dict[int, Tuple[str, Dict[str, Any]]] = {}
+        for (m, _), result in zip(jobs, score_match_batch(jobs, puuids)):
+            if isinstance(result, Exception):
+                skipped += 1
+                continue
+            metrics_rows, features, _ = result
+            if features is not None:
+                new_features[m["match_pk"]] = (m["match_id_riot"], features)
+            row_ids = ids_by_match.get(m["match_pk"], {})
+            for row in metrics_rows:
+                # puuids de outras partidas do bloco que não tinham linha nesta
+                if row.puuid in row_ids:
+                    ids.append(row_ids[row.puuid])
+                    values_by_row.append([getattr(row, c) for c in columns])
+
+        if ids:
+            update_scores_by_id(conn, ids, columns, values_by_row, WEIGHTS_VERSION)
+        save_timeline_features(conn, new_features)
+        if stats is not None:
+            stats.incr("reprocessed_role_matches", len(matches))
+
+        total += len(ids)
+        last_pk = match_pks[-1]
+        if len(match_pks) < chunk_size:
+            break
+
+    return total, skipped
+
+
+def ensure_timeline_features_table(conn):
+    """
+    Cria (se não existir) o cache match_timeline_features:
+    features extraídas do timeline por matches.id, versionadas por
+    TIMELINE_FEATURES_VERSION. Não é uma entidade do Spring, então
+    o Python cuida do schema dela.
+
+    match_riot_id (matches.match_id da Riot) vai junto e as leituras só
+    aceitam a entrada se ele bater: se o Spring recriar a tabela matches
+    e um matches.id for reaproveitado por outra partida, o cache antigo
+    vira um miss (e é sobrescrito) em vez de servir as features erradas.
+    """
+    sql = """
+        CREATE TABLE IF NOT EXISTS match_timeline_features (
+            match_id BIGINT NOT NULL,
+            match_riot_id VARCHAR(64) NULL,
+            extractor_version INT NOT NULL,
+            features_json MEDIUMTEXT NOT NULL,
+            created_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+            PRIMARY KEY (match_id)
+        )
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql)
+    conn.commit()
+    # caches de antes da coluna: as entradas sem ela são reextraídas uma vez
+    ensure_column(conn, "match_timeline_features", "match_riot_id", """
+        ALTER TABLE match_timeline_features
+            ADD COLUMN match_riot_id VARCHAR(64) NULL AFTER match_id
+    """)
+
+
+def save_timeline_features(conn, features_by_match: Dict[int, Tuple[str, Dict[str, Any]]]):
+    """
+    Grava no cache match_timeline_features as features recém-extraídas
+    ({match_pk: (match_id da Riot, features)}). Sobrescreve entradas de
+    versões antigas ou de outra partida no mesmo matches.id.
+    """
+    if not features_by_match:
+        return
+
+    sql = """
+        INSERT INTO match_timeline_features (match_id, match_riot_id, extractor_version, features_json)
+        VALUES (%s, %s, %s, %s)
         ON DUPLICATE KEY UPDATE
-            puuid = VALUES(puuid),
-            nick = VALUES(nick),
-            tag  = VALUES(tag),
-            matches_count = VALUES(matches_count),
-            mean_final_score = VALUES(mean_final_score),
-            position = VALUES(position);
+            match_riot_id = VALUES(match_riot_id),
+            extractor_version = VALUES(extractor_version),
+            features_json = VALUES(features_json);
+    """
+    params = [
+        (match_pk, match_riot_id, TIMELINE_FEATURES_VERSION, json.dumps(features, separators=(",", ":")))
+        for match_pk, (match_riot_id, features) in features_by_match.items()
+    ]
+    with conn.cursor() as cur:
+        cur.executemany(sql, params)
+    conn.commit()
+
+
+# =========================
+# ORQUESTRAÇÃO DO CÁLCULO (serial ou multiprocesso)
+# =========================
+
+# puuids dos membros (e baselines do modo "role") dentro de cada processo worker
+# (setados no initializer)
+_WORKER_MEMBER_PUUIDS: set = set()
+_WORKER_BASELINES: Optional["RoleBaselines"] = None
+
+
+def _init_scoring_worker(member_puuids: set, baselines: Optional["RoleBaselines"] = None):
+    global _WORKER_MEMBER_PUUIDS, _WORKER_BASELINES
+    _WORKER_MEMBER_PUUIDS = member_puuids
+    _WORKER_BASELINES = baselines
+
+
+def score_match_batch(
+    jobs: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]],
+    member_puuids: set,
+    baselines: Optional["RoleBaselines"] = None
+) -> List[Any]:
+    """
+    Calcula várias partidas de uma vez: as métricas brutas saem partida a
+    partida (features do cache ou do timeline) e a normalização min-max +
+    final_score de todas roda junta no motor vetorizado (score_metrics_batch),
+    com os mesmos valores bit a bit de compute_metrics_for_match.
+
+    Devolve, na ordem de jobs, (metrics_rows, features, timings) de cada
+    partida, onde features só vem preenchido quando foi extraído agora do
+    timeline bruto (precisa ir para o cache) e timings tem os segundos de
+    json_parse, frame_walk e scoring (o tempo do lote dividido entre as
+    partidas); uma partida que falha (timeline malformado etc.) vem como a
+    exceção, sem derrubar as outras.
+    baselines: modo "role" (cada membro contra o baseline da rota; não há
+    min-max da partida para vetorizar).
+    """
+    t0 = time.perf_counter()
+    results: List[Any] = []
+    raw_jobs: List[Tuple[int, Dict[str, Any], List[RawMetricsRow]]] = []
+    for i, (match_row, participants) in enumerate(jobs):
+        timings: Dict[str, float] = {}
+        try:
+            features, extracted = get_timeline_features(match_row, timings)
+            temp_rows = raw_metrics_for_match(match_row, participants, member_puuids, features)
+        except Exception as exc:
+            results.append(exc)
+            continue
+        results.append(([], features if extracted else None, timings))
+        if temp_rows:
+            raw_jobs.append((i, match_row, temp_rows))
+
+    if baselines is not None:
+        for i, match_row, temp_rows in raw_jobs:
+            results[i][0].extend(role_metrics_rows(match_row, temp_rows, baselines))
+    else:
+        scores_by_match, final_by_match = score_metrics_batch(
+            [[r.metrics() for r in temp_rows] for _, _, temp_rows in raw_jobs]
+        )
+        for (i, match_row, temp_rows), scores_by_row, finals in zip(raw_jobs, scores_by_match, final_by_match):
+            results[i][0].extend(
+                member_metrics_rows(match_row["match_pk"], temp_rows, scores_by_row, finals, WEIGHTS_VERSION)
+            )
+
+    # parse/frame walk já estão nos timings de cada partida; o resto é o scoring
+    parsed = sum(
+        r[2].get("json_parse", 0.0) + r[2].get("frame_walk", 0.0)
+        for r in results if not isinstance(r, Exception)
+    )
+    scoring = max(0.0, time.perf_counter() - t0 - parsed) / max(1, len(jobs))
+    for r in results:
+        if not isinstance(r, Exception):
+            r[2]["scoring"] = scoring
+    return results
+
+
+def _score_batch_in_worker(
+    jobs: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]
+) -> List[Any]:
+    return score_match_batch(jobs, _WORKER_MEMBER_PUUIDS, _WORKER_BASELINES)
+
+
+def iter_scoring_jobs(
+    conn,
+    batch_size: int = MATCHES_BATCH_SIZE,
+    stats: Optional[RunStats] = None,
+    batches: Optional[Iterator[List[Dict[str, Any]]]] = None,
+    writer: Optional["MetricsWriter"] = None,
+    loaded: Optional[Iterator[Tuple[List[Dict[str, Any]], Dict[int, List[Dict[str, Any]]]]]] = None
+) -> Iterator[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    """
+    Gera (match_row, participants) para cada partida pendente, lendo as
+    partidas em lotes (iter_matches_to_process) e os participantes de cada
+    lote de uma vez (fetch_participants_for_matches).
+    Partidas sem participantes são puladas aqui mesmo.
+    Com stats, soma o tempo das queries em "fetch".
+    batches: lotes de partidas já definidos (padrão: iter_matches_to_process).
+    loaded: lotes já com os participantes (iter_prefetched_batches); se vier,
+    conn e batches não são usados para leitura.
+    writer: se vier, as partidas puladas também são marcadas como processadas.
+    """
+    if loaded is None:
+        if batches is None:
+            batches = iter_matches_to_process(conn, batch_size)
+        loaded = iter_loaded_batches(conn, batches, stats)
+    for batch, participants_by_match in loaded:
+        if stats is not None:
+            stats.incr("batches")
+
+        if VERBOSITY >= 1:
+            print(f"Lote com {len(batch)} partidas para processar.")
+
+        for m in batch:
+            if VERBOSITY >= 1:
+                print(f"Processando match {m['match_id_riot']} (id={m['match_pk']})...")
+            participants = participants_by_match.pop(m["match_pk"], [])
+            if not participants:
+                if VERBOSITY >= 1:
+                    print(f"  -> match {m['match_id_riot']}: sem participantes? pulando.")
+                if stats is not None:
+                    stats.incr("matches_without_participants")
+                if writer is not None:
+                    writer.add([], match_pk=m["match_pk"])
+                continue
+            yield m, participants
+
+        # libera os timelines do lote antes de buscar o próximo
+        del batch, participants_by_match
+
+
+def score_matches(
+    jobs: Iterator[Tuple[Dict[str, Any], List[Dict[str, Any]]]],
+    member_puuids: set,
+    workers: int = 1,
+    max_in_flight: Optional[int] = None,
+    baselines: Optional["RoleBaselines"] = None,
+    pool: Optional[ProcessPoolExecutor] = None,
+    on_error=None
+) -> Iterator[Tuple[Dict[str, Any], List[MetricsRow], Optional[Dict[str, Any]], Dict[str, float]]]:
+    """
+    Calcula os jobs em lotes (score_match_batch) e gera (match_row, metrics_rows,
+    features, timings), com features != None só para partidas que ainda não
+    estavam no cache.
+
+    - workers <= 1: serial, na ordem dos jobs, SCORING_BATCH_SIZE partidas
+      por lote do motor vetorizado.
+    - workers > 1: distribui lotes de partidas num pool de processos e
+      devolve os resultados na ordem em que terminam. No máximo
+      max_in_flight partidas (padrão: 4 por worker) ficam pendentes ao mesmo
+      tempo, o que limita quantos timelines ficam em memória; cada tarefa
+      leva até SCORING_BATCH_SIZE partidas, sem passar de metade do que cabe
+      por worker (max_in_flight / (2 x workers)).
+
+    O cálculo é o mesmo nos dois modos, então os scores são idênticos;
+    só muda a ordem de saída. baselines (modo "role") vai junto para os workers.
+
+    pool: pool já aberto (make_scoring_pool, com os mesmos member_puuids e
+    baselines), reaproveitado entre chamadas (ex.: micro-lotes do --watch);
+    sem ele, cria um só para esta chamada.
+    on_error(match_row, exc): se vier, o erro de uma partida (timeline
+    malformado etc.) vai para ele e a partida fica de fora, em vez de
+    interromper tudo. Um pool quebrado (worker morto) continua levantando.
+    """
+    jobs_iter = iter(jobs)
+    if workers <= 1:
+        while True:
+            chunk = list(islice(jobs_iter, max(1, SCORING_BATCH_SIZE)))
+            if not chunk:
+                return
+            for (m, _), result in zip(chunk, score_match_batch(chunk, member_puuids, baselines)):
+                if isinstance(result, Exception):
+                    if on_error is None:
+                        raise result
+                    on_error(m, result)
+                    continue
+                yield (m, *result)
+
+    if not max_in_flight or max_in_flight < 1:
+        max_in_flight = workers * 4
+    chunk_size = max(1, min(SCORING_BATCH_SIZE, max_in_flight // (2 * workers)))
+
+    pool_ctx = nullcontext(pool) if pool is not None else make_scoring_pool(workers, member_puuids, baselines)
+    with pool_ctx as pool:
+        in_flight: Dict[Any, List[Dict[str, Any]]] = {}
+        try:
+            yield from _drain_scoring_pool(pool, jobs_iter, in_flight, max_in_flight, chunk_size, on_error)
+        finally:
+            # consumidor parou antes do fim: não deixa partidas na fila de um pool compartilhado
+            for fut in in_flight:
+                fut.cancel()
+
+
+def make_scoring_pool(
+    workers: int,
+    member_puuids: set,
+    baselines: Optional["RoleBaselines"] = None
+) -> ProcessPoolExecutor:
+    """
+    Pool de processos do cálculo, com os membros e baselines já nos workers.
+    Processos criados com SCORING_START_METHOD: um fork com as threads
+    leitoras no meio de uma consulta copiaria locks (pymysql, stdout,
+    allocator) travados para dentro dos workers.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(SCORING_START_METHOD),
+        initializer=_init_scoring_worker,
+        initargs=(member_puuids, baselines),
+    )
+
+
+def _drain_scoring_pool(
+    pool: ProcessPoolExecutor,
+    jobs_iter: Iterator[Tuple[Dict[str, Any], List[Dict[str, Any]]]],
+    in_flight: Dict[Any, List[Dict[str, Any]]],
+    max_in_flight: int,
+    chunk_size: int,
+    on_error=None
+):
+    """Laço do score_matches com pool: mantém até max_in_flight partidas pendentes, em lotes de chunk_size."""
+    exhausted = False
+    pending = 0
+    while True:
+        while not exhausted and pending < max_in_flight:
+            chunk = list(islice(jobs_iter, min(chunk_size, max_in_flight - pending)))
+            if not chunk:
+                exhausted = True
+                break
+            fut = pool.submit(_score_batch_in_worker, chunk)
+            # o worker já tem os timelines; aqui só guardamos os metadados
+            in_flight[fut] = [
+                {k: v for k, v in m.items() if k not in ("timeline_json", "timeline_features_json")}
+                for m, _ in chunk
+            ]
+            pending += len(chunk)
+            del chunk
+
+        if not in_flight:
+            return
+
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for fut in done:
+            metas = in_flight.pop(fut)
+            pending -= len(metas)
+            try:
+                results = fut.result()
+            except BrokenProcessPool:
+                raise
+            except Exception as exc:
+                # o lote inteiro falhou fora do cálculo por partida (ex.: pickling)
+                if on_error is None:
+                    raise
+                results = [exc] * len(metas)
+            for m, result in zip(metas, results):
+                if isinstance(result, Exception):
+                    if on_error is None:
+                        raise result
+                    on_error(m, result)
+                    continue
+                yield (m, *result)
+
+
+# =========================
+# RANKING DE MEMBROS
+# =========================
+
+RANKING_UPSERT_SQL = """
+    INSERT INTO member_ranking_metrics (
+        member_id,
+        puuid,
+        nick,
+        tag,
+        matches_count,
+        mean_final_score,
+        sum_final_score,
+        position
+    )
+    VALUES (
+        %(member_id)s,
+        %(puuid)s,
+        %(nick)s,
+        %(tag)s,
+        %(matches_count)s,
+        %(mean_final_score)s,
+        %(sum_final_score)s,
+        %(position)s
+    )
+    ON DUPLICATE KEY UPDATE
+        puuid = VALUES(puuid),
+        nick = VALUES(nick),
+        tag  = VALUES(tag),
+        matches_count = VALUES(matches_count),
+        mean_final_score = VALUES(mean_final_score),
+        sum_final_score = VALUES(sum_final_score),
+        position = VALUES(position);
+"""
+
+
+def update_member_ranking(conn, full_rebuild: bool = False):
+    """
+    Calcula ranking por membro (apenas membros da tabela members)
+    e grava em member_ranking_metrics.
+
+    Incremental por padrão: soma nas somas/contagens guardadas só as
+    linhas de player_match_metrics acima da marca RANKING_STATE_KEY
+    (maior pmm.id já somado) e recalcula as posições. A marca avança na
+    mesma transação do ranking, então linhas gravadas por uma execução
+    que caiu antes de chegar aqui entram na próxima.
+    Com full_rebuild=True (ou sem marca), refaz tudo com GROUP BY.
+    """
+    if full_rebuild:
+        rebuild_member_ranking(conn)
+    else:
+        update_member_ranking_incremental(conn)
+
+
+def fetch_max_metrics_id(conn) -> int:
+    with conn.cursor() as cur:
+        cur.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM player_match_metrics")
+        return int(cur.fetchone()["max_id"])
+
+
+def rebuild_member_ranking(conn):
+    """
+    Reconstrução completa do ranking: agrega todo o player_match_metrics
+    (até o maior id lido no início) e grava a marca do incremental.
     """
+    max_id = fetch_max_metrics_id(conn)
+    sql = """
+        SELECT m.id AS member_id,
+               m.puuid AS puuid,
+               m.nick AS nick,
+               m.tag  AS tag,
+               COUNT(pmm.id) AS matches_count,
+               SUM(pmm.final_score) AS sum_final_score,
+               AVG(pmm.final_score) AS mean_final_score
+        FROM player_match_metrics pmm
+        JOIN members m ON m.puuid = pmm.puuid
+        WHERE pmm.id <= %s
+        GROUP BY m.id, m.puuid, m.nick, m.tag
+        ORDER BY mean_final_score DESC;
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql, (max_id,))
+        rows = cur.fetchall()
+
+    if not rows:
+        print("Nenhum dado para ranking de membros.")
+        return
+
+    ranking_rows = []
+    position = 1
+    for r in rows:
+        ranking_rows.append({
+            "member_id": r["member_id"],
+            "puuid": r["puuid"],
+            "nick": r["nick"],
+            "tag":  r["tag"],
+            "matches_count": int(r["matches_count"]),
+            "mean_final_score": float(r["mean_final_score"]),
+            "sum_final_score": float(r["sum_final_score"]),
+            "position": position,
+        })
+        position += 1
+
     with conn.cursor() as cur:
-        cur.executemany(sql_insert, ranking_rows)
+        cur.executemany(RANKING_UPSERT_SQL, ranking_rows)
+    save_job_state(conn, RANKING_STATE_KEY, max_id, commit=False)
     conn.commit()
 
     print(f"Ranking de membros atualizado para {len(ranking_rows)} membros.")
 
 
+def update_member_ranking_incremental(conn):
+    """
+    Atualização incremental do ranking: soma as linhas novas (pmm.id acima
+    da marca) nas somas e contagens já guardadas em member_ranking_metrics
+    (sum_final_score, matches_count) e reordena as posições só sobre o
+    conjunto de membros. O custo depende de quantas linhas chegaram, não
+    do histórico.
+
+    Se o estado guardado não serve (sem marca, tabela vazia ou linhas sem
+    sum_final_score, de antes dessa coluna existir), faz o rebuild completo.
+    """
+    mark = load_job_state(conn, RANKING_STATE_KEY)
+
+    sql_state = """
+        SELECT member_id, puuid, nick, tag, matches_count, sum_final_score
+        FROM member_ranking_metrics
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql_state)
+        state_rows = cur.fetchall()
+
+    if mark is None or not state_rows or any(r["sum_final_score"] is None for r in state_rows):
+        print("Ranking sem estado incremental; fazendo rebuild completo.")
+        rebuild_member_ranking(conn)
+        return
+
+    max_id = fetch_max_metrics_id(conn)
+    if max_id <= mark:
+        print("Ranking de membros sem novas partidas; nada a atualizar.")
+        return
+
+    # somas das linhas novas por membro (ativos ou não, como no rebuild)
+    sql_delta = """
+        SELECT m.id AS member_id,
+               m.puuid AS puuid,
+               m.nick AS nick,
+               m.tag  AS tag,
+               COUNT(pmm.id) AS matches_count,
+               SUM(pmm.final_score) AS sum_final_score
+        FROM player_match_metrics pmm
+        JOIN members m ON m.puuid = pmm.puuid
+        WHERE pmm.id > %s AND pmm.id <= %s
+        GROUP BY m.id, m.puuid, m.nick, m.tag
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql_delta, (mark, max_id))
+        delta_rows = cur.fetchall()
+
+    by_member: Dict[int, Dict[str, Any]] = {}
+    for r in state_rows:
+        by_member[r["member_id"]] = {
+            "member_id": r["member_id"],
+            "puuid": r["puuid"],
+            "nick": r["nick"],
+            "tag": r["tag"],
+            "matches_count": int(r["matches_count"]),
+            "sum_final_score": float(r["sum_final_score"]),
+        }
+
+    new_rows = 0
+    for dr in delta_rows:
+        s = by_member.setdefault(dr["member_id"], {
+            "member_id": dr["member_id"],
+            "matches_count": 0,
+            "sum_final_score": 0.0,
+        })
+        s["puuid"] = dr["puuid"]
+        s["nick"] = dr["nick"]
+        s["tag"] = dr["tag"]
+        s["matches_count"] += int(dr["matches_count"])
+        s["sum_final_score"] += float(dr["sum_final_score"])
+        new_rows += int(dr["matches_count"])
+
+    ranking_rows = []
+    for s in by_member.values():
+        s["mean_final_score"] = s["sum_final_score"] / s["matches_count"]
+        ranking_rows.append(s)
+
+    ranking_rows.sort(key=lambda x: (-x["mean_final_score"], x["member_id"]))
+    for position, r in enumerate(ranking_rows, start=1):
+        r["position"] = position
+
+    with conn.cursor() as cur:
+        cur.executemany(RANKING_UPSERT_SQL, ranking_rows)
+    save_job_state(conn, RANKING_STATE_KEY, max_id, commit=False)
+    conn.commit()
+
+    print(
+        f"Ranking de membros atualizado (incremental: {new_rows} novas linhas, "
+        f"{len(delta_rows)} membros afetados, {len(ranking_rows)} no ranking)."
+    )
+
+
+# =========================
+# ESCRITA DOS EXPORTS (CSV + Parquet opcional)
+# =========================
+
+# tipos das colunas do export de métricas no Parquet (na ordem de ExportRow)
+METRICS_EXPORT_PARQUET_TYPES = {
+    "metrics_id": "int64",
+    "match_pk": "int64",
+    "match_riot_id": "string",
+    "puuid": "string",
+    "nick": "string",
+    "tag": "string",
+    "team_position": "string",
+    "win": "int8",
+    "champion_name": "string",
+    **{key: "float64" for key in METRIC_KEYS},
+    "final_score": "float64",
+    "created_at": "string",
+    "patch": "string",
+    "game_creation": "int64",
+}
+
+
+def parquet_path_for(path: Path) -> Path:
+    return path.with_suffix(".parquet")
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError("export Parquet pedido, mas o pyarrow não está instalado (pip install pyarrow).")
+
+
+def sha256_file(path: Path) -> Optional[str]:
+    """sha256 do arquivo (hex), ou None se ele não existir."""
+    if not path.exists():
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# arquivos gravados nesta execução: {caminho: {sha256, bytes, rows, changed}}
+_EXPORTS_WRITTEN: Dict[Path, Dict[str, Any]] = {}
+
+
+class AtomicExportFile:
+    """
+    Grava um export num arquivo temporário no mesmo diretório e, ao sair do
+    with sem erro, troca pelo destino com os.replace (atômico): quem lê
+    nunca vê um arquivo pela metade. Se o conteúdo novo tiver o mesmo
+    sha256 do arquivo atual, descarta o temporário e deixa o destino
+    intocado (mtime/ETag preservados, sem invalidar cache à toa).
+
+    Com text=True, self.file é o arquivo texto aberto (csv/json); com
+    text=False, quem chama escreve direto em self.tmp_path (ex.: Parquet).
+    Quem escreve linhas de dados atualiza self.rows, que vai pro manifesto.
+    """
+
+    def __init__(self, path: Path, text: bool = True):
+        self.path = path
+        self.tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        self.text = text
+        self.file = None
+        self.rows: Optional[int] = None
+        self.changed = False
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.text:
+            self.file = open(self.tmp_path, "w", newline="", encoding="utf-8")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if exc_type is not None:
+            self.tmp_path.unlink(missing_ok=True)
+            return False
+        self.commit()
+        return False
+
+    def commit(self):
+        new_hash = sha256_file(self.tmp_path)
+        size = self.tmp_path.stat().st_size
+        self.changed = new_hash != sha256_file(self.path)
+        if self.changed:
+            os.replace(self.tmp_path, self.path)
+        else:
+            self.tmp_path.unlink()
+
+        _EXPORTS_WRITTEN[self.path] = {
+            "sha256": new_hash,
+            "bytes": size,
+            "rows": self.rows,
+            "changed": self.changed,
+        }
+
+
+def write_export_manifest(path: Path = EXPORT_MANIFEST_PATH):
+    """
+    Atualiza o manifesto dos exports com os arquivos gravados nesta execução
+    (sha256, bytes, linhas e updated_at, que só muda quando o conteúdo muda).
+    Entradas de execuções anteriores continuam enquanto o arquivo existir.
+    O próprio manifesto passa pelo AtomicExportFile: sem mudanças, fica igual.
+    """
+    if not _EXPORTS_WRITTEN and not path.exists():
+        return
+
+    base = path.parent
+    files: Dict[str, Dict[str, Any]] = {}
+    if path.exists():
+        with open(path, encoding="utf-8") as f:
+            files = json.load(f).get("files", {})
+
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+    changed = 0
+    for file_path, info in _EXPORTS_WRITTEN.items():
+        try:
+            key = file_path.relative_to(base).as_posix()
+        except ValueError:
+            key = str(file_path)
+        previous = files.get(key, {})
+        if info["changed"] or previous.get("sha256") != info["sha256"]:
+            changed += 1
+            updated_at = now
+        else:
+            updated_at = previous.get("updated_at", now)
+        files[key] = {
+            "sha256": info["sha256"],
+            "bytes": info["bytes"],
+            "rows": info["rows"],
+            "updated_at": updated_at,
+        }
+
+    # remove arquivos que não existem mais (ex.: páginas antigas dos pacotes)
+    files = {k: v for k, v in sorted(files.items()) if (base / k).exists()}
+    unchanged = len(_EXPORTS_WRITTEN) - changed
+
+    with AtomicExportFile(path) as out:
+        json.dump({"files": files}, out.file, ensure_ascii=False, indent=2, sort_keys=True)
+        out.file.write("\n")
+
+    print(
+        f"Manifesto de exports: {changed} arquivos alterados, "
+        f"{unchanged} sem mudanças ({path})"
+    )
+    _EXPORTS_WRITTEN.clear()
+
+
+def write_export_rows(path: Path, fieldnames: List[str], rows: List[Dict[str, Any]]):
+    """
+    Grava um export (lista de dicts) em CSV e, com EXPORT_PARQUET, também
+    em Parquet no mesmo caminho com extensão .parquet. No Parquet os tipos
+    vêm dos valores (int/float/str), com as colunas na ordem de fieldnames.
+    """
+    with AtomicExportFile(path) as out:
+        writer = csv.DictWriter(out.file, fieldnames=fieldnames)
+        writer.writeheader()
+        for r in rows:
+            writer.writerow(r)
+        out.rows = len(rows)
+
+    if EXPORT_PARQUET:
+        _require_pyarrow()
+        table = pa.Table.from_pylist([{k: r.get(k) for k in fieldnames} for r in rows])
+        with AtomicExportFile(parquet_path_for(path), text=False) as out:
+            pq.write_table(table, out.tmp_path, compression=PARQUET_COMPRESSION)
+            out.rows = len(rows)
+
+
+class ParquetRowWriter:
+    """
+    Escreve linhas (dicts, ou tuplas na ordem das colunas de types, como
+    ExportRow) num Parquet em row groups de batch_rows linhas,
+    sem segurar o arquivo todo em memória. types: {coluna: tipo pyarrow}.
+    Grava via AtomicExportFile: o destino só é trocado no close().
+    """
+
+    def __init__(self, path: Path, types: Dict[str, str], batch_rows: int = EXPORT_FETCH_SIZE):
+        _require_pyarrow()
+        self.path = path
+        self.schema = pa.schema([(name, pa.type_for_alias(t)) for name, t in types.items()])
+        self.batch_rows = max(1, batch_rows)
+        self._columns: Dict[str, List[Any]] = {name: [] for name in types}
+        self._pending = 0
+        self.rows = 0
+        self._out = AtomicExportFile(path, text=False).__enter__()
+        self._writer = pq.ParquetWriter(self._out.tmp_path, self.schema, compression=PARQUET_COMPRESSION)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def add(self, row):
+        if isinstance(row, dict):
+            row = [row.get(name) for name in self._columns]
+        for values, value in zip(self._columns.values(), row):
+            values.append(value)
+        self._pending += 1
+        self.rows += 1
+        if self._pending >= self.batch_rows:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(self._columns[f.name], type=f.type) for f in self.schema],
+            schema=self.schema,
+        )
+        self._writer.write_batch(batch)
+        for values in self._columns.values():
+            values.clear()
+        self._pending = 0
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._flush()
+        self._writer.close()
+        self._writer = None
+        self._out.rows = self.rows
+        self._out.__exit__(None, None, None)
+
+    def abort(self):
+        """Descarta o temporário sem tocar no destino."""
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+        self._out.tmp_path.unlink(missing_ok=True)
+
+
+def iter_metrics_export(path: Path, batch_rows: int = EXPORT_FETCH_SIZE) -> Iterator[ExportRow]:
+    """
+    Relê um export de métricas já gravado (Parquet ou CSV) como as mesmas
+    linhas (ExportRow) que export_metrics_to_csv passa para o
+    MetricsAggregator, para refazer os rankings sem tocar no MySQL.
+    """
+    if path.suffix == ".parquet":
+        _require_pyarrow()
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=batch_rows):
+            for r in batch.to_pylist():
+                yield ExportRow.from_export(r)
+        return
+
+    with open(path, newline="", encoding="utf-8") as f:
+        for r in csv.DictReader(f):
+            yield ExportRow.from_export(r)
+
+
+# =========================
+# TOP-K E VARIAÇÃO DE POSIÇÃO
+# =========================
+
+# snapshot lido do disco (uma vez por execução) e as posições desta execução:
+# {ranking: {"positions": {chave: posição}, "previous": {chave: posição}}}
+_RANKING_SNAPSHOT: Optional[Dict[str, Any]] = None
+_RANKING_POSITIONS: Dict[str, Dict[str, Any]] = {}
+
+
+def top_ranked(rows: List[Dict[str, Any]], key, top_k: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Ordena do maior para o menor por key e numera a coluna position.
+    Com top_k (padrão RANKING_TOP_K) > 0 só os K primeiros, por heap
+    (O(n log K) em vez de ordenar tudo); empates na mesma ordem do sort.
+    """
+    if top_k is None:
+        top_k = RANKING_TOP_K
+    if 0 < top_k < len(rows):
+        rows = heapq.nlargest(top_k, rows, key=key)
+    else:
+        rows = sorted(rows, key=key, reverse=True)
+    for pos, r in enumerate(rows, start=1):
+        r["position"] = pos
+    return rows
+
+
+def _load_ranking_snapshot(path: Path) -> Dict[str, Any]:
+    global _RANKING_SNAPSHOT
+    if _RANKING_SNAPSHOT is None:
+        _RANKING_SNAPSHOT = {}
+        if path.exists():
+            with open(path, encoding="utf-8") as f:
+                _RANKING_SNAPSHOT = json.load(f).get("rankings", {})
+    return _RANKING_SNAPSHOT
+
+
+def apply_position_deltas(
+    name: str,
+    rows: List[Dict[str, Any]],
+    key_fields: Tuple[str, ...],
+    path: Path = RANKING_SNAPSHOT_PATH
+):
+    """
+    Preenche positionDelta (posição anterior - atual: positivo = subiu;
+    None = não estava no ranking) comparando por chave com o snapshot da
+    última execução, sem reconsultar o banco. Se o ranking não mudou desde
+    o snapshot, compara com o anterior a ele: a variação não zera só
+    porque os exports foram regravados (ex.: --watch).
+    """
+    entry = _load_ranking_snapshot(path).get(name, {})
+    positions = {"|".join(str(r[f]) for f in key_fields): r["position"] for r in rows}
+    if positions == entry.get("positions"):
+        base = entry.get("previous", {})
+    else:
+        base = entry.get("positions", {})
+
+    for r, (k, position) in zip(rows, positions.items()):
+        previous = base.get(k)
+        r["positionDelta"] = previous - position if previous is not None else None
+
+    _RANKING_POSITIONS[name] = {"positions": positions, "previous": base}
+
+
+def write_ranking_snapshot(path: Path = RANKING_SNAPSHOT_PATH):
+    """Grava as posições desta execução (rankings não exportados agora ficam como estavam)."""
+    global _RANKING_SNAPSHOT
+    if not _RANKING_POSITIONS:
+        return
+    rankings = dict(_load_ranking_snapshot(path))
+    rankings.update(_RANKING_POSITIONS)
+
+    with AtomicExportFile(path) as out:
+        json.dump({"rankings": rankings}, out.file, ensure_ascii=False, sort_keys=True)
+        out.file.write("\n")
+
+    _RANKING_POSITIONS.clear()
+    _RANKING_SNAPSHOT = None
+
+
 # =========================
 # EXPORTAR CSV (OPCIONAL)
 # =========================
 
-def export_metrics_to_csv(conn, path: Path = CSV_METRICS_EXPORT_PATH):
+def export_metrics_to_csv(
+    conn,
+    path: Path = CSV_METRICS_EXPORT_PATH,
+    aggregator: Optional["MetricsAggregator"] = None,
+    chunk_size: int = EXPORT_FETCH_SIZE,
+    match_groups: Optional["MatchGroupStream"] = None
+) -> "MetricsAggregator":
     """
     Exporta uma visão 'rica' de player_match_metrics para CSV:
     - junta com match_participants, matches e members
     - inclui nick, tag, team_position, win, champion, match_riot_id, created_at etc.
 
-    Retorna a lista de rows já normalizada (win=0/1 e created_at em ISO)
-    para reutilizar nos rankings sem novas queries.
+    Em streaming: lê com cursor do lado do servidor (SSDictCursor) em blocos
+    de chunk_size, escreve cada linha no CSV assim que chega e passa a
+    mesma linha (ExportRow.from_db: win=0/1 e created_at em ISO) para o
+    aggregator, sem guardar a lista inteira em memória.
+    Com EXPORT_PARQUET, grava junto o .parquet tipado (ParquetRowWriter).
+    Com match_groups, as mesmas linhas alimentam o group-by por partida
+    (a ordem created_at DESC, match_pk DESC deixa as linhas de cada
+    partida juntas); quem chama fecha o stream.
+
+    Retorna o MetricsAggregator alimentado (novo, se não veio nenhum),
+    para os rankings sem novas queries.
     """
+    if aggregator is None:
+        aggregator = MetricsAggregator()
+
     sql = """
         SELECT
             pmm.id                          AS metrics_id,
@@ -598,7 +2989,9 @@ def export_metrics_to_csv(conn, path: Path = CSV_METRICS_EXPORT_PATH):
             pmm.vision_per_min              AS vision_per_min,
             pmm.cc_per_min                  AS cc_per_min,
             pmm.final_score                 AS final_score,
-            pmm.created_at                  AS created_at
+            pmm.created_at                  AS created_at,
+            mt.game_version                 AS game_version,
+            mt.game_creation                AS game_creation
         FROM player_match_metrics pmm
         JOIN match_participants mp
           ON pmm.match_participant_id = mp.id
@@ -606,83 +2999,44 @@ def export_metrics_to_csv(conn, path: Path = CSV_METRICS_EXPORT_PATH):
           ON pmm.match_id = mt.id
         LEFT JOIN members mem
           ON mem.puuid = pmm.puuid
-        ORDER BY pmm.created_at DESC;
+        ORDER BY pmm.created_at DESC, pmm.match_id DESC;
     """
 
-    with conn.cursor() as cur:
-        cur.execute(sql)
-        rows = cur.fetchall()
-
-    if not rows:
-        print("Nenhum dado em player_match_metrics para exportar.")
-        return []
-
-    import csv
-
-    path.parent.mkdir(parents=True, exist_ok=True)
-
-    fieldnames = [
-        "metrics_id",
-        "match_pk",
-        "match_riot_id",
-        "puuid",
-        "nick",
-        "tag",
-        "team_position",
-        "win",
-        "champion_name",
-        "kda",
-        "dmg_per_min",
-        "gold_per_min",
-        "cs_per_min",
-        "kp",
-        "dmg_taken_per_min",
-        "deaths_per_min",
-        "xp_per_min",
-        "vision_per_min",
-        "cc_per_min",
-        "final_score",
-        "created_at",
-    ]
-
-    exported_rows = []
-
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for r in rows:
-            win_flag = win_to_int(r["win"])
-            created_at_iso = r["created_at"].isoformat() if r["created_at"] else ""
-
-            out_row = {
-                "metrics_id": r["metrics_id"],
-                "match_pk": r["match_pk"],
-                "match_riot_id": r["match_riot_id"],
-                "puuid": r["puuid"],
-                "nick": r["nick"] or "",
-                "tag": r["tag"] or "",
-                "team_position": r["team_position"] or "",
-                "win": win_flag,
-                "champion_name": r["champion_name"],
-                "kda": r["kda"],
-                "dmg_per_min": r["dmg_per_min"],
-                "gold_per_min": r["gold_per_min"],
-                "cs_per_min": r["cs_per_min"],
-                "kp": r["kp"],
-                "dmg_taken_per_min": r["dmg_taken_per_min"],
-                "deaths_per_min": r["deaths_per_min"],
-                "xp_per_min": r["xp_per_min"],
-                "vision_per_min": r["vision_per_min"],
-                "cc_per_min": r["cc_per_min"],
-                "final_score": r["final_score"],
-                "created_at": created_at_iso,
-            }
-
-            writer.writerow(out_row)
-            exported_rows.append(out_row)
+    chunk_size = max(1, chunk_size)
 
-    print(f"Exportado CSV de métricas para: {path}")
-    return exported_rows
+    with conn.cursor(pymysql.cursors.SSDictCursor) as cur:
+        cur.execute(sql)
+        rows = cur.fetchmany(chunk_size)
+
+        if not rows:
+            print("Nenhum dado em player_match_metrics para exportar.")
+            return aggregator
+
+        parquet_ctx = nullcontext()
+        if EXPORT_PARQUET:
+            parquet_ctx = ParquetRowWriter(
+                parquet_path_for(path), METRICS_EXPORT_PARQUET_TYPES, batch_rows=chunk_size
+            )
+
+        with AtomicExportFile(path) as out, parquet_ctx as parquet_writer:
+            writer = csv.writer(out.file)
+            writer.writerow(ExportRow._fields)
+            out.rows = 0
+            while rows:
+                for r in rows:
+                    out_row = ExportRow.from_db(r)
+                    writer.writerow(out_row)
+                    if parquet_writer is not None:
+                        parquet_writer.add(out_row)
+                    aggregator.add(out_row)
+                    if match_groups is not None:
+                        match_groups.add(out_row)
+                    out.rows += 1
+
+                rows = cur.fetchmany(chunk_size)
+
+    print(f"Exportado CSV de métricas para: {path} ({out.rows} linhas)")
+    return aggregator
 
 
 def export_ranking_to_csv(conn, path: Path = CSV_RANKING_EXPORT_PATH):
@@ -702,6 +3056,8 @@ def export_ranking_to_csv(conn, path: Path = CSV_RANKING_EXPORT_PATH):
         FROM member_ranking_metrics
         ORDER BY position ASC
     """
+    if RANKING_TOP_K > 0:
+        sql += f" LIMIT {int(RANKING_TOP_K)}"
 
     with conn.cursor() as cur:
         cur.execute(sql)
@@ -711,50 +3067,205 @@ def export_ranking_to_csv(conn, path: Path = CSV_RANKING_EXPORT_PATH):
         print("Nenhum dado em member_ranking_metrics para exportar.")
         return
 
-    import csv
+    rows_out = [
+        {
+            "position": r["position"],
+            "nick": r["nick"],
+            "tag":  r["tag"],
+            "puuid": r["puuid"],
+            "matches": r["matches_count"],
+            "meanFinalScore": r["mean_final_score"],
+        }
+        for r in rows
+    ]
+    apply_position_deltas("member_ranking", rows_out, ("puuid",))
+
+    fieldnames = ["position", "positionDelta", "nick", "tag", "puuid", "matches", "meanFinalScore"]
+    write_export_rows(path, fieldnames, rows_out)
 
-    path.parent.mkdir(parents=True, exist_ok=True)
+    print(f"Exportado CSV de ranking para: {path}")
 
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        fieldnames = ["position", "nick", "tag", "puuid", "matches", "meanFinalScore"]
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
 
+# =========================
+# NOVOS RANKINGS (sem novas queries)
+# =========================
+
+# posições na ordem do ranking por team_position
+POSITIONS = ["TOP", "JG", "MID", "ADC", "SUP"]
+
+
+def map_team_position(tp: str) -> str:
+    s = (tp or "").strip().upper()
+    if s in ("JUNGLE", "JG"):
+        return "JG"
+    if s in ("MIDDLE", "MID"):
+        return "MID"
+    if s in ("BOTTOM", "ADC"):
+        return "ADC"
+    if s in ("UTILITY", "SUP", "SUPPORT"):
+        return "SUP"
+    if s in ("TOP",):
+        return "TOP"
+    return s
+
+
+class MetricsAggregator:
+    """
+    Agregação única para todos os rankings exportados: cada linha de
+    export_metrics_to_csv (ExportRow) passa por add() uma vez (com os
+    float() feitos uma vez só) e alimenta ao mesmo tempo os acumuladores
+    por jogador, por jogador+posição e por campeão.
+
+    Por jogador também ficam buckets diários e por patch ([partidas, soma
+    de final_score]), base dos rankings por janela (daily_prefix_sums).
+
+    Nada aqui cresce por partida: os exports agrupados por partida saem em
+    streaming (MatchGroupStream) na mesma passada do export de métricas.
+
+    Os export_ranking_* só renderizam a partir daqui. As somas seguem a
+    ordem das linhas, então os resultados são os mesmos de antes.
+    """
+
+    def __init__(self):
+        self.rows_count = 0
+        # (puuid, nick, tag) -> somas de KDA, dano/min e final_score
+        self.players: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        # (team_position mapeada, puuid) -> soma de final_score
+        self.positions: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # champion_name -> partidas, vitórias, somas
+        self.champions: Dict[str, Dict[str, Any]] = {}
+
+    def add(self, r: ExportRow):
+        self.rows_count += 1
+
+        puuid = r.puuid
+        nick = r.nick
+        tag = r.tag
+        win = int(r.win)
+        kda = float(r.kda)
+        dmg_per_min = float(r.dmg_per_min)
+        final_score = float(r.final_score)
+
+        # ---- por jogador ----
+        key = (puuid, nick, tag)
+        p = self.players.get(key)
+        if p is None:
+            p = self.players[key] = {
+                "puuid": puuid, "nick": nick, "tag": tag,
+                "matches": 0, "sumKDA": 0.0, "sumDmg": 0.0, "sumFinalScore": 0.0,
+                "days": {}, "patches": {},
+            }
+        p["matches"] += 1
+        p["sumKDA"] += kda
+        p["sumDmg"] += dmg_per_min
+        p["sumFinalScore"] += final_score
+
+        # ---- buckets por dia da partida (game_creation, UTC) e por patch ----
+        day = game_day(r.game_creation, r.created_at)
+        if day:
+            bucket = p["days"].get(day)
+            if bucket is None:
+                bucket = p["days"][day] = [0, 0.0]
+            bucket[0] += 1
+            bucket[1] += final_score
+        if r.patch:
+            bucket = p["patches"].get(r.patch)
+            if bucket is None:
+                bucket = p["patches"][r.patch] = [0, 0.0]
+            bucket[0] += 1
+            bucket[1] += final_score
+
+        # ---- por jogador + posição ----
+        tp = map_team_position(r.team_position)
+        key_pos = (tp, puuid)
+        ps = self.positions.get(key_pos)
+        if ps is None:
+            ps = self.positions[key_pos] = {
+                "team_position": tp,
+                "puuid": puuid,
+                "nick_tag": f"{nick}#{tag}" if tag else nick,
+                "matches": 0,
+                "sumFinalScore": 0.0,
+            }
+        ps["matches"] += 1
+        ps["sumFinalScore"] += final_score
+
+        # ---- por campeão ----
+        champ = r.champion_name
+        c = self.champions.get(champ)
+        if c is None:
+            c = self.champions[champ] = {
+                "champion_name": champ, "matches": 0, "wins": 0, "sumFinalScore": 0.0, "sumKDA": 0.0,
+            }
+        c["matches"] += 1
+        c["wins"] += win
+        c["sumFinalScore"] += final_score
+        c["sumKDA"] += kda
+
+    def add_all(self, rows) -> "MetricsAggregator":
+        """Aceita ExportRow ou dicts com as colunas do export (convertidos aqui)."""
         for r in rows:
-            writer.writerow({
-                "position": r["position"],
-                "nick": r["nick"],
-                "tag":  r["tag"],
-                "puuid": r["puuid"],
-                "matches": r["matches_count"],
-                "meanFinalScore": r["mean_final_score"],
-            })
+            self.add(r if isinstance(r, ExportRow) else ExportRow.from_export(r))
+        return self
 
-    print(f"Exportado CSV de ranking para: {path}")
+    def daily_prefix_sums(self) -> Dict[Tuple[str, str, str], "PrefixSums"]:
+        """Índice por jogador (puuid, nick, tag) para consultar qualquer janela de dias."""
+        return {key: PrefixSums(p["days"]) for key, p in self.players.items() if p["days"]}
+
+    def recent_patches(self, n: int) -> List[str]:
+        """Os n patches mais recentes (ordem de versão, "14.10" depois de "14.9")."""
+        patches = {patch for p in self.players.values() for patch in p["patches"]}
+
+        def version_key(patch: str):
+            return tuple(int(x) if x.isdigit() else 0 for x in patch.split("."))
 
+        return sorted(patches, key=version_key, reverse=True)[:max(0, n)]
+
+
+class PrefixSums:
+    """
+    Somas acumuladas dos buckets diários de um jogador: days ordenados e
+    cum_matches[i] / cum_score[i] = totais dos dias antes de days[i]. Uma
+    janela [start, end] sai de duas buscas binárias e uma subtração, sem
+    voltar às linhas de métricas.
+    """
+
+    __slots__ = ("days", "cum_matches", "cum_score")
+
+    def __init__(self, buckets: Dict[str, List[Any]]):
+        self.days = sorted(buckets)
+        self.cum_matches = [0]
+        self.cum_score = [0.0]
+        for day in self.days:
+            matches, total = buckets[day]
+            self.cum_matches.append(self.cum_matches[-1] + matches)
+            self.cum_score.append(self.cum_score[-1] + total)
+
+    def window(self, start: str, end: str) -> Tuple[int, float]:
+        """(partidas, soma de final_score) entre os dias start e end (ISO, inclusivos)."""
+        lo = bisect.bisect_left(self.days, start)
+        hi = bisect.bisect_right(self.days, end)
+        return self.cum_matches[hi] - self.cum_matches[lo], self.cum_score[hi] - self.cum_score[lo]
+
+
+def as_metrics_aggregator(metrics_rows) -> "MetricsAggregator":
+    """
+    Os exporters aceitam tanto o MetricsAggregator já preenchido quanto
+    a lista de linhas de export_metrics_to_csv (agrega na hora).
+    """
+    if isinstance(metrics_rows, MetricsAggregator):
+        return metrics_rows
+    return MetricsAggregator().add_all(metrics_rows or [])
 
-# =========================
-# NOVOS RANKINGS (sem novas queries)
-# =========================
 
 def export_ranking_kda_mean_to_csv(metrics_rows, path: Path = CSV_RANKING_KDA_MEAN_EXPORT_PATH):
-    if not metrics_rows:
+    agg = as_metrics_aggregator(metrics_rows)
+    if not agg.rows_count:
         print("Nenhum dado para ranking de KDA médio.")
         return
 
-    import csv
-
-    agg = {}
-    for r in metrics_rows:
-        key = (r["puuid"], r["nick"], r["tag"])
-        if key not in agg:
-            agg[key] = {"puuid": r["puuid"], "nick": r["nick"], "tag": r["tag"], "matches": 0, "sumKDA": 0.0, "sumFinalScore": 0.0}
-        agg[key]["matches"] += 1
-        agg[key]["sumKDA"] += float(r["kda"])
-        agg[key]["sumFinalScore"] += float(r["final_score"])
-
     rows_out = []
-    for _, s in agg.items():
+    for s in agg.players.values():
         matches = s["matches"]
         rows_out.append({
             "nick": s["nick"],
@@ -765,67 +3276,25 @@ def export_ranking_kda_mean_to_csv(metrics_rows, path: Path = CSV_RANKING_KDA_ME
             "meanKDA": s["sumKDA"] / matches,
         })
 
-    rows_out.sort(key=lambda x: x["meanKDA"], reverse=True)
+    rows_out = top_ranked(rows_out, key=lambda x: x["meanKDA"])
+    apply_position_deltas("kda_mean", rows_out, ("puuid", "nick", "tag"))
 
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        fieldnames = ["position", "nick", "tag", "puuid", "matches", "meanFinalScore", "meanKDA"]
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        pos = 1
-        for r in rows_out:
-            r["position"] = pos
-            writer.writerow(r)
-            pos += 1
+    fieldnames = ["position", "positionDelta", "nick", "tag", "puuid", "matches", "meanFinalScore", "meanKDA"]
+    write_export_rows(path, fieldnames, rows_out)
 
     print(f"Exportado CSV ranking KDA médio para: {path}")
 
 
 def export_ranking_position_score_to_csv(metrics_rows, path: Path = CSV_RANKING_POSITION_SCORE_EXPORT_PATH):
-    if not metrics_rows:
+    agg = as_metrics_aggregator(metrics_rows)
+    if not agg.rows_count:
         print("Nenhum dado para ranking por posição (team_position).")
         return
 
-    import csv
-
-    def map_pos(tp: str) -> str:
-        s = (tp or "").strip().upper()
-        if s in ("JUNGLE", "JG"):
-            return "JG"
-        if s in ("MIDDLE", "MID"):
-            return "MID"
-        if s in ("BOTTOM", "ADC"):
-            return "ADC"
-        if s in ("UTILITY", "SUP", "SUPPORT"):
-            return "SUP"
-        if s in ("TOP",):
-            return "TOP"
-        return s
-
-    pos_order = {"TOP": 0, "JG": 1, "MID": 2, "ADC": 3, "SUP": 4}
-
-    agg = {}
-    for r in metrics_rows:
-        tp = map_pos(r["team_position"])
-        puuid = r["puuid"]
-        nick = r["nick"]
-        tag = r["tag"]
-
-        key = (tp, puuid)
-        if key not in agg:
-            agg[key] = {
-                "team_position": tp,
-                "puuid": puuid,
-                "nick_tag": f"{nick}#{tag}" if tag else nick,
-                "matches": 0,
-                "sumFinalScore": 0.0,
-            }
-
-        agg[key]["matches"] += 1
-        agg[key]["sumFinalScore"] += float(r["final_score"])
+    pos_order = {tp: i for i, tp in enumerate(POSITIONS)}
 
-    by_pos = {"TOP": [], "JG": [], "MID": [], "ADC": [], "SUP": []}
-    for (_, _), s in agg.items():
+    by_pos = {tp: [] for tp in POSITIONS}
+    for s in agg.positions.values():
         tp = s["team_position"]
         if tp not in by_pos:
             continue
@@ -839,45 +3308,25 @@ def export_ranking_position_score_to_csv(metrics_rows, path: Path = CSV_RANKING_
         })
 
     rows_out = []
-    for tp in ["TOP", "JG", "MID", "ADC", "SUP"]:
-        players = by_pos[tp]
-        players.sort(key=lambda x: x["meanFinalScore"], reverse=True)
-        pos = 1
-        for p in players:
-            p["position"] = pos
-            rows_out.append(p)
-            pos += 1
+    for tp in POSITIONS:
+        rows_out.extend(top_ranked(by_pos[tp], key=lambda x: x["meanFinalScore"]))
 
     rows_out.sort(key=lambda x: (pos_order.get(x["team_position"], 99), x["position"]))
+    apply_position_deltas("position_score", rows_out, ("team_position", "puuid", "nick"))
 
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        fieldnames = ["team_position", "position", "nick", "matches", "meanFinalScore", "puuid"]
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for r in rows_out:
-            writer.writerow(r)
+    fieldnames = ["team_position", "position", "positionDelta", "nick", "matches", "meanFinalScore", "puuid"]
+    write_export_rows(path, fieldnames, rows_out)
 
     print(f"Exportado CSV ranking por posição (player rank por team_position) para: {path}")
 
 def export_ranking_damage_mean_to_csv(metrics_rows, path: Path = CSV_RANKING_DAMAGE_MEAN_EXPORT_PATH):
-    if not metrics_rows:
+    agg = as_metrics_aggregator(metrics_rows)
+    if not agg.rows_count:
         print("Nenhum dado para ranking de dano médio.")
         return
 
-    import csv
-
-    agg = {}
-    for r in metrics_rows:
-        key = (r["puuid"], r["nick"], r["tag"])
-        if key not in agg:
-            agg[key] = {"puuid": r["puuid"], "nick": r["nick"], "tag": r["tag"], "matches": 0, "sumDmg": 0.0, "sumFinalScore": 0.0}
-        agg[key]["matches"] += 1
-        agg[key]["sumDmg"] += float(r["dmg_per_min"])
-        agg[key]["sumFinalScore"] += float(r["final_score"])
-
     rows_out = []
-    for _, s in agg.items():
+    for s in agg.players.values():
         matches = s["matches"]
         rows_out.append({
             "nick": s["nick"],
@@ -888,41 +3337,23 @@ def export_ranking_damage_mean_to_csv(metrics_rows, path: Path = CSV_RANKING_DAM
             "meanDmgPerMin": s["sumDmg"] / matches,
         })
 
-    rows_out.sort(key=lambda x: x["meanDmgPerMin"], reverse=True)
+    rows_out = top_ranked(rows_out, key=lambda x: x["meanDmgPerMin"])
+    apply_position_deltas("damage_mean", rows_out, ("puuid", "nick", "tag"))
 
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        fieldnames = ["position", "nick", "tag", "puuid", "matches", "meanFinalScore", "meanDmgPerMin"]
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        pos = 1
-        for r in rows_out:
-            r["position"] = pos
-            writer.writerow(r)
-            pos += 1
+    fieldnames = ["position", "positionDelta", "nick", "tag", "puuid", "matches", "meanFinalScore", "meanDmgPerMin"]
+    write_export_rows(path, fieldnames, rows_out)
 
     print(f"Exportado CSV ranking dano médio para: {path}")
 
 
 def export_ranking_champion_winrate_to_csv(metrics_rows, path: Path = CSV_RANKING_CHAMPION_WINRATE_EXPORT_PATH):
-    if not metrics_rows:
+    agg = as_metrics_aggregator(metrics_rows)
+    if not agg.rows_count:
         print("Nenhum dado para ranking winrate por campeão.")
         return
 
-    import csv
-
-    agg = {}
-    for r in metrics_rows:
-        champ = r["champion_name"]
-        if champ not in agg:
-            agg[champ] = {"champion_name": champ, "matches": 0, "wins": 0, "sumFinalScore": 0.0, "sumKDA": 0.0}
-        agg[champ]["matches"] += 1
-        agg[champ]["wins"] += int(r["win"])
-        agg[champ]["sumFinalScore"] += float(r["final_score"])
-        agg[champ]["sumKDA"] += float(r["kda"])
-
     rows_out = []
-    for _, s in agg.items():
+    for s in agg.champions.values():
         matches = s["matches"]
         wins = s["wins"]
         rows_out.append({
@@ -934,41 +3365,23 @@ def export_ranking_champion_winrate_to_csv(metrics_rows, path: Path = CSV_RANKIN
             "meanKDA": s["sumKDA"] / matches,
         })
 
-    rows_out.sort(key=lambda x: x["winRate"], reverse=True)
+    rows_out = top_ranked(rows_out, key=lambda x: x["winRate"])
+    apply_position_deltas("champion_winrate", rows_out, ("champion_name",))
 
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        fieldnames = ["position", "champion_name", "matches", "wins", "winRate", "meanFinalScore", "meanKDA"]
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        pos = 1
-        for r in rows_out:
-            r["position"] = pos
-            writer.writerow(r)
-            pos += 1
+    fieldnames = ["position", "positionDelta", "champion_name", "matches", "wins", "winRate", "meanFinalScore", "meanKDA"]
+    write_export_rows(path, fieldnames, rows_out)
 
     print(f"Exportado CSV ranking winrate por campeão para: {path}")
 
 
 def export_ranking_champion_kda_to_csv(metrics_rows, path: Path = CSV_RANKING_CHAMPION_KDA_EXPORT_PATH):
-    if not metrics_rows:
+    agg = as_metrics_aggregator(metrics_rows)
+    if not agg.rows_count:
         print("Nenhum dado para ranking KDA por campeão.")
         return
 
-    import csv
-
-    agg = {}
-    for r in metrics_rows:
-        champ = r["champion_name"]
-        if champ not in agg:
-            agg[champ] = {"champion_name": champ, "matches": 0, "wins": 0, "sumFinalScore": 0.0, "sumKDA": 0.0}
-        agg[champ]["matches"] += 1
-        agg[champ]["wins"] += int(r["win"])
-        agg[champ]["sumFinalScore"] += float(r["final_score"])
-        agg[champ]["sumKDA"] += float(r["kda"])
-
     rows_out = []
-    for _, s in agg.items():
+    for s in agg.champions.values():
         matches = s["matches"]
         wins = s["wins"]
         rows_out.append({
@@ -979,134 +3392,1317 @@ def export_ranking_champion_kda_to_csv(metrics_rows, path: Path = CSV_RANKING_CH
             "meanFinalScore": s["sumFinalScore"] / matches,
         })
 
-    rows_out.sort(key=lambda x: x["meanKDA"], reverse=True)
+    rows_out = top_ranked(rows_out, key=lambda x: x["meanKDA"])
+    apply_position_deltas("champion_kda", rows_out, ("champion_name",))
 
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        fieldnames = ["position", "champion_name", "matches", "meanKDA", "winRate", "meanFinalScore"]
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        pos = 1
-        for r in rows_out:
-            r["position"] = pos
-            writer.writerow(r)
-            pos += 1
+    fieldnames = ["position", "positionDelta", "champion_name", "matches", "meanKDA", "winRate", "meanFinalScore"]
+    write_export_rows(path, fieldnames, rows_out)
 
     print(f"Exportado CSV ranking KDA por campeão para: {path}")
 
 
-def export_match_individual_score_grouped_to_csv(metrics_rows, path: Path = CSV_MATCH_INDIVIDUAL_SCORE_GROUPED_EXPORT_PATH):
-    if not metrics_rows:
-        print("Nenhum dado para score individual agrupado por match.")
+def _rank_window(window: str, start: str, end: str, entries) -> List[Dict[str, Any]]:
+    """entries: ((puuid, nick, tag), partidas, soma); ordena por média e numera (top-K)."""
+    min_matches = max(1, RANKING_WINDOW_MIN_MATCHES)
+    rows = [
+        {
+            "window": window,
+            "window_start": start,
+            "window_end": end,
+            "nick": nick,
+            "tag": tag,
+            "puuid": puuid,
+            "matches": matches,
+            "meanFinalScore": total / matches,
+        }
+        for (puuid, nick, tag), matches, total in entries
+        if matches >= min_matches
+    ]
+    return top_ranked(rows, key=lambda x: x["meanFinalScore"])
+
+
+def export_ranking_windows_to_csv(
+    metrics_rows,
+    path: Path = CSV_RANKING_WINDOWS_EXPORT_PATH,
+    today: Optional[datetime.date] = None
+):
+    """
+    Ranking de membros (média de final_score) por janela, num CSV só com a
+    coluna window: "7d", "30d"... (RANKING_WINDOW_DAYS, contando hoje, pelo
+    dia UTC em que a partida foi jogada) e "patch 14.3" para os
+    RANKING_WINDOW_PATCHES patches mais recentes.
+
+    As janelas de dias saem das somas acumuladas por dia (PrefixSums) e as
+    de patch dos buckets por patch, todos montados na mesma passada do
+    export de métricas: nenhuma janela relê as linhas.
+    """
+    agg = as_metrics_aggregator(metrics_rows)
+    if not agg.rows_count:
+        print("Nenhum dado para os rankings por janela.")
         return
 
-    import csv
-
-    matches = {}
-    for r in metrics_rows:
-        match_pk = r["match_pk"]
-        if match_pk not in matches:
-            matches[match_pk] = {
-                "match_pk": r["match_pk"],
-                "match_riot_id": r["match_riot_id"],
-                "created_at": r["created_at"],
-                "players": [],
-            }
+    today = today or datetime.datetime.now(datetime.timezone.utc).date()
+    rows_out: List[Dict[str, Any]] = []
+
+    index = agg.daily_prefix_sums()
+    for days in RANKING_WINDOW_DAYS:
+        start = (today - datetime.timedelta(days=max(1, days) - 1)).isoformat()
+        end = today.isoformat()
+        entries = ((key, *prefix.window(start, end)) for key, prefix in index.items())
+        rows_out.extend(_rank_window(f"{days}d", start, end, entries))
+
+    for patch in agg.recent_patches(RANKING_WINDOW_PATCHES):
+        entries = (
+            (key, *p["patches"][patch])
+            for key, p in agg.players.items()
+            if patch in p["patches"]
+        )
+        rows_out.extend(_rank_window(f"patch {patch}", "", "", entries))
 
-        matches[match_pk]["players"].append({
-            "team_position": r["team_position"],
-            "nick": r["nick"],
-            "tag": r["tag"],
-            "puuid": r["puuid"],
-            "win": int(r["win"]),
-            "champion_name": r["champion_name"],
-            "kda": float(r["kda"]),
-            "dmg_per_min": float(r["dmg_per_min"]),
-            "final_score": float(r["final_score"]),
-        })
+    apply_position_deltas("windows", rows_out, ("window", "puuid", "nick", "tag"))
 
-    rows_out = []
-    for _, m in matches.items():
-        players = m["players"]
-        players.sort(key=lambda x: x["final_score"], reverse=True)
+    fieldnames = ["window", "window_start", "window_end", "position", "positionDelta", "nick", "tag", "puuid", "matches", "meanFinalScore"]
+    write_export_rows(path, fieldnames, rows_out)
 
-        sum_score = 0.0
-        max_score = None
-        for p in players:
-            sum_score += p["final_score"]
-            if max_score is None or p["final_score"] > max_score:
-                max_score = p["final_score"]
+    print(f"Exportado CSV rankings por janela (dias/patch) para: {path}")
 
-        mean_score = sum_score / len(players) if players else 0.0
 
-        rows_out.append({
-            "match_pk": m["match_pk"],
-            "match_riot_id": m["match_riot_id"],
-            "created_at": m["created_at"],
-            "players": len(players),
-            "meanFinalScore": mean_score,
-            "maxFinalScore": max_score if max_score is not None else 0.0,
-            "players_scores": json.dumps(players, ensure_ascii=False),
+# =========================
+# PARTIDAS AGRUPADAS (group-by em streaming)
+# =========================
+
+GROUPED_EXPORT_FIELDS = ["match_pk", "match_riot_id", "created_at", "players", "meanFinalScore", "maxFinalScore", "players_scores"]
+
+GROUPED_EXPORT_PARQUET_TYPES = {
+    "match_pk": "int64",
+    "match_riot_id": "string",
+    "created_at": "string",
+    "players": "int64",
+    "meanFinalScore": "float64",
+    "maxFinalScore": "float64",
+    "players_scores": "string",
+}
+
+
+def export_page_path(path: Path, page: int) -> Path:
+    """Arquivo da página (1, 2...) de um export paginado: nome-0001.ext."""
+    return path.with_name(f"{path.stem}-{page:04d}{path.suffix}")
+
+
+def remove_stale_pages(path: Path, keep: List[Path]):
+    """Apaga páginas (nome-NNNN.ext) que sobraram de um export maior."""
+    keep_names = {p.name for p in keep}
+    for old in path.parent.glob(f"{path.stem}-[0-9][0-9][0-9][0-9]{path.suffix}"):
+        if old.name not in keep_names:
+            old.unlink()
+
+
+def build_match_group(match_pk, match_riot_id: str, created_at: str, players: List[MatchPlayer]) -> Dict[str, Any]:
+    """
+    Resumo de uma partida: jogadores ordenados por final_score, média e
+    máximo. players_scores fica como lista de MatchPlayer;
+    players_scores_payload converte para os dicts do JSON na hora de gravar.
+    """
+    players = sorted(players, key=lambda x: x.final_score, reverse=True)
+
+    sum_score = 0.0
+    max_score = None
+    for p in players:
+        sum_score += p.final_score
+        if max_score is None or p.final_score > max_score:
+            max_score = p.final_score
+
+    return {
+        "match_pk": match_pk,
+        "match_riot_id": match_riot_id,
+        "created_at": created_at,
+        "players": len(players),
+        "meanFinalScore": sum_score / len(players) if players else 0.0,
+        "maxFinalScore": max_score if max_score is not None else 0.0,
+        "players_scores": players,
+    }
+
+
+def players_scores_payload(players: List[MatchPlayer]) -> List[Dict[str, Any]]:
+    return [p._asdict() for p in players]
+
+
+class MatchGroupStream:
+    """
+    Group-by por partida em streaming sobre as linhas do export de
+    métricas, que chegam em created_at DESC, match_pk DESC: as linhas de
+    uma partida vêm juntas, então só a partida aberta fica em memória e
+    ela é emitida (build_match_group) assim que a próxima começa.
+
+    Cada partida emitida vai para os sinks (add/close/abort), ex.:
+    GroupedCsvWriter e MatchBundleWriter, na ordem do export. A ordem é
+    conferida ((created_at, match_pk) sempre decrescente) e as quebras
+    contadas em out_of_order: uma partida cujas linhas não viessem juntas
+    sairia como mais de uma entrada.
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+        self.matches = 0
+        self.out_of_order = 0
+        self._match_pk = None
+        self._created_at = ""
+        self._match_riot_id = ""
+        self._last_key = None
+        self._players: List[MatchPlayer] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def add(self, r):
+        if not isinstance(r, ExportRow):
+            r = ExportRow.from_export(r)
+        if r.match_pk != self._match_pk or not self._players:
+            self._emit()
+            self._match_pk = r.match_pk
+            self._created_at = r.created_at
+            self._match_riot_id = r.match_riot_id
+        self._players.append(MatchPlayer(
+            r.team_position, r.nick, r.tag, r.puuid, int(r.win), r.champion_name,
+            float(r.kda), float(r.dmg_per_min), float(r.final_score),
+        ))
+
+    def add_all(self, rows) -> "MatchGroupStream":
+        for r in rows:
+            self.add(r)
+        return self
+
+    def _emit(self):
+        if not self._players:
+            return
+        key = (self._created_at, self._match_pk)
+        if self._last_key is not None and key > self._last_key:
+            self.out_of_order += 1
+        self._last_key = key
+
+        group = build_match_group(self._match_pk, self._match_riot_id, self._created_at, self._players)
+        for sink in self.sinks:
+            sink.add(group)
+        self.matches += 1
+        self._players = []
+
+    def close(self):
+        self._emit()
+        for sink in self.sinks:
+            sink.close()
+        if self.out_of_order:
+            print(f"Aviso: {self.out_of_order} partidas fora da ordem created_at/match_pk no export agrupado.")
+
+    def abort(self):
+        for sink in self.sinks:
+            sink.abort()
+
+
+class GroupedCsvWriter:
+    """
+    CSV agrupado por partida (players_scores em JSON), gravado conforme as
+    partidas chegam. Com page_size > 0 também divide em arquivos de
+    page_size partidas (nome-0001.csv, nome-0002.csv...); o arquivo único
+    continua saindo ao lado, porque é o fallback da página de partidas
+    sem os pacotes JSON. Com EXPORT_PARQUET, cada arquivo ganha o
+    .parquet ao lado.
+    """
+
+    def __init__(self, path: Path = CSV_MATCH_INDIVIDUAL_SCORE_GROUPED_EXPORT_PATH, page_size: int = 0):
+        self.path = path
+        self.page_size = max(0, page_size)
+        self.pages: List[Path] = []
+        self.matches = 0
+        self._page: Optional[_GroupedCsvFile] = None
+        self._full: Optional[_GroupedCsvFile] = None
+
+    def _finish_page(self):
+        if self._page is None:
+            return
+        self._page.close()
+        self._page = None
+
+    def add(self, group: Dict[str, Any]):
+        if self._full is None:
+            self._full = _GroupedCsvFile(self.path)
+        if self.page_size and self._page is None:
+            page_path = export_page_path(self.path, len(self.pages) + 1)
+            self.pages.append(page_path)
+            self._page = _GroupedCsvFile(page_path)
+        row = dict(
+            group, players_scores=json.dumps(players_scores_payload(group["players_scores"]), ensure_ascii=False)
+        )
+        self._full.add(row)
+        self.matches += 1
+        if self._page is not None:
+            self._page.add(row)
+            if self._page.out.rows >= self.page_size:
+                self._finish_page()
+
+    def close(self):
+        self._finish_page()
+        if self._full is not None:
+            self._full.close()
+            self._full = None
+        if not self.matches:
+            return
+        remove_stale_pages(self.path, self.pages)
+        if self.page_size:
+            print(
+                f"Exportado CSV score individual agrupado por partidas para: {self.path} "
+                f"(e em {len(self.pages)} arquivos de {self.page_size} partidas)"
+            )
+        else:
+            print(f"Exportado CSV score individual agrupado por partidas para: {self.path}")
+
+    def abort(self):
+        for f in (self._page, self._full):
+            if f is not None:
+                f.abort()
+        self._page = self._full = None
+
+
+class _GroupedCsvFile:
+    """Um arquivo do GroupedCsvWriter: CSV atômico (+ .parquet com EXPORT_PARQUET)."""
+
+    def __init__(self, path: Path):
+        self.out = AtomicExportFile(path).__enter__()
+        self.writer = csv.DictWriter(self.out.file, fieldnames=GROUPED_EXPORT_FIELDS)
+        self.writer.writeheader()
+        self.out.rows = 0
+        self.parquet = ParquetRowWriter(parquet_path_for(path), GROUPED_EXPORT_PARQUET_TYPES) if EXPORT_PARQUET else None
+
+    def add(self, row: Dict[str, Any]):
+        self.writer.writerow(row)
+        if self.parquet is not None:
+            self.parquet.add(row)
+        self.out.rows += 1
+
+    def close(self):
+        self.out.__exit__(None, None, None)
+        if self.parquet is not None:
+            self.parquet.close()
+
+    def abort(self):
+        self.out.__exit__(RuntimeError, None, None)
+        if self.parquet is not None:
+            self.parquet.abort()
+
+
+def _write_json(path: Path, payload, rows: Optional[int] = None):
+    with AtomicExportFile(path) as out:
+        json.dump(payload, out.file, ensure_ascii=False, separators=(",", ":"))
+        out.rows = rows
+
+
+class MatchBundleWriter:
+    """
+    Pacotes JSON paginados para a página de partidas (mesmos dados do CSV
+    agrupado, sem CSV com JSON embutido), gravados conforme as partidas
+    chegam: só a página atual (até page_size partidas) fica em memória.
+      - page-0001.json, page-0002.json...: na mesma ordem do CSV, com
+        players_scores já como lista;
+      - search-0001.json...: ao lado de cada página, o texto pesquisável
+        de cada partida (match id, nick#tag e campeão dos jogadores), que
+        a página só baixa quando alguém pesquisa;
+      - out_dir/index.json: totais (para os KPIs) e a lista de páginas,
+        para a página buscar só o que vai mostrar.
+
+    As páginas vão para um diretório temporário e, no close, viram
+    out_dir/v-<hash do conteúdo>/ (rename atômico); o index.json, que
+    aponta para esse diretório, é trocado por último. Um abort no meio
+    do caminho não deixa páginas novas ao lado de um index.json antigo.
+    Sem mudanças, o hash é o mesmo e nada é regravado; a versão anterior
+    fica até o próximo export, para quem ainda está com o index.json
+    antigo aberto.
+    """
+
+    def __init__(self, out_dir: Path = JSON_MATCHES_EXPORT_DIR, page_size: int = MATCHES_BUNDLE_PAGE_SIZE):
+        self.out_dir = out_dir
+        self.page_size = max(1, page_size)
+        self.pages: List[Dict[str, Any]] = []
+        self.total_matches = 0
+        self.total_players = 0
+        self.max_final_score = 0.0
+        self._chunk: List[Dict[str, Any]] = []
+        self._search: List[str] = []
+        self._staging = out_dir / f".staging-{os.getpid()}"
+        self._staged: List[Path] = []
+
+    def add(self, group: Dict[str, Any]):
+        self._chunk.append(dict(group, players_scores=players_scores_payload(group["players_scores"])))
+        self._search.append(" ".join(
+            [str(group["match_riot_id"] or "")]
+            + [f"{p.nick}#{p.tag} {p.champion_name}" for p in group["players_scores"]]
+        ).lower())
+        self.total_matches += 1
+        self.total_players += group["players"]
+        self.max_final_score = max(self.max_final_score, group["maxFinalScore"])
+        if len(self._chunk) >= self.page_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._chunk:
+            return
+        page = len(self.pages) + 1
+        page_path = export_page_path(self._staging / "page.json", page)
+        search_path = export_page_path(self._staging / "search.json", page)
+        _write_json(page_path, {"matches": self._chunk}, rows=len(self._chunk))
+        _write_json(search_path, {"search": self._search}, rows=len(self._search))
+        self._staged += [page_path, search_path]
+        self.pages.append({
+            "file": page_path.name,
+            "search_file": search_path.name,
+            "matches": len(self._chunk),
+            "first_match_pk": self._chunk[0]["match_pk"],
+            "last_match_pk": self._chunk[-1]["match_pk"],
+        })
+        self._chunk = []
+        self._search = []
+
+    def _publish(self) -> str:
+        """Move as páginas do diretório temporário para out_dir/v-<hash>/ e devolve o nome dele."""
+        digest = hashlib.sha256()
+        for path in self._staged:
+            digest.update(f"{path.name}:{_EXPORTS_WRITTEN[path]['sha256']}\n".encode())
+        version_dir = self.out_dir / f"v-{digest.hexdigest()[:16]}"
+
+        existed = version_dir.exists()
+        if existed:
+            # mesmo conteúdo da versão publicada: nada muda para quem lê
+            shutil.rmtree(self._staging)
+        else:
+            os.replace(self._staging, version_dir)
+        for path in self._staged:
+            info = _EXPORTS_WRITTEN.pop(path)
+            _EXPORTS_WRITTEN[version_dir / path.name] = dict(info, changed=not existed)
+        self._staged = []
+        return version_dir.name
+
+    def _remove_old_versions(self, keep: set):
+        for old in self.out_dir.glob("v-*"):
+            if old.is_dir() and old.name not in keep:
+                shutil.rmtree(old, ignore_errors=True)
+        # páginas soltas (formato antigo, sem diretório de versão) e
+        # diretórios temporários de execuções que caíram
+        remove_stale_pages(self.out_dir / "page.json", [])
+        for stale in self.out_dir.glob(".staging-*"):
+            shutil.rmtree(stale, ignore_errors=True)
+
+    def close(self):
+        self._flush()
+        if not self.total_matches:
+            return
+
+        index_path = self.out_dir / "index.json"
+        previous = None
+        if index_path.exists():
+            try:
+                with open(index_path, encoding="utf-8") as f:
+                    previous = json.load(f).get("version")
+            except ValueError:
+                previous = None
+
+        version = self._publish()
+        for p in self.pages:
+            p["file"] = f"{version}/{p['file']}"
+            p["search_file"] = f"{version}/{p['search_file']}"
+
+        _write_json(index_path, {
+            "version": version,
+            "page_size": self.page_size,
+            "total_matches": self.total_matches,
+            "total_players": self.total_players,
+            "max_final_score": self.max_final_score,
+            "pages": self.pages,
         })
+        self._remove_old_versions({version, previous})
 
-    rows_out.sort(key=lambda x: x["created_at"], reverse=True)
+        print(f"Exportados {len(self.pages)} pacotes JSON de partidas para: {self.out_dir / version}")
 
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        fieldnames = ["match_pk", "match_riot_id", "created_at", "players", "meanFinalScore", "maxFinalScore", "players_scores"]
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for r in rows_out:
-            writer.writerow(r)
+    def abort(self):
+        self._chunk = []
+        self._search = []
+        shutil.rmtree(self._staging, ignore_errors=True)
+        for path in self._staged:
+            _EXPORTS_WRITTEN.pop(path, None)
+        self._staged = []
+
+
+def match_group_stream() -> MatchGroupStream:
+    """Stream com os dois exports por partida nos caminhos padrão (CSV agrupado + pacotes JSON)."""
+    return MatchGroupStream(
+        GroupedCsvWriter(page_size=MATCHES_GROUPED_PAGE_SIZE),
+        MatchBundleWriter(),
+    )
+
+
+def export_match_individual_score_grouped_to_csv(
+    metrics_rows,
+    path: Path = CSV_MATCH_INDIVIDUAL_SCORE_GROUPED_EXPORT_PATH,
+    page_size: int = MATCHES_GROUPED_PAGE_SIZE
+):
+    """
+    metrics_rows: linhas do export de métricas (ExportRow ou dicts), na
+    ordem dele (created_at DESC, match_pk DESC). No pipeline o CSV agrupado
+    sai na mesma passada do export (match_group_stream); isto é para
+    regravar só ele a partir das linhas.
+    """
+    with MatchGroupStream(GroupedCsvWriter(path, page_size)) as stream:
+        stream.add_all(metrics_rows or [])
+    if not stream.matches:
+        print("Nenhum dado para score individual agrupado por match.")
 
-    print(f"Exportado CSV score individual agrupado por partidas para: {path}")
+
+def export_match_bundles_to_json(
+    metrics_rows,
+    out_dir: Path = JSON_MATCHES_EXPORT_DIR,
+    page_size: int = MATCHES_BUNDLE_PAGE_SIZE
+):
+    """Como export_match_individual_score_grouped_to_csv, para os pacotes JSON (MatchBundleWriter)."""
+    with MatchGroupStream(MatchBundleWriter(out_dir, page_size)) as stream:
+        stream.add_all(metrics_rows or [])
+    if not stream.matches:
+        print("Nenhum dado para os pacotes JSON de partidas.")
 
 
 # =========================
-# MAIN
+# ESTADO DO PROCESSAMENTO (high-water mark + marcação)
 # =========================
 
-def main():
-    conn = get_connection()
-    try:
-        members_by_puuid, member_puuids = fetch_members(conn)
-        print(f"Encontrados {len(member_puuids)} membros ativos na tabela members.")
+# chave do high-water mark em metrics_job_state: maior matches.id já processado
+HWM_STATE_KEY = "last_match_pk"
+# maior player_match_metrics.id já somado em member_ranking_metrics
+RANKING_STATE_KEY = "ranked_metrics_id"
 
-        matches = fetch_matches_to_process(conn)
-        print(f"Encontradas {len(matches)} partidas para processar.")
 
-        for m in matches:
-            print(f"Processando match {m['match_id_riot']} (id={m['match_pk']})...")
-            participants = fetch_participants_for_match(conn, m["match_pk"])
-            if not participants:
-                print("  -> sem participantes? pulando.")
-                continue
+def ensure_processed_table(conn):
+    """
+    match_metrics_processed: uma linha por partida já processada (rows_count
+    = linhas gravadas em player_match_metrics, 0 quando não tem membros).
+    """
+    sql = """
+        CREATE TABLE IF NOT EXISTS match_metrics_processed (
+            match_id BIGINT NOT NULL PRIMARY KEY,
+            rows_count INT NOT NULL,
+            processed_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql)
+    conn.commit()
+
+
+def ensure_match_errors_table(conn):
+    """
+    match_metrics_errors: partidas que falharam no cálculo (ex.: timeline
+    malformado) e foram puladas pelo --watch, com a última mensagem de erro.
+    Elas ficam marcadas como processadas (rows_count = 0); para tentar de
+    novo, apague a linha delas em match_metrics_processed.
+    """
+    sql = """
+        CREATE TABLE IF NOT EXISTS match_metrics_errors (
+            match_id BIGINT NOT NULL PRIMARY KEY,
+            error_message TEXT NOT NULL,
+            failed_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+                ON UPDATE CURRENT_TIMESTAMP
+        )
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql)
+    conn.commit()
+
+
+def record_match_error(conn, match_pk: int, exc: BaseException):
+    sql = """
+        INSERT INTO match_metrics_errors (match_id, error_message)
+        VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE error_message = VALUES(error_message)
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql, (match_pk, f"{type(exc).__name__}: {exc}"[:2000]))
+    conn.commit()
+
+
+def ensure_job_state_table(conn):
+    """
+    Estado persistente dos jobs do Python (ex.: high-water mark do --watch).
+    state_text guarda uma âncora opcional do valor (o matches.match_id da
+    Riot no high-water mark), para detectar ids que voltaram a 1.
+    """
+    sql = """
+        CREATE TABLE IF NOT EXISTS metrics_job_state (
+            state_key VARCHAR(64) NOT NULL PRIMARY KEY,
+            state_value BIGINT NOT NULL,
+            state_text VARCHAR(64) NULL,
+            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+                ON UPDATE CURRENT_TIMESTAMP
+        )
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql)
+    conn.commit()
+    ensure_column(conn, "metrics_job_state", "state_text", """
+        ALTER TABLE metrics_job_state
+            ADD COLUMN state_text VARCHAR(64) NULL
+    """)
+
+
+def load_job_state(conn, key: str) -> Optional[int]:
+    with conn.cursor() as cur:
+        cur.execute("SELECT state_value FROM metrics_job_state WHERE state_key = %s", (key,))
+        row = cur.fetchone()
+    return int(row["state_value"]) if row else None
+
+
+def load_job_state_text(conn, key: str) -> Optional[str]:
+    with conn.cursor() as cur:
+        cur.execute("SELECT state_text FROM metrics_job_state WHERE state_key = %s", (key,))
+        row = cur.fetchone()
+    return row["state_text"] if row else None
+
+
+def save_job_state(conn, key: str, value: int, commit: bool = True, text: Optional[str] = None):
+    """commit=False deixa a gravação na transação de quem chama; text vai em state_text."""
+    sql = """
+        INSERT INTO metrics_job_state (state_key, state_value, state_text)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            state_value = VALUES(state_value),
+            state_text = VALUES(state_text)
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql, (key, value, text))
+    if commit:
+        conn.commit()
+
+
+def clear_job_state(conn, key: str):
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM metrics_job_state WHERE state_key = %s", (key,))
+    conn.commit()
+
+
+def fetch_max_match_pk(conn) -> int:
+    with conn.cursor() as cur:
+        cur.execute("SELECT COALESCE(MAX(id), 0) AS max_pk FROM matches")
+        row = cur.fetchone()
+    return int(row["max_pk"])
+
+
+def fetch_match_riot_id(conn, match_pk: int) -> Optional[str]:
+    with conn.cursor() as cur:
+        cur.execute("SELECT match_id FROM matches WHERE id = %s", (match_pk,))
+        row = cur.fetchone()
+    return row["match_id"] if row else None
+
+
+def detect_matches_reset(conn) -> bool:
+    """
+    Se a tabela matches foi recriada desde o último high-water mark
+    (ddl-auto: create do Spring derruba matches e player_match_metrics e
+    os ids voltam a 1): o matches.id do high-water mark não existe mais,
+    ou não é mais a mesma partida da Riot (âncora em state_text).
+
+    Nesse caso as marcas e o estado do Python, que são por matches.id,
+    apontariam para outras partidas: apaga as marcas, os erros e as
+    marcas de estado, e a próxima busca faz o bootstrap (marcas refeitas
+    a partir de player_match_metrics + passada completa). Retorna True
+    se apagou.
+    """
+    hwm = load_job_state(conn, HWM_STATE_KEY)
+    if hwm is None or hwm == 0:
+        return False
+    anchor = load_job_state_text(conn, HWM_STATE_KEY)
+    riot_id = fetch_match_riot_id(conn, hwm)
+    if riot_id is not None and riot_id == anchor:
+        return False
+    if riot_id is not None and anchor is None:
+        # estado de antes da âncora: passa a valer a partir de agora
+        save_job_state(conn, HWM_STATE_KEY, hwm, text=riot_id)
+        return False
+
+    print(
+        f"Aviso: matches.id = {hwm} (high-water mark) não é mais a partida {anchor or '?'}; "
+        "a tabela matches foi recriada. Apagando as marcas de processamento e recomeçando."
+    )
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM match_metrics_processed")
+        cur.execute("DELETE FROM match_metrics_errors")
+        cur.execute(
+            "DELETE FROM metrics_job_state WHERE state_key IN (%s, %s)",
+            (HWM_STATE_KEY, RANKING_STATE_KEY),
+        )
+    conn.commit()
+    return True
+
+
+def backfill_processed_markers(conn) -> int:
+    """
+    Marca como processadas as partidas que já têm linhas em
+    player_match_metrics (bancos de antes da match_metrics_processed).
+    Roda uma vez, no bootstrap.
+    """
+    sql = """
+        INSERT INTO match_metrics_processed (match_id, rows_count)
+        SELECT match_id, COUNT(*)
+        FROM player_match_metrics
+        GROUP BY match_id
+        ON DUPLICATE KEY UPDATE rows_count = VALUES(rows_count)
+    """
+    with conn.cursor() as cur:
+        n = cur.execute(sql)
+    conn.commit()
+    return n or 0
+
+
+def pending_scan_start(conn, lookback: int = HWM_LOOKBACK) -> Tuple[int, Optional[int]]:
+    """
+    Devolve (start_after, bootstrap_hwm) para a busca por partidas pendentes.
+
+    Com high-water mark salvo: começa lookback ids antes dele, e a
+    busca só toca as partidas novas (as do intervalo já marcadas saem
+    pelo anti-join na chave primária de match_metrics_processed).
+    Partidas pendentes mais de lookback ids abaixo dele não são vistas.
+
+    Sem high-water mark (primeira execução): preenche as marcas a partir de
+    player_match_metrics e faz uma passada completa (start_after = 0);
+    bootstrap_hwm é o maior matches.id antes dela, para salvar no fim.
+    """
+    hwm = load_job_state(conn, HWM_STATE_KEY)
+    if hwm is not None:
+        return max(0, hwm - lookback), None
+
+    bootstrap_hwm = fetch_max_match_pk(conn)
+    marked = backfill_processed_markers(conn)
+    print(
+        f"Sem high-water mark: {marked} partidas marcadas a partir de player_match_metrics; "
+        f"passada completa até matches.id = {bootstrap_hwm}."
+    )
+    return 0, bootstrap_hwm
+
+
+def advance_hwm(conn, writer: "MetricsWriter", bootstrap_hwm: Optional[int] = None) -> Optional[int]:
+    """
+    Depois do writer fechado, sobe o high-water mark para o maior match_id
+    gravado (ou para o bootstrap_hwm da passada completa). Nunca desce.
+    """
+    current = load_job_state(conn, HWM_STATE_KEY)
+    candidates = [v for v in (current, writer.max_match_pk, bootstrap_hwm) if v is not None]
+    if not candidates:
+        return None
+    hwm = max(candidates)
+    if hwm != current:
+        # âncora para detect_matches_reset: a partida da Riot nesse matches.id
+        save_job_state(conn, HWM_STATE_KEY, hwm, text=fetch_match_riot_id(conn, hwm))
+    return hwm
+
+
+# =========================
+# PIPELINE (cálculo + ranking + exports)
+# =========================
+
+def process_jobs(
+    conn,
+    jobs: Iterator[Tuple[Dict[str, Any], List[Dict[str, Any]]]],
+    member_puuids: set,
+    writer: "MetricsWriter",
+    stats: RunStats,
+    args: argparse.Namespace,
+    baselines: Optional["RoleBaselines"] = None,
+    pool: Optional[ProcessPoolExecutor] = None,
+    skip_errors: bool = False
+) -> int:
+    """
+    Calcula as partidas de jobs (score_matches), manda as linhas para o
+    writer e guarda as features novas no cache. Retorna quantas partidas
+    foram processadas. O writer continua aberto: quem chama faz o close.
+    baselines: modo "role" (None = normalização por partida).
+    pool: pool de processos reaproveitado (ver score_matches).
+    skip_errors: uma partida que falha no cálculo vai para
+    match_metrics_errors e é marcada como processada (sem linhas), e as
+    demais seguem; sem isso, o erro interrompe a execução.
+    """
+    def on_match_error(m: Dict[str, Any], exc: Exception):
+        print(f"ERRO na match {m['match_id_riot']} (id={m['match_pk']}): {type(exc).__name__}: {exc}; pulando.")
+        stats.incr("matches_failed")
+        record_match_error(conn, m["match_pk"], exc)
+        writer.add([], match_pk=m["match_pk"])
+
+    total_matches = 0
+    new_features: Dict[int, Tuple[str, Dict[str, Any]]] = {}
+    try:
+        for m, metrics_rows, features, timings in score_matches(
+            jobs, member_puuids, workers=args.workers, max_in_flight=args.max_in_flight,
+            baselines=baselines, pool=pool, on_error=on_match_error if skip_errors else None,
+        ):
+            total_matches += 1
+            stats.add_timings(timings)
+
+            # guarda as features extraídas agora (inclusive de partidas sem membros)
+            if features is not None:
+                new_features[m["match_pk"]] = (m["match_id_riot"], features)
+                if len(new_features) >= args.batch_size:
+                    with stats.stage("save_features"):
+                        save_timeline_features(conn, new_features)
+                    new_features = {}
+
+            # marca a partida como processada junto com as linhas (sem membros: só a marca)
+            writer.add(metrics_rows, match_pk=m["match_pk"])
 
-            metrics_rows = compute_metrics_for_match(m, participants, member_puuids)
             if not metrics_rows:
-                print("  -> nenhum membro do grupo nessa partida. pulando.")
+                stats.incr("matches_without_members")
+                if VERBOSITY >= 1:
+                    print(f"  -> match {m['match_id_riot']}: nenhum membro do grupo nessa partida. pulando.")
+                stats.match_done()
                 continue
 
-            insert_metrics(conn, metrics_rows)
-            print(f"  -> inseridas {len(metrics_rows)} linhas em player_match_metrics.")
+            if VERBOSITY >= 1:
+                print(f"  -> match {m['match_id_riot']}: {len(metrics_rows)} linhas para player_match_metrics.")
+            stats.match_done()
+    except MetricsFlushError as e:
+        print(f"ERRO: partidas não gravadas em player_match_metrics: {e.match_ids}")
+        raise
 
-        # Atualiza ranking por membro
-        update_member_ranking(conn)
+    with stats.stage("save_features"):
+        save_timeline_features(conn, new_features)
+    return total_matches
 
-        # Exportar CSV
-        exported_metrics_rows = export_metrics_to_csv(conn)
+
+def prepare_baselines(conn, args: argparse.Namespace, stats: RunStats) -> Tuple[Optional[RoleBaselines], bool]:
+    """
+    Baselines do modo "role": reconstrói com --rebuild-baselines (ou se o
+    modo "role" ainda não tem baselines) e carrega. Retorna (baselines ou
+    None no modo "match", se houve rebuild).
+    """
+    role_mode = args.scoring_mode == "role"
+    baselines = load_role_baselines(conn) if role_mode else None
+
+    rebuilt = False
+    if args.rebuild_baselines or (role_mode and baselines is None):
+        print("Recalculando os baselines por rota a partir de player_match_metrics...")
+        with stats.stage("baselines"):
+            version, n_groups = rebuild_role_baselines(conn, by_patch=args.baseline_by_patch)
+        print(f"  -> baselines versão {version}: {n_groups} grupos (rota/patch).")
+        rebuilt = True
+        if role_mode:
+            baselines = load_role_baselines(conn)
+
+    if role_mode and baselines is None:
+        print("Sem baselines por rota (player_match_metrics vazio?); usando a normalização por partida.")
+    return baselines, rebuilt
+
+
+def refresh_outputs(
+    conn,
+    stats: RunStats,
+    full_rebuild: bool = False,
+    checkpoint=None
+):
+    """Atualiza o ranking de membros e regrava todos os exports (e o manifesto)."""
+    if checkpoint is None:
+        checkpoint = lambda label: None
+
+    with stats.stage("ranking_update"):
+        update_member_ranking(conn, full_rebuild=full_rebuild)
+    checkpoint("after_ranking")
+
+    # Exportar CSV: a mesma passada (em streaming) grava o CSV de
+    # métricas, os exports por partida e alimenta os agregados dos rankings
+    with stats.stage("export_metrics"), match_group_stream() as match_groups:
+        aggregates = export_metrics_to_csv(conn, match_groups=match_groups)
+    checkpoint("after_export_metrics")
+    with stats.stage("export_member_ranking"):
         export_ranking_to_csv(conn)
 
-        # Novos rankings (sem novas queries)
-        export_ranking_kda_mean_to_csv(exported_metrics_rows)
-        export_ranking_position_score_to_csv(exported_metrics_rows)
-        export_ranking_damage_mean_to_csv(exported_metrics_rows)
-        export_ranking_champion_winrate_to_csv(exported_metrics_rows)
-        export_ranking_champion_kda_to_csv(exported_metrics_rows)
-        export_match_individual_score_grouped_to_csv(exported_metrics_rows)
+    # Novos rankings (sem novas queries): só renderizam dos agregados
+    export_rankings(aggregates, stats)
+    write_ranking_snapshot()
+    write_export_manifest()
+    checkpoint("after_exports")
+
+
+# =========================
+# MODO WATCH (daemon)
+# =========================
+
+def install_stop_handlers() -> threading.Event:
+    """SIGINT/SIGTERM só pedem a parada; o loop termina o micro-lote atual e sai."""
+    stop = threading.Event()
+
+    def _request_stop(signum, frame):
+        print(f"Sinal {signal.Signals(signum).name} recebido; encerrando depois do lote atual...")
+        stop.set()
+
+    signal.signal(signal.SIGINT, _request_stop)
+    signal.signal(signal.SIGTERM, _request_stop)
+    return stop
+
+
+def watch(
+    conn,
+    args: argparse.Namespace,
+    stats: RunStats,
+    stop: Optional[threading.Event] = None,
+    baselines: Optional["RoleBaselines"] = None
+):
+    """
+    Fica rodando e calcula as partidas novas em micro-lotes:
+      - consulta matches.id acima do high-water mark (metrics_job_state,
+        menos --hwm-lookback), então cada consulta só toca as linhas novas;
+      - grava as métricas e as marcas (match_metrics_processed) do
+        micro-lote numa transação e só depois avança o high-water mark;
+      - ranking e exports com debounce (WATCH_DEBOUNCE_SECONDS sem partidas
+        novas, ou no máximo WATCH_MAX_DELAY_SECONDS);
+      - usa uma conexão só (ping com reconnect antes de cada consulta);
+      - SIGINT/SIGTERM: termina o lote, atualiza os exports pendentes e sai;
+      - uma partida que falha no cálculo é registrada em match_metrics_errors
+        e pulada, sem derrubar o watch;
+      - com --workers > 1, um pool de processos só para a sessão inteira
+        (recriado só quando a lista de membros muda).
+      - se o Spring recriar a tabela matches (ids voltam a 1), apaga as
+        marcas (detect_matches_reset) e recomeça do início.
+
+    Sem high-water mark salvo, faz antes uma passada completa (como o modo
+    normal) e começa do maior matches.id visto antes dela.
+    baselines: modo "role", carregado uma vez no início (um rebuild dos
+    baselines vale a partir do próximo start do watch).
+    """
+    if stop is None:
+        stop = install_stop_handlers()
+
+    batch_size = max(1, args.watch_batch_size)
+
+    pending_rows = 0
+    first_pending: Optional[float] = None
+    last_new: Optional[float] = None
+
+    pool: Optional[ProcessPoolExecutor] = None
+    pool_members: Optional[set] = None
+
+    def scoring_pool(member_puuids: set) -> Optional[ProcessPoolExecutor]:
+        nonlocal pool, pool_members
+        if args.workers <= 1:
+            return None
+        if pool is None or member_puuids != pool_members:
+            if pool is not None:
+                pool.shutdown()
+            pool = make_scoring_pool(args.workers, member_puuids, baselines)
+            pool_members = member_puuids
+        return pool
+
+    try:
+        hwm = load_job_state(conn, HWM_STATE_KEY)
+        if hwm is None:
+            start_after, bootstrap_hwm = pending_scan_start(conn, args.hwm_lookback)
+            _, member_puuids = fetch_members(conn)
+            with MetricsWriter(conn, stats=stats) as writer:
+                batches = iter_matches_to_process(conn, args.batch_size, start_after=start_after)
+                jobs = iter_scoring_jobs(conn, args.batch_size, stats, batches=batches, writer=writer)
+                total = process_jobs(
+                    conn, jobs, member_puuids, writer, stats, args, baselines,
+                    pool=scoring_pool(member_puuids), skip_errors=True,
+                )
+            hwm = advance_hwm(conn, writer, bootstrap_hwm)
+            print(f"  -> {total} partidas processadas, {writer.rows_written} linhas gravadas.")
+            refresh_outputs(conn, stats, full_rebuild=args.full_rebuild)
+        else:
+            print(f"Watch retomando depois de matches.id = {hwm}.")
+            # linhas de um watch que caiu antes do refresh entram no ranking agora
+            refresh_outputs(conn, stats)
+
+        print(f"Aguardando partidas novas (a cada {args.watch_interval:g}s; Ctrl+C para sair)...")
+        while not stop.is_set():
+            conn.ping(reconnect=True)
+
+            if detect_matches_reset(conn):
+                # Spring recriou as tabelas com o watch rodando: recomeça do início
+                hwm, _ = pending_scan_start(conn, args.hwm_lookback)
+
+            with stats.stage("fetch"):
+                start_after = max(0, hwm - args.hwm_lookback)
+                batch = next(iter_matches_to_process(conn, batch_size, start_after=start_after), [])
+
+            if batch:
+                _, member_puuids = fetch_members(conn)
+                with MetricsWriter(conn, stats=stats) as writer:
+                    jobs = iter_scoring_jobs(conn, batch_size, stats, batches=iter([batch]), writer=writer)
+                    process_jobs(
+                        conn, jobs, member_puuids, writer, stats, args, baselines,
+                        pool=scoring_pool(member_puuids), skip_errors=True,
+                    )
+                hwm = advance_hwm(conn, writer)
+
+                pending_rows += writer.rows_written
+                now = time.monotonic()
+                last_new = now
+                if first_pending is None:
+                    first_pending = now
+                print(
+                    f"Micro-lote: {len(batch)} partidas, {writer.rows_written} linhas "
+                    f"(matches.id até {hwm})."
+                )
+
+            now = time.monotonic()
+            if first_pending is not None and (
+                now - last_new >= args.watch_debounce or now - first_pending >= WATCH_MAX_DELAY_SECONDS
+            ):
+                refresh_outputs(conn, stats)
+                stats.emit("watch_refresh", last_match_pk=hwm, new_rows=pending_rows)
+                pending_rows, first_pending, last_new = 0, None, None
+
+            # lote cheio: provavelmente tem mais partidas esperando, não dorme
+            if len(batch) < batch_size:
+                stop.wait(args.watch_interval)
+
+        if first_pending is not None:
+            refresh_outputs(conn, stats)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    print(f"Watch encerrado (último matches.id processado: {hwm}).")
+
+
+# =========================
+# MAIN
+# =========================
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Calcula as métricas das partidas pendentes, atualiza o ranking e exporta os CSVs."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("METRICS_WORKERS", "1")),
+        help="processos para o cálculo das partidas (1 = serial)",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=None,
+        help="máximo de partidas pendentes no pool (padrão: 4 x workers)",
+    )
+    parser.add_argument(
+        "--rescore",
+        action="store_true",
+        help="recalcula o final_score das linhas gravadas com pesos antigos (WEIGHTS_VERSION)",
+    )
+    parser.add_argument(
+        "--full-rebuild",
+        action="store_true",
+        help="refaz o ranking de membros do zero (GROUP BY em player_match_metrics)",
+    )
+    parser.add_argument(
+        "--parquet",
+        action="store_true",
+        default=EXPORT_PARQUET,
+        help="grava também os exports em Parquet (requer pyarrow)",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=RANKING_TOP_K,
+        metavar="K",
+        help="exporta só os K primeiros de cada ranking (0 = todos)",
+    )
+    parser.add_argument(
+        "--from-export",
+        type=Path,
+        default=None,
+        metavar="ARQUIVO",
+        help="só refaz os rankings a partir de um export de métricas (.parquet ou .csv), sem MySQL",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=MATCHES_BATCH_SIZE,
+        help="partidas lidas do banco por lote",
+    )
+    parser.add_argument(
+        "--db-readers",
+        type=int,
+        default=DB_READERS,
+        help="threads que leem os próximos lotes enquanto o atual é calculado (0 = só a conexão principal)",
+    )
+    parser.add_argument(
+        "--scoring-mode",
+        choices=["match", "role"],
+        default=SCORING_MODE,
+        help="normalização dos scores: min-max na partida (match) ou contra os baselines da rota (role)",
+    )
+    parser.add_argument(
+        "--reprocess-role",
+        action="store_true",
+        help="no modo match, recalcula (min-max na partida) as linhas gravadas no modo role",
+    )
+    parser.add_argument(
+        "--rebuild-baselines",
+        action="store_true",
+        help="recalcula metric_role_baselines (média/desvio por rota) a partir de player_match_metrics",
+    )
+    parser.add_argument(
+        "--baseline-by-patch",
+        action="store_true",
+        default=ROLE_BASELINE_BY_PATCH,
+        help="no rebuild, baselines também por patch (cai para a rota quando faltam amostras)",
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        action="count",
+        default=VERBOSITY,
+        help="mais saída (-v: uma linha por partida)",
+    )
+    parser.add_argument(
+        "--stats-path",
+        type=Path,
+        default=Path(METRICS_STATS_PATH) if METRICS_STATS_PATH else None,
+        metavar="ARQUIVO",
+        help="grava as estatísticas da execução (JSON lines) neste arquivo em vez do stdout",
+    )
+    parser.add_argument(
+        "--stats-every",
+        type=int,
+        default=0,
+        metavar="N",
+        help="emite também uma linha de progresso a cada N partidas (0 = só o resumo final)",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        nargs="?",
+        const=Path("compute_metrics.prof"),
+        default=None,
+        metavar="ARQUIVO",
+        help="roda sob cProfile e grava ARQUIVO (pstats) e ARQUIVO.txt (ordenado por tempo acumulado)",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="tracemalloc: memória e maiores alocações a cada etapa (setup, scoring, ranking, exports)",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="fica rodando: calcula as partidas novas em micro-lotes e atualiza os exports com debounce",
+    )
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=WATCH_POLL_SECONDS,
+        metavar="SEG",
+        help="segundos entre consultas por partidas novas no --watch",
+    )
+    parser.add_argument(
+        "--watch-debounce",
+        type=float,
+        default=WATCH_DEBOUNCE_SECONDS,
+        metavar="SEG",
+        help="no --watch, atualiza ranking/exports depois de SEG segundos sem partidas novas",
+    )
+    parser.add_argument(
+        "--watch-batch-size",
+        type=int,
+        default=WATCH_BATCH_SIZE,
+        help="partidas por micro-lote no --watch",
+    )
+    parser.add_argument(
+        "--hwm-lookback",
+        type=int,
+        default=HWM_LOOKBACK,
+        metavar="N",
+        help="a busca por pendentes começa N ids abaixo do high-water mark; partidas "
+             "que aparecem mais abaixo que isso não são vistas (aumente para recuperá-las)",
+    )
+    return parser.parse_args(argv)
+
+
+def export_rankings(aggregates: "MetricsAggregator", stats: Optional[RunStats] = None):
+    """Rankings que só dependem dos agregados do export de métricas."""
+    if stats is None:
+        stats = RunStats()
+    with stats.stage("export_ranking_kda_mean"):
+        export_ranking_kda_mean_to_csv(aggregates)
+    with stats.stage("export_ranking_position_score"):
+        export_ranking_position_score_to_csv(aggregates)
+    with stats.stage("export_ranking_damage_mean"):
+        export_ranking_damage_mean_to_csv(aggregates)
+    with stats.stage("export_ranking_champion_winrate"):
+        export_ranking_champion_winrate_to_csv(aggregates)
+    with stats.stage("export_ranking_champion_kda"):
+        export_ranking_champion_kda_to_csv(aggregates)
+    with stats.stage("export_ranking_windows"):
+        export_ranking_windows_to_csv(aggregates)
+
+
+def write_profile(profiler: cProfile.Profile, path: Path, limit: int = 60):
+    """Grava o .prof (para snakeviz/pstats) e um .txt com as funções por tempo acumulado."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    profiler.dump_stats(path)
+    txt_path = path.with_name(path.name + ".txt")
+    with open(txt_path, "w", encoding="utf-8") as f:
+        ps = pstats.Stats(profiler, stream=f)
+        ps.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+        ps.sort_stats(pstats.SortKey.TIME).print_stats(limit)
+    print(f"Profile gravado em: {path} e {txt_path}")
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+
+    if args.profile is None:
+        run(args)
+        return
+
+    # só o processo principal; com --workers > 1 o cálculo das partidas fica de fora
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run, args)
+    finally:
+        write_profile(profiler, args.profile)
+
+
+def run(args: argparse.Namespace):
+    global EXPORT_PARQUET, RANKING_TOP_K, VERBOSITY
+
+    EXPORT_PARQUET = args.parquet
+    RANKING_TOP_K = args.top_k
+    VERBOSITY = args.verbose
+    stats = RunStats(args.stats_path, every=args.stats_every)
+
+    tracer = MemoryTracer(stats) if args.trace_memory else None
+    checkpoint = tracer.checkpoint if tracer is not None else (lambda label: None)
+
+    try:
+        _run(args, stats, checkpoint)
+    finally:
+        if tracer is not None:
+            tracer.stop()
+
+
+def _run(args: argparse.Namespace, stats: RunStats, checkpoint):
+    if args.from_export is not None:
+        print(f"Refazendo rankings a partir de {args.from_export} (sem banco)...")
+        aggregates = MetricsAggregator()
+        with stats.stage("read_export"), match_group_stream() as match_groups:
+            for r in iter_metrics_export(args.from_export):
+                aggregates.add(r)
+                match_groups.add(r)
+        checkpoint("after_read_export")
+        export_rankings(aggregates, stats)
+        write_ranking_snapshot()
+        write_export_manifest()
+        checkpoint("after_exports")
+        stats.emit("run_summary", mode="from_export")
+        return
+
+    # conexão principal (escrita) + paginação dos ids + uma por thread leitora
+    readers = max(0, args.db_readers)
+    pool = ConnectionPool(size=readers + 2 if readers else 1)
+    conn = pool.acquire()
+    status = "error"
+    try:
+        members_by_puuid, member_puuids = fetch_members(conn)
+        print(f"Encontrados {len(member_puuids)} membros ativos na tabela members.")
+
+        ensure_timeline_features_table(conn)
+        ensure_weights_version_column(conn)
+        ensure_ranking_sum_column(conn)
+        ensure_processed_table(conn)
+        ensure_match_errors_table(conn)
+        ensure_job_state_table(conn)
+        ensure_role_baselines_table(conn)
+        detect_matches_reset(conn)
+        baselines, baselines_rebuilt = prepare_baselines(conn, args, stats)
+        if baselines is None and args.reprocess_role:
+            clear_job_state(conn, RANKING_STATE_KEY)
+            print("Recalculando no modo match as linhas do modo role...")
+            with stats.stage("reprocess_role"):
+                reprocessed, not_found = reprocess_role_matches(conn, stats, chunk_size=args.batch_size)
+            stats.incr("rescored_rows", reprocessed)
+            print(f"  -> {reprocessed} linhas de player_match_metrics atualizadas.")
+            if not_found:
+                print(f"  -> {not_found} partidas sem timeline/participantes continuam no modo role.")
+        elif baselines is None and has_role_scored_rows(conn):
+            print(
+                "Aviso: há linhas de player_match_metrics calculadas no modo role; o ranking vai "
+                "misturar as duas normalizações. Rode com --reprocess-role para voltar ao modo match."
+            )
+        checkpoint("after_setup")
+
+        rescored = 0
+        # antes do --watch também: --watch --rescore e baselines refeitos
+        # no start do watch valem para as linhas antigas
+        if args.rescore or (baselines is not None and baselines_rebuilt):
+            # final_scores antigos vão mudar: o próximo ranking é um rebuild,
+            # mesmo que esta execução caia antes de chegar lá
+            clear_job_state(conn, RANKING_STATE_KEY)
+        if baselines is not None and (args.rescore or baselines_rebuilt):
+            # modo "role": só as linhas fora da versão atual (pesos + baselines)
+            print(f"Recalculando scores para {baselines.scoring_version}...")
+            with stats.stage("rescore"):
+                rescored = rescore_metrics_by_role(conn, baselines)
+            stats.incr("rescored_rows", rescored)
+            print(f"  -> {rescored} linhas de player_match_metrics atualizadas.")
+        elif args.rescore:
+            print(f"Recalculando final_score para os pesos {WEIGHTS_VERSION}...")
+            with stats.stage("rescore"):
+                rescored = rescore_metrics(conn)
+            stats.incr("rescored_rows", rescored)
+            print(f"  -> {rescored} linhas de player_match_metrics atualizadas.")
+
+        if args.watch:
+            watch(conn, args, stats, baselines=baselines)
+            status = "ok"
+            return
+
+        # só as partidas acima do high-water mark (primeira vez: passada completa)
+        start_after, bootstrap_hwm = pending_scan_start(conn, args.hwm_lookback)
+        # commit antes de as threads leitoras abrirem as suas conexões
+        conn.commit()
+        with MetricsWriter(conn, stats=stats) as writer:
+            if readers:
+                loaded = iter_prefetched_batches(
+                    pool, args.batch_size, start_after, readers=readers, stats=stats
+                )
+                jobs = iter_scoring_jobs(conn, args.batch_size, stats, writer=writer, loaded=loaded)
+            else:
+                batches = iter_matches_to_process(conn, args.batch_size, start_after=start_after)
+                jobs = iter_scoring_jobs(conn, args.batch_size, stats, batches=batches, writer=writer)
+            total_matches = process_jobs(conn, jobs, member_puuids, writer, stats, args, baselines)
+        hwm = advance_hwm(conn, writer, bootstrap_hwm)
+        print(
+            f"Processadas {total_matches} partidas em {stats.counters.get('batches', 0)} lotes "
+            f"(high-water mark: matches.id = {hwm})."
+        )
+        skipped = stats.counters.get("matches_without_participants", 0)
+        if skipped:
+            print(f"  -> {skipped} partidas sem participantes puladas (-v para ver quais).")
+        print(
+            f"Gravadas {writer.rows_written} linhas de {writer.matches_written} partidas "
+            f"em player_match_metrics."
+        )
+        checkpoint("after_scoring")
+
+        # Atualiza ranking por membro: incremental com as linhas acima da
+        # marca (o rescore apaga a marca, e aí o ranking é refeito)
+        refresh_outputs(
+            conn,
+            stats,
+            full_rebuild=args.full_rebuild,
+            checkpoint=checkpoint,
+        )
+        status = "ok"
 
     finally:
-        conn.close()
+        pool.close()
+        stats.emit("run_summary", status=status, workers=args.workers, db_readers=readers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# compute_metrics.py e benchmark_metrics.py ficam em assets/python (sem pacote)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
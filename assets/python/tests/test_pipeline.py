@@ -0,0 +1,63 @@
+import pytest
+
+import compute_metrics as cm
+from benchmark_metrics import InMemoryDB, SyntheticMatches
+
+
+@pytest.fixture(scope="module")
+def gen():
+    return SyntheticMatches(seed=11, n_members=8, timeline_pool=4, events_per_frame=(5, 15))
+
+
+def _write(db, gen, pks, workers=1, max_in_flight=None):
+    jobs = (gen.match(pk) for pk in pks)
+    with cm.MetricsWriter(db, max_rows=37) as writer:
+        for m, metrics_rows, _, _ in cm.score_matches(
+            jobs, gen.member_puuids, workers=workers, max_in_flight=max_in_flight
+        ):
+            writer.add(metrics_rows, match_pk=m["match_pk"])
+
+
+def _ranking(db):
+    return {
+        r["member_id"]: (r["puuid"], r["matches_count"], r["position"], r["sum_final_score"], r["mean_final_score"])
+        for r in db.ranking.values()
+    }
+
+
+def test_incremental_ranking_matches_full_rebuild(gen):
+    db = InMemoryDB(gen.members, keep_metrics=True)
+    # sem marca: a primeira atualização é o rebuild; as outras, incrementais
+    for pks in (range(1, 31), range(31, 61), range(61, 62), range(62, 101)):
+        _write(db, gen, pks)
+        cm.update_member_ranking(db)
+    # regravar partidas já somadas não muda id nem ranking
+    _write(db, gen, range(1, 11))
+    cm.update_member_ranking(db)
+
+    incremental = _ranking(db)
+    assert db.job_state[cm.RANKING_STATE_KEY] == max(row_id for row_id, _ in db.metrics.values())
+
+    cm.update_member_ranking(db, full_rebuild=True)
+    rebuilt = _ranking(db)
+
+    assert incremental.keys() == rebuilt.keys() and len(rebuilt) == len(gen.members)
+    for member_id, (puuid, count, position, total, mean) in rebuilt.items():
+        inc = incremental[member_id]
+        assert inc[:3] == (puuid, count, position)
+        # a ordem das somas muda entre os dois caminhos
+        assert inc[3] == pytest.approx(total, rel=1e-12)
+        assert inc[4] == pytest.approx(mean, rel=1e-12)
+
+
+def test_workers_write_the_same_rows_as_serial(gen):
+    serial = InMemoryDB(gen.members, keep_metrics=True)
+    _write(serial, gen, range(1, 61))
+
+    parallel = InMemoryDB(gen.members, keep_metrics=True)
+    _write(parallel, gen, range(1, 61), workers=2, max_in_flight=6)
+
+    # mesmas linhas, floats bit a bit; só a ordem de chegada (ids) muda
+    assert serial.metrics.keys() == parallel.metrics.keys()
+    for key, (_, row) in serial.metrics.items():
+        assert parallel.metrics[key][1] == row
@@ -0,0 +1,61 @@
+import pytest
+
+import compute_metrics as cm
+from benchmark_metrics import SyntheticMatches
+
+
+@pytest.fixture(scope="module")
+def gen():
+    return SyntheticMatches(seed=7, timeline_pool=4, events_per_frame=(5, 15))
+
+
+def _jobs(gen, n):
+    jobs = [gen.match(pk) for pk in range(1, n + 1)]
+    # empate técnico: kills/deaths/assists/dano/ouro/farm iguais para os 10
+    match_row, participants = jobs[0]
+    same = {k: participants[0][k] for k in (
+        "kills", "deaths", "assists", "total_damage_dealt_to_champions", "total_damage_taken",
+        "gold_earned", "total_minions_killed", "neutral_minions_killed",
+    )}
+    jobs[0] = (match_row, [dict(p, **same) for p in participants])
+    return jobs
+
+
+def _expected(jobs, member_puuids):
+    return [cm.compute_metrics_for_match(m, ps, member_puuids) for m, ps in jobs]
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_score_match_batch_matches_scalar_path_bit_for_bit(gen, monkeypatch, use_numpy):
+    if use_numpy and cm.np is None:
+        pytest.skip("numpy não instalado")
+    if not use_numpy:
+        monkeypatch.setattr(cm, "np", None)
+
+    jobs = _jobs(gen, 40)
+    expected = _expected(jobs, gen.member_puuids)
+    results = cm.score_match_batch(jobs, gen.member_puuids)
+
+    assert len(results) == len(jobs)
+    for (metrics_rows, features, timings), rows in zip(results, expected):
+        # NamedTuple == compara cada float exatamente (sem tolerância)
+        assert metrics_rows == rows
+        assert features is not None and "scoring" in timings
+    assert any(r.score_kda == 50.0 for r in results[0][0])
+
+
+def test_score_match_batch_isolates_failed_matches(gen):
+    jobs = _jobs(gen, 5)
+    bad_row, participants = jobs[2]
+    jobs[2] = (dict(bad_row, timeline_json="{not json"), participants)
+
+    results = cm.score_match_batch(jobs, gen.member_puuids)
+
+    assert isinstance(results[2], Exception)
+    expected = _expected([j for i, j in enumerate(jobs) if i != 2], gen.member_puuids)
+    assert [r[0] for i, r in enumerate(results) if i != 2] == expected
+
+
+def test_final_scores_matches_weighted_final_score():
+    scores = [[float(i * 7 + k) % 100 for k in range(len(cm.METRIC_KEYS))] for i in range(50)]
+    assert cm.final_scores(scores) == [cm.weighted_final_score(s) for s in scores]
@@ -42,6 +42,10 @@ public class MemberRankingMetrics extends BaseEntity {
     @Column(name = "mean_final_score", nullable = false)
     private Double meanFinalScore;
 
+    // soma do finalScore (ranking incremental do compute_metrics.py)
+    @Column(name = "sum_final_score")
+    private Double sumFinalScore;
+
     // posição no ranking (1 = melhor)
     @Column(nullable = false)
     private Integer position;
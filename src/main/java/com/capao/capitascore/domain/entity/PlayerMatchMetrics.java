@@ -17,7 +17,8 @@ import lombok.Setter;
         indexes = {
                 @Index(name = "idx_pmm_match", columnList = "match_id"),
                 @Index(name = "idx_pmm_match_participant", columnList = "match_participant_id"),
-                @Index(name = "idx_pmm_puuid", columnList = "puuid")
+                @Index(name = "idx_pmm_puuid", columnList = "puuid"),
+                @Index(name = "idx_pmm_weights_version", columnList = "weights_version")
         }
 )
 @Getter
@@ -68,5 +69,9 @@ public class PlayerMatchMetrics extends BaseEntity {
     // ---- score final ----
     private Double finalScore;
 
+    // versão dos pesos (WEIGHTS do compute_metrics.py) usada no finalScore
+    @Column(name = "weights_version", length = 32)
+    private String weightsVersion;
+
 }
 